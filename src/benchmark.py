@@ -0,0 +1,522 @@
+"""
+#####################################################################################################################
+
+    Benchmarks of the inference backends
+
+    The first argument is the name of the benchmark, the following ones are the same flags of main_exec.py
+        $ python benchmark.py spec -c cfg_example -m 10 -d 9
+
+    Available benchmarks:
+        spec        assisted generation with a draft model, against plain generation
+        fast        tokens/sec on CPU for each combination of attention kernel, KV cache and compilation
+        replicas    Qwen2-VL samples as replicas in one batch, against sequential calls
+        batching    continuous batching scheduler, against one generate call per prompt
+        detail      yes/no/unk replies, tokens and latency of OpenAI (or local) models for each image detail level
+        onnx        latency of HF completions with the vision encoder in ONNX Runtime, against PyTorch
+        load        cold and warm load time of a HF model from the local cache, appended to f_load
+        startup     wall time and import time of the commands in startup_commands, appended to f_startup
+
+#####################################################################################################################
+"""
+
+import  os
+import  sys
+import  time
+import  subprocess
+
+import  main_exec                               # this module sets the execution configuration
+import  prompt          as prmpt                # this module composes the prompts
+import  complete        as cmplt                # this module performs LLM completions
+import  conversation    as conv                 # this module handles conversations with the LLM
+
+detail_levels           = ( "high", "low", "auto" ) # image detail levels compared, the first is the reference
+detail_news             = 10                    # news used by the detail benchmark, if not given in the config
+f_load                  = "../res/load_times.csv"   # history of the load times of HF models
+f_startup               = "../res/startup_times.csv"    # history of the startup times of the commands
+startup_repeats         = 5                     # executions of each command, the first is the cold start
+startup_top             = 5                     # packages with the largest import time shown for each command
+startup_commands        = (                     # commands measured by the startup benchmark
+        [ "main_exec.py", "-m", "-1" ],
+        [ "main_exec.py", "-h" ],
+        [ "replay.py", "-h" ],
+        [ "workqueue.py", "-h" ],
+        [ "benchmark.py" ],
+        [ "-c", "import scan_res" ],
+        [ "-c", "import infstat" ],
+)
+
+# ===================================================================================================================
+#
+#   Utilities
+#   - count_calls
+#   - modalities
+#   - bench_prompts
+#   - evict
+#   - import_times
+#
+# ===================================================================================================================
+
+def count_calls( model ):
+    """
+    Attach to a model a hook counting its forward calls
+
+    params:
+        model       [torch.nn.Module] the model to monitor
+
+    return:         [list] with the counter as single item, updated at each call
+                    [torch.utils.hooks.RemovableHandle] handle to remove the hook
+    """
+    counter     = [ 0 ]
+
+    def hook( module, args ):
+        counter[ 0 ]    += 1
+
+    handle      = model.register_forward_pre_hook( hook )
+    return counter, handle
+
+
+def modalities():
+    """
+    Return the image modalities used by the configured experiment
+
+    return:         [list] of [bool] with_img values
+    """
+    match main_exec.cnfg.experiment:
+        case "news_noimage":
+            return [ False ]
+        case "news_image":
+            return [ True ]
+    return [ True, False ]
+
+
+def bench_prompts():
+    """
+    Compose the prompts of the configured dialogs for all news and modalities
+
+    return:         [list] of tuples ( prompt, image )
+    """
+    cnfg        = main_exec.cnfg
+    news_ids    = cnfg.news_ids if len( cnfg.news_ids ) else prmpt.list_news()
+    prompts     = []
+
+    for with_img in modalities():
+        for n in news_ids:
+            pr, image, _    = conv.build_prompt( n, with_img=with_img, demographics=cnfg.demographics )
+            prompts.append( ( pr, image ) )
+
+    return prompts
+
+
+def evict( folder ):
+    """
+    Drop the files of a folder from the page cache, so that the next read comes from disk
+
+    params:
+        folder      [str] the folder, symbolic links are followed
+    """
+    for root, _, files in os.walk( folder ):
+        for f in files:
+            fd      = os.open( os.path.realpath( os.path.join( root, f ) ), os.O_RDONLY )
+            os.posix_fadvise( fd, 0, 0, os.POSIX_FADV_DONTNEED )
+            os.close( fd )
+
+
+def import_times( cmd ):
+    """
+    Execute a python command with -X importtime, and return its wall time and the import time of each package
+
+    params:
+        cmd         [list] of [str] arguments of python
+
+    return:         [float] wall seconds of the command
+                    [dict] with top level packages as keys and their import seconds (self time) as values
+    """
+    t_start     = time.perf_counter()
+    res         = subprocess.run( [ sys.executable, "-X", "importtime", *cmd ], capture_output=True, text=True )
+    wall        = time.perf_counter() - t_start
+
+    packages    = dict()
+    for line in res.stderr.splitlines():
+        if not line.startswith( "import time:" ) or "self [us]" in line:
+            continue
+        us, _, name = line[ len( "import time:" ): ].split( "|" )
+        pkg         = name.strip().split( "." )[ 0 ]
+        packages[ pkg ] = packages.get( pkg, 0. ) + int( us ) / 1e6
+
+    return wall, packages
+
+
+# ===================================================================================================================
+#
+#   Benchmarks
+#   - bench_spec
+#   - bench_fast
+#   - bench_replicas
+#   - bench_batching
+#   - bench_detail
+#   - bench_onnx
+#   - bench_load
+#   - bench_startup
+#
+# ===================================================================================================================
+
+def bench_spec():
+    """
+    Compare assisted generation using the draft model with plain generation of the main model, over the dialogs
+    of the configuration. Report the acceptance rate of the draft tokens and the end-to-end speedup.
+
+    The acceptance rate is derived from the number of forward calls: each verification pass of the main model
+    yields the accepted draft tokens plus one token of its own, and each forward of the draft proposes one token.
+    """
+    cnfg        = main_exec.cnfg
+    assert cnfg.draft is not None, "error: the spec benchmark requires a draft model (flag -d)"
+
+    cmplt.client    = cmplt.set_hf()
+    draft           = cmplt.client[ "draft" ]
+    tokenizer       = cmplt.client[ "processor" ].tokenizer
+    prompts         = bench_prompts()
+    cnfg.n_returns  = 1
+
+    stats       = { "plain": [ 0., 0, 0 ], "assisted": [ 0., 0, 0 ] }     # seconds, new tokens, main calls
+    n_target, h_target  = count_calls( cmplt.client[ "model" ] )
+    n_draft, h_draft    = count_calls( draft )
+
+    for i, ( pr, image ) in enumerate( prompts ):
+        for mode in ( "plain", "assisted" ):
+            cmplt.client[ "draft" ] = draft if mode == "assisted" else None
+            calls       = n_target[ 0 ]
+            t_start     = time.perf_counter()
+            completion  = cmplt.complete_hf( pr, image )
+            stats[ mode ][ 0 ]  += time.perf_counter() - t_start
+            stats[ mode ][ 1 ]  += sum( len( tokenizer( c )[ "input_ids" ] ) for c in completion )
+            stats[ mode ][ 2 ]  += n_target[ 0 ] - calls
+        if cnfg.VERBOSE:
+            print( f"prompt {i+1}/{len( prompts )} done" )
+
+    h_target.remove()
+    h_draft.remove()
+    cmplt.client[ "draft" ] = draft
+
+    t_plain, tok_plain, _   = stats[ "plain" ]
+    t_asst, tok_asst, verif = stats[ "assisted" ]
+    accepted                = max( tok_asst - verif, 0 )
+    acceptance              = accepted / n_draft[ 0 ] if n_draft[ 0 ] else 0.
+
+    print( f"main model:           {cnfg.model}" )
+    print( f"draft model:          {cnfg.draft}" )
+    print( f"prompts:              {len( prompts )}" )
+    print( f"plain generation:     {tok_plain:>7d} tokens in {t_plain:8.1f} s  ({tok_plain/t_plain:6.2f} tok/s)" )
+    print( f"assisted generation:  {tok_asst:>7d} tokens in {t_asst:8.1f} s  ({tok_asst/t_asst:6.2f} tok/s)" )
+    print( f"draft tokens:         {n_draft[ 0 ]:>7d} proposed, {accepted} accepted" )
+    print( f"acceptance rate:      {acceptance:.3f}" )
+    print( f"end-to-end speedup:   {t_plain/t_asst:.2f}x" )
+    print( f"per-token speedup:    {( tok_asst/t_asst ) / ( tok_plain/t_plain ):.2f}x" )
+
+
+def bench_fast():
+    """
+    Measure the generation speed on CPU of the configured HF model, for all combinations of attention kernel,
+    KV cache and compilation. The model is reloaded for every combination, and the time spent in the first
+    prompt, that includes warm-up and compilation, is reported separately.
+    """
+    os.environ[ "CUDA_VISIBLE_DEVICES" ]    = ""           # force CPU, before torch is imported by complete.py
+
+    cnfg        = main_exec.cnfg
+    assert cnfg.interface == "hf", "error: the fast benchmark requires a HF model"
+    cnfg.draft  = None
+    prompts     = bench_prompts()
+    combos      = [
+            ( "eager",  None,       False ),
+            ( "sdpa",   None,       False ),
+            ( "eager",  "static",   False ),
+            ( "sdpa",   "static",   False ),
+            ( "eager",  "static",   True ),
+            ( "sdpa",   "static",   True ),
+    ]
+    results     = []
+
+    for attn, cache, comp in combos:
+        cnfg.attn_impl, cnfg.cache_impl, cnfg.compile = attn, cache, comp
+        cmplt.static_caches.clear()
+        cmplt.warmed.clear()
+        cmplt.client    = cmplt.set_hf()
+        cmplt.torch._dynamo.reset()
+        tokenizer       = cmplt.client[ "processor" ].tokenizer
+
+        t_first         = 0.
+        t_total         = 0.
+        n_tokens        = 0
+        for i, ( pr, image ) in enumerate( prompts ):
+            t_start     = time.perf_counter()
+            completion  = cmplt.do_complete( pr, image=image )
+            elapsed     = time.perf_counter() - t_start
+            if i == 0:
+                t_first     = elapsed
+                continue
+            t_total     += elapsed
+            n_tokens    += sum( len( tokenizer( c )[ "input_ids" ] ) for c in completion )
+        results.append( ( attn, str( cache ), comp, t_first, n_tokens, t_total ) )
+        if cnfg.VERBOSE:
+            print( f"done {attn} {cache} {comp}" )
+
+    print( f"model: {cnfg.model}    prompts: {len( prompts )}    n_returns: {cnfg.n_returns}" )
+    print( "attn    cache    compile   first [s]   tokens    time [s]     tok/s" )
+    for attn, cache, comp, t_first, n_tokens, t_total in results:
+        speed   = n_tokens / t_total if t_total else 0.
+        print( f"{attn:<8}{cache:<9}{str( comp ):<10}{t_first:>9.1f}{n_tokens:>9d}{t_total:>12.1f}{speed:>10.2f}" )
+
+
+def bench_replicas():
+    """
+    Compare the Qwen2-VL samples generated as replicas along the batch dimension in one call, with the samples
+    generated by one call each, in speed and in the distribution of yes/no/unk replies over the configured dialogs.
+    The differences in the fraction of replies are compared with the noise expected from sampling cnfg.n_returns.
+    """
+    import  numpy           as np
+
+    cnfg        = main_exec.cnfg
+    assert "Qwen2-VL" in cnfg.model and cnfg.interface == "hf", "error: the replicas benchmark requires Qwen2-VL"
+    cnfg.draft      = None
+    cmplt.client    = cmplt.set_hf()
+    prompts         = bench_prompts()
+    values          = ( "yes", "no", "unk" )
+    n_max           = cmplt.qwen2_vl_n_max
+    stats           = dict()
+
+    for mode, n in ( ( "batched", n_max ), ( "sequential", 1 ) ):
+        cmplt.qwen2_vl_n_max    = n
+        t_total     = 0.
+        fractions   = []
+        for pr, image in prompts:
+            t_start     = time.perf_counter()
+            completion  = cmplt.do_complete( pr, image=image )
+            t_total     += time.perf_counter() - t_start
+            res         = conv.check_reply( completion )
+            fractions.append( [ res[ v ].mean() for v in values ] )
+        stats[ mode ]   = ( t_total, np.array( fractions ) )
+    cmplt.qwen2_vl_n_max    = n_max
+
+    t_batch, f_batch    = stats[ "batched" ]
+    t_seq, f_seq        = stats[ "sequential" ]
+    diff                = np.abs( f_batch - f_seq )
+    pooled              = ( f_batch + f_seq ) / 2
+    noise               = 2 * np.sqrt( 2 * pooled * ( 1 - pooled ) / cnfg.n_returns )
+
+    print( f"model: {cnfg.model}    prompts: {len( prompts )}    n_returns: {cnfg.n_returns}" )
+    print( "                 yes      no     unk" )
+    print( "batched     " + "".join( f"{v:>8.3f}" for v in f_batch.mean( axis=0 ) ) )
+    print( "sequential  " + "".join( f"{v:>8.3f}" for v in f_seq.mean( axis=0 ) ) )
+    print( "max |diff|  " + "".join( f"{v:>8.3f}" for v in diff.max( axis=0 ) ) )
+    print( "beyond 2sd  " + "".join( f"{v:>8d}" for v in ( diff > noise ).sum( axis=0 ) ) )
+    print( f"time batched:    {t_batch:8.1f} s" )
+    print( f"time sequential: {t_seq:8.1f} s" )
+    print( f"speedup:         {t_seq/t_batch:8.2f}x" )
+
+
+def bench_batching():
+    """
+    Compare the throughput of the continuous batching scheduler, with cnfg.cb_slots decode slots (default 8),
+    with that of one generate call per prompt, over the configured dialogs
+    """
+    cnfg        = main_exec.cnfg
+    assert cnfg.interface == "hf", "error: the batching benchmark requires a HF model"
+    if not cnfg.cb_slots:
+        cnfg.cb_slots   = 8
+    cmplt.client    = cmplt.set_hf()
+    tokenizer       = cmplt.client[ "processor" ].tokenizer
+    prompts         = bench_prompts()
+    n_seqs          = len( prompts ) * cnfg.n_returns
+
+    t_start         = time.perf_counter()
+    n_tokens        = 0
+    for pr, image in prompts:
+        completion  = cmplt.do_complete( pr, image=image )
+        n_tokens    += sum( len( tokenizer( c )[ "input_ids" ] ) for c in completion )
+    t_call          = time.perf_counter() - t_start
+
+    cmplt.do_complete_batch( [ p[ 0 ] for p in prompts ], [ p[ 1 ] for p in prompts ] )
+    st              = cmplt.batch_stats
+
+    print( f"model: {cnfg.model}    prompts: {len( prompts )}    n_returns: {cnfg.n_returns}" )
+    print( "                       tokens    time [s]     tok/s     seq/s     req/s" )
+    print( f"generate per prompt  {n_tokens:>8d}{t_call:>12.1f}{n_tokens/t_call:>10.2f}"
+           f"{n_seqs/t_call:>10.3f}{len( prompts )/t_call:>10.3f}" )
+    print( f"{cnfg.cb_slots:>3d} decode slots      {st[ 'tokens' ]:>8d}{st[ 'seconds' ]:>12.1f}{st[ 'tokens/s' ]:>10.2f}"
+           f"{st[ 'sequences/s' ]:>10.3f}{st[ 'requests/s' ]:>10.3f}" )
+
+
+def bench_detail():
+    """
+    Run the news with images at each image detail level, and compare the distributions of yes/no/unk replies
+    with the reference level, together with the prompt tokens and the latency of the requests.
+    The cheapest level whose replies match the reference is the one to use.
+    """
+    import  numpy           as np
+
+    cnfg        = main_exec.cnfg
+    assert cnfg.interface in ( "openai", "local" ), "error: the detail benchmark requires an OpenAI or local model"
+    assert cnfg.mode == "chat", "error: the detail benchmark requires a chat-mode model"
+
+    news_ids    = cnfg.news_ids if len( cnfg.news_ids ) else prmpt.list_news()[ :detail_news ]
+    values      = ( "yes", "no", "unk" )
+    stats       = dict()
+
+    for level in detail_levels:
+        prmpt.detail    = level
+        for k in cmplt.usage_stats:
+            cmplt.usage_stats[ k ]  = 0
+        seconds     = 0.
+        yes_rate    = []
+        counts      = dict.fromkeys( values, 0 )
+        for n in news_ids:
+            t_start     = time.perf_counter()
+            _, completion, res, _   = conv.ask_one( n, with_img=True, demographics=cnfg.demographics )
+            seconds     += time.perf_counter() - t_start
+            for v in values:
+                counts[ v ] += res[ v ].sum()
+            yes_rate.append( res[ "yes" ].mean() )
+        n_replies   = sum( counts.values() )
+        stats[ level ]  = {
+            "dist":     np.array( [ counts[ v ] / n_replies for v in values ] ),
+            "yes_rate": np.array( yes_rate ),
+            "tokens":   cmplt.usage_stats[ "prompt" ],
+            "latency":  seconds / len( news_ids ),
+        }
+        if cnfg.VERBOSE:
+            print( f"detail {level} done" )
+
+    # total variation distance of the overall distribution, and mean difference of the yes rate per news
+    ref         = stats[ detail_levels[ 0 ] ]
+    print( f"model: {cnfg.model}    news: {len( news_ids )}    n_returns: {cnfg.n_returns}" )
+    print( "detail     yes     no    unk   TVD   d_yes   prompt tokens   saved   latency [s]   saved" )
+    for level in detail_levels:
+        st          = stats[ level ]
+        tvd         = 0.5 * np.abs( st[ "dist" ] - ref[ "dist" ] ).sum()
+        d_yes       = np.abs( st[ "yes_rate" ] - ref[ "yes_rate" ] ).mean()
+        tok_saved   = 1. - st[ "tokens" ] / ref[ "tokens" ] if ref[ "tokens" ] else 0.
+        lat_saved   = 1. - st[ "latency" ] / ref[ "latency" ]
+        yes, no, unk    = st[ "dist" ]
+        print( f"{level:<8}{yes:>6.3f}{no:>7.3f}{unk:>7.3f}{tvd:>6.3f}{d_yes:>8.3f}"
+               f"{st[ 'tokens' ]:>16d}{tok_saved:>8.1%}{st[ 'latency' ]:>14.2f}{lat_saved:>8.1%}" )
+
+
+def bench_onnx():
+    """
+    Compare the latency of HF completions of the news with images, with the vision encoder in PyTorch and
+    in ONNX Runtime. The ONNX encoder is exported if needed, and verified against PyTorch when loaded.
+    """
+    import  onnx_vision
+
+    cnfg                = main_exec.cnfg
+    cnfg.onnx_vision    = False
+    cmplt.client        = cmplt.set_hf()
+    onnx_vision.cnfg    = cnfg
+    news_ids            = cnfg.news_ids if len( cnfg.news_ids ) else prmpt.list_news()
+    prompts             = [ conv.build_prompt( n, with_img=True, demographics=cnfg.demographics ) for n in news_ids ]
+    seconds             = dict()
+
+    for backend in ( "pytorch", "onnx" ):
+        if backend == "onnx":
+            onnx_vision.patch_client( cmplt.client )
+        cmplt.complete_hf( *prompts[ 0 ][ :2 ] )           # warm up
+        t_start     = time.perf_counter()
+        for pr, image, _ in prompts:
+            cmplt.complete_hf( pr, image )
+        seconds[ backend ]  = ( time.perf_counter() - t_start ) / len( prompts )
+
+    print( f"model: {cnfg.model}    prompts: {len( prompts )}    onnx threads: {cnfg.onnx_threads}" )
+    print( f"pytorch encoder    {seconds[ 'pytorch' ]:.2f} s per prompt" )
+    print( f"onnx encoder       {seconds[ 'onnx' ]:.2f} s per prompt" )
+    print( f"speedup            {seconds[ 'pytorch' ] / seconds[ 'onnx' ]:.2f}" )
+
+
+def bench_load():
+    """
+    Measure the load time of a HF model from the local cache, cold (its files evicted from the page cache)
+    and warm (loaded again right after). The times are appended to f_load, to track regressions per model.
+        NOTE: files with pages mapped by other processes are not evicted
+    """
+    import  gc
+
+    cnfg            = main_exec.cnfg
+    cnfg.offline    = True
+    snapshot        = cmplt.hf_snapshot( cnfg.model )
+    assert snapshot is not None, f"error: no local snapshot of {cnfg.model}"
+
+    seconds         = dict()
+    for start in ( "cold", "warm" ):
+        if start == "cold":
+            evict( snapshot )
+        cmplt.client    = cmplt.set_hf()
+        seconds[ start ]    = cmplt.load_seconds
+        cmplt.client    = None
+        gc.collect()
+
+    print( f"model: {cnfg.model}" )
+    print( f"cold load          {seconds[ 'cold' ]:.1f} s" )
+    print( f"warm load          {seconds[ 'warm' ]:.1f} s" )
+
+    new_file        = not os.path.isfile( f_load )
+    with open( f_load, 'a' ) as f:
+        if new_file:
+            f.write( "date,host,model,cold,warm\n" )
+        f.write( f"{time.strftime( '%y-%m-%d_%H-%M-%S' )},{os.uname().nodename},{cnfg.model},"
+                 f"{seconds[ 'cold' ]:.2f},{seconds[ 'warm' ]:.2f}\n" )
+
+
+def bench_startup():
+    """
+    Measure the startup of the commands in startup_commands: the wall time of the first execution (cold start)
+    and the best of startup_repeats executions (warm start), with the import time and the packages taking
+    the most of it.
+    The times are appended to f_startup, to track the startup of each command.
+    """
+    rows        = []
+    print( "command                        cold [s]  warm [s]  imports [s]  largest imports [s]" )
+    for cmd in startup_commands:
+        walls       = []
+        for _ in range( startup_repeats ):
+            wall, packages  = import_times( cmd )
+            walls.append( wall )
+        imports     = sum( packages.values() )
+        top         = sorted( packages.items(), key=lambda x: -x[ 1 ] )[ : startup_top ]
+        top         = " ".join( f"{p}:{t:.3f}" for p, t in top )
+        name        = " ".join( cmd )
+        print( f"{name:<31}{walls[ 0 ]:>8.3f}{min( walls ):>10.3f}{imports:>13.3f}  {top}" )
+        rows.append( ( name, walls[ 0 ], min( walls ), imports, top ) )
+
+    os.makedirs( os.path.dirname( f_startup ), exist_ok=True )
+    new_file    = not os.path.isfile( f_startup )
+    with open( f_startup, 'a' ) as f:
+        if new_file:
+            f.write( "date,host,command,cold,warm,imports,largest\n" )
+        for name, cold, warm, imports, top in rows:
+            f.write( f"{time.strftime( '%y-%m-%d_%H-%M-%S' )},{os.uname().nodename},{name},"
+                     f"{cold:.3f},{warm:.3f},{imports:.3f},{top}\n" )
+
+
+# ===================================================================================================================
+#
+#   MAIN
+#
+# ===================================================================================================================
+
+benchmarks  = {
+    "spec":     bench_spec,
+    "fast":     bench_fast,
+    "replicas": bench_replicas,
+    "batching": bench_batching,
+    "detail":   bench_detail,
+    "onnx":     bench_onnx,
+    "load":     bench_load,
+    "startup":  bench_startup,
+}
+
+if __name__ == '__main__':
+    if len( sys.argv ) < 2 or sys.argv[ 1 ] not in benchmarks:
+        print( f"usage: python benchmark.py <{'|'.join( benchmarks )}> [main_exec.py flags]" )
+        sys.exit()
+
+    bench       = benchmarks[ sys.argv.pop( 1 ) ]
+    main_exec.init_cnfg()
+    bench()
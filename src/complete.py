@@ -8,30 +8,111 @@
 
 import  os
 import  sys
+import  time
 import  platform
-from    PIL         import Image
+import  threading
+from    collections             import deque
+from    concurrent.futures      import ThreadPoolExecutor, wait, as_completed
 
 key_file                = "../data/.key.txt"    # file with the current OpenAI API access key
 hf_file                 = "../data/.hf.txt"     # file with the current huggingface access key
 
 native_res              = ( 672, 672 )          # image resolution for LLaVA-NeXT, Qwen2-VL-7B should be multiple of 28
 llava_next_n_max        = 50                    # maximum number of returns for LLaVA-NeXT (due to GPU memory)
-qwen2_vl_n_max          = 1                     # NOTE: Qwen2-VL-7B provide inconsisten results with more than 1!!
+qwen2_vl_n_max          = 50                    # maximum number of returns for Qwen2-VL (replicas in the batch)
+compile_bucket          = 64                    # input lengths are padded to multiples of this, with static cache
+local_pool              = 16                    # connections kept alive with a local OpenAI-compatible server
+hedge_min_samples       = 10                    # latencies observed before hedging requests
+hedge_workers           = 8                     # threads sending hedged requests
 
 client                  = None                  # the language model client object
 cnfg                    = None                  # parameter obj assigned by main_exec.py
 
+static_caches           = dict()                # static KV caches, by input shape and number of sequences
+warmed                  = set()                 # input shapes already run through the compiled decoder
+batch_stats             = None                  # throughput of the last continuous batching run
+hedge_pool              = None                  # threads sending hedged requests
+stats_lock              = threading.Lock()      # statistics and pool shared by the threads sending requests
+hedge_stats             = {                     # statistics of hedged requests
+        "latencies":    deque( maxlen=200 ),    # recent latencies, for the hedging percentile
+        "requests":     0,                      # all requests
+        "hedged":       0,                      # requests with a duplicate
+        "won":          0,                      # duplicates faster than the original request
+        "saved":        0.,                     # seconds saved by the duplicates
+}
+usage_stats             = {                     # tokens billed by OpenAI requests, as returned by the API
+        "requests":     0,
+        "prompt":       0,
+        "completion":   0,
+}
+local_only              = False                 # HF models are loaded from the local cache, without network
+load_seconds            = None                  # time taken to load the HF client
+
 
 # ===================================================================================================================
 #
+#   - hf_snapshot
+#   - hf_load_kwargs
+#   - compile_decoder
 #   - set_hf_llava_next
 #   - set_hf_chameleon
 #   - set_hf_qwen
 #   - set_hf
 #   - set_openai
+#   - set_local
 #
 # ===================================================================================================================
 
+def hf_snapshot( model_id ):
+    """
+    Return the folder of the local snapshot of a HuggingFace model, if in the cache
+
+    params:
+        model_id    [str] name of the model
+
+    return:         [str] or None if the model is not in the cache
+    """
+    from    huggingface_hub import snapshot_download
+
+    try:
+        return snapshot_download( model_id, local_files_only=True )
+    except Exception:
+        return None
+
+
+def hf_load_kwargs():
+    """
+    Return the arguments of from_pretrained common to all HuggingFace models.
+    Loading from the local cache, the safetensors are memory mapped and copied layer by layer to their
+    place, without a second full copy of the weights in memory
+
+    return:         [dict] keyword arguments
+    """
+    kwargs  = {
+            "device_map":           "auto",
+            "attn_implementation":  cnfg.attn_impl,             # "sdpa", "eager" or None for the model default
+    }
+    if local_only:
+        kwargs[ "local_files_only" ]    = True
+        kwargs[ "use_safetensors" ]     = True
+        kwargs[ "low_cpu_mem_usage" ]   = True
+    return kwargs
+
+
+def compile_decoder( model ):
+    """
+    Compile the forward of the language decoder, which runs once per generated token.
+    The vision encoder is left as it is, since it runs only once per prompt.
+        NOTE: compilation is effective with the static KV cache only, otherwise shapes change at each step
+
+    params:
+        model       [transformers.models...] client model
+    """
+    decoder         = model.language_model if hasattr( model, "language_model" ) else model.model
+    mode            = "reduce-overhead" if torch.cuda.is_available() else "default"
+    decoder.forward = torch.compile( decoder.forward, mode=mode, fullgraph=True )
+
+
 def set_hf_llava_next():
     """
     Return the LlavaNext client
@@ -43,9 +124,9 @@ def set_hf_llava_next():
     model           = LlavaNextForConditionalGeneration.from_pretrained(
             cnfg.model,
             torch_dtype=torch.float16,
-            device_map="auto"
+            **hf_load_kwargs()
             )
-    processor       = LlavaNextProcessor.from_pretrained( cnfg.model )
+    processor       = LlavaNextProcessor.from_pretrained( cnfg.model, local_files_only=local_only )
     client          = { "model": model, "processor": processor }
     return client
 
@@ -62,9 +143,9 @@ def set_hf_chameleon():
             cnfg.model,
             torch_dtype         = torch.float16,
             repetition_penalty  = cnfg.repetition_penalty,
-            device_map          = "auto"
+            **hf_load_kwargs()
             )
-    processor       = ChameleonProcessor.from_pretrained( cnfg.model )
+    processor       = ChameleonProcessor.from_pretrained( cnfg.model, local_files_only=local_only )
     client          = { "model": model, "processor": processor }
     return client
 
@@ -72,6 +153,7 @@ def set_hf_chameleon():
 def set_hf_qwen():
     """
     Return the Qwen client
+        NOTE: if a draft model is set in cnfg, the client includes it, for assisted generation
     """
     global  torch
     from    transformers    import Qwen2VLForConditionalGeneration, AutoProcessor
@@ -80,11 +162,18 @@ def set_hf_qwen():
     model           = Qwen2VLForConditionalGeneration.from_pretrained(
             cnfg.model,
             torch_dtype=torch.bfloat16,
-            # attn_implementation="flash_attention_2",    # should install FlashAttention-2 and see if works
-            device_map="auto"
+            # NOTE cnfg.attn_impl="flash_attention_2" should install FlashAttention-2 and see if works
+            **hf_load_kwargs()
+            )
+    processor       = AutoProcessor.from_pretrained( cnfg.model, local_files_only=local_only )
+    client          = { "model": model, "processor": processor, "draft": None }
+
+    if cnfg.draft is not None:
+        client[ "draft" ]   = Qwen2VLForConditionalGeneration.from_pretrained(
+            cnfg.draft,
+            torch_dtype=torch.bfloat16,
+            **hf_load_kwargs()
             )
-    processor       = AutoProcessor.from_pretrained( cnfg.model )
-    client          = { "model": model, "processor": processor }
     return client
 
 
@@ -93,20 +182,40 @@ def set_hf():
     Parse the hugginface key and return the client
         NOTE: should be the first function to call before all others that use hugginface models
         NOTE: the client has two items: the model and the prompt processor
+        NOTE: with cnfg.offline, the login is skipped if the models are in the local cache
     """
+    global  local_only, load_seconds
     from    huggingface_hub import login
 
-    key             = open( hf_file, 'r' ).read().rstrip()
-    login( token=key )
+    t_start         = time.time()
+    local_only      = cnfg.offline and hf_snapshot( cnfg.model ) is not None
+    if local_only and cnfg.draft is not None:
+        local_only      = hf_snapshot( cnfg.draft ) is not None
+    if not local_only:
+        if cnfg.offline:
+            print( f"WARNING: no local snapshot of {cnfg.model}, downloading it" )
+        key             = open( hf_file, 'r' ).read().rstrip()
+        login( token=key )
 
     if "llava-v1.6" in cnfg.model:
-        return set_hf_llava_next()
-    if "chameleon" in cnfg.model:
-        return set_hf_chameleon()
-    if "Qwen" in cnfg.model:
-        return set_hf_qwen()
-
-    return None
+        client  = set_hf_llava_next()
+    elif "chameleon" in cnfg.model:
+        client  = set_hf_chameleon()
+    elif "Qwen" in cnfg.model:
+        client  = set_hf_qwen()
+    else:
+        return None
+
+    if cnfg.onnx_vision:
+        import  onnx_vision
+        onnx_vision.cnfg    = cnfg
+        onnx_vision.patch_client( client )
+    if cnfg.compile:
+        compile_decoder( client[ "model" ] )
+    load_seconds    = time.time() - t_start
+    if cnfg.VERBOSE:
+        print( f"model loaded in {load_seconds:.1f} s" )
+    return client
 
 
 def set_openai():
@@ -120,34 +229,228 @@ def set_openai():
     return client
 
 
+def set_local():
+    """
+    Return the client for a local server with OpenAI-compatible API (like vLLM or llama.cpp server).
+    The client keeps a pool of keep-alive connections, shared by all the requests of the execution.
+        NOTE: the model is served with the same name used in models.py (e.g. vLLM --served-model-name)
+    """
+    import  httpx
+    from    openai          import OpenAI
+
+    limits          = httpx.Limits(
+            max_connections             = local_pool,
+            max_keepalive_connections   = local_pool,
+            keepalive_expiry            = None                  # never close idle connections
+    )
+    http_client     = httpx.Client( limits=limits, timeout=httpx.Timeout( None, connect=10. ) )
+    client          = OpenAI( base_url=cnfg.base_url, api_key="EMPTY", http_client=http_client )
+    return client
+
+
+# ===================================================================================================================
+#
+#   Utilities for HuggingFace generation
+#   - pad_bucket
+#   - replicate
+#   - static_cache
+#   - generate
+#   - decode_new
+#
+# ===================================================================================================================
+
+def pad_bucket( model, inputs ):
+    """
+    Left-pad the token ids of the inputs to a multiple of compile_bucket, so that the compiled decoder
+    and the static KV cache see only a few different shapes
+
+    params:
+        model       [transformers.models...] client model
+        inputs      [transformers.BatchFeature] output of the processor
+
+    return:         [transformers.BatchFeature] the padded inputs (the same object, modified in place)
+    """
+    length      = inputs[ "input_ids" ].shape[ 1 ]
+    n_pad       = -length % compile_bucket
+    if not n_pad:
+        return inputs
+
+    pad_id      = model.generation_config.pad_token_id
+    if pad_id is None:
+        pad_id      = model.generation_config.eos_token_id
+    if isinstance( pad_id, list ):
+        pad_id      = pad_id[ 0 ]
+
+    ids         = inputs[ "input_ids" ]
+    mask        = inputs[ "attention_mask" ]
+    pad         = torch.full( ( ids.shape[ 0 ], n_pad ), pad_id, dtype=ids.dtype, device=ids.device )
+    inputs[ "input_ids" ]       = torch.cat( ( pad, ids ), dim=1 )
+    inputs[ "attention_mask" ]  = torch.cat( ( torch.zeros_like( pad, dtype=mask.dtype ), mask ), dim=1 )
+    return inputs
+
+
+def replicate( inputs, n ):
+    """
+    Replicate the processed prompt along the batch dimension, to get independent samples from a single generate.
+    This replaces num_return_sequences for Qwen2-VL, where generate expands pixel_values as if the first dimension
+    were the batch, while it is the sequence of patches of all images: that is why more than 1 return gave garbage.
+    Here the patches are repeated once for every replica, together with their grid sizes.
+
+    params:
+        inputs      [transformers.BatchFeature] output of the processor, for one prompt
+        n           [int] number of replicas
+
+    return:         [transformers.BatchFeature] the batched inputs
+    """
+    if n == 1:
+        return inputs
+    for k in ( "input_ids", "attention_mask" ):
+        inputs[ k ]     = inputs[ k ].repeat( n, 1 )
+    if "pixel_values" in inputs:
+        inputs[ "pixel_values" ]    = inputs[ "pixel_values" ].repeat( n, 1 )
+        inputs[ "image_grid_thw" ]  = inputs[ "image_grid_thw" ].repeat( n, 1 )
+    return inputs
+
+
+def static_cache( model, length, batch ):
+    """
+    Return a static KV cache able to hold the input and cnfg.max_tokens new tokens, for all sequences.
+    The caches are created once per shape and then reset at every use.
+
+    params:
+        model       [transformers.models...] client model
+        length      [int] length of the (padded) input
+        batch       [int] number of sequences generated, including return sequences
+
+    return:         [transformers.StaticCache]
+    """
+    from    transformers    import StaticCache
+
+    key         = ( cnfg.model, length, batch )
+    if key not in static_caches:
+        config              = getattr( model.config, "text_config", model.config )
+        static_caches[ key ]    = StaticCache(
+                config          = config,
+                batch_size      = batch,
+                max_cache_len   = length + cnfg.max_tokens,
+                device          = model.device,
+                dtype           = model.dtype
+        )
+    cache       = static_caches[ key ]
+    cache.reset()
+    return cache
+
+
+def generate( model, inputs, n_returns, assistant=None, **extra ):
+    """
+    Generate completions with the sampling parameters in cnfg.
+    When cnfg.cache_impl is "static", the KV cache is preallocated and, if cnfg.compile is set,
+    the compiled decoder is warmed up once for each new shape of the inputs.
+
+    params:
+        model       [transformers.models...] client model
+        inputs      [transformers.BatchFeature] output of the processor
+        n_returns   [int] number of return sequences
+        assistant   [transformers.models...] draft model for assisted generation, or None
+        extra       other arguments of model.generate
+
+    return:         [torch.Tensor] the generated token ids, prompt included (with padding, if any),
+                    or the output object if return_dict_in_generate is in extra
+    """
+    kwargs      = {
+            "max_new_tokens":           cnfg.max_tokens,
+            "do_sample":                True,                   # NOTE: the default is greedy!
+            "num_return_sequences":     n_returns,
+            "top_p":                    cnfg.top_p,
+            "temperature":              cnfg.temperature,
+            **extra
+    }
+
+    # NOTE assisted generation manages its own dynamic caches for both models
+    if assistant is not None:
+        return model.generate( **inputs, assistant_model=assistant, **kwargs )
+
+    if cnfg.cache_impl == "static":
+        inputs          = pad_bucket( model, inputs )
+        batch, length   = inputs[ "input_ids" ].shape
+        batch           *= n_returns
+        if cnfg.compile and ( cnfg.model, length, batch ) not in warmed:
+            warm_kwargs = dict( kwargs, max_new_tokens=2 )
+            model.generate( **inputs, past_key_values=static_cache( model, length, batch ), **warm_kwargs )
+            warmed.add( ( cnfg.model, length, batch ) )
+        kwargs[ "past_key_values" ] = static_cache( model, length, batch )
+
+    return model.generate( **inputs, **kwargs )
+
+
+def decode_new( processor, out, length ):
+    """
+    Decode only the tokens generated after the prompt, in one batched call.
+    All rows share the same input length, since prompts are left-padded or replicated.
+
+    params:
+        processor   [transformers.models...] client input processor
+        out         [torch.Tensor] token ids returned by generate, prompt included
+        length      [int] length of the input ids passed to generate
+
+    return:         [list] with completions [str]
+    """
+    res         = processor.batch_decode( out[ :, length : ], skip_special_tokens=True )
+    return [ r.strip() for r in res ]
+
+
 # ===================================================================================================================
 #
+#   - add_usage
+#   - request_openai
+#   - hedge_delay
+#   - hedge_request
 #   - complete_openai
+#   - inputs_llava
+#   - inputs_chameleon
+#   - inputs_qwen
+#   - hf_inputs
 #   - complete_llava
 #   - complete_chameleon
 #   - complete_qwen
 #   - complete_hf
 #
 #   - do_complete
+#   - run_stats
 #
 # ===================================================================================================================
 
-def complete_openai( prompt ):
+def add_usage( res ):
     """
-    Feed a prompt to an OpenAI model and get the list of completions returned.
-    This function works for both completion-mode models and chat-mode models.
+    Accumulate the tokens used by a request, if returned by the server
+
+    params:
+        res         [openai.types...] response of the request
+
+    return:         [dict] with the prompt and completion tokens of the request
+    """
+    usage   = { "prompt": 0, "completion": 0 }
+    if res.usage is not None:
+        usage   = { "prompt": res.usage.prompt_tokens, "completion": res.usage.completion_tokens }
+    with stats_lock:
+        usage_stats[ "requests" ]   += 1
+        for k in usage:
+            usage_stats[ k ]    += usage[ k ]
+    return usage
+
+
+def request_openai( prompt ):
+    """
+    Send one completion request to an OpenAI model.
+    This function works for both completion-mode models and chat-mode models,
+    and for models on local servers with OpenAI-compatible API.
 
     params:
         prompt      [str] or [list] the prompt for completion-mode models,
                     or the messages for chat-mode models
 
-    return:         [list] with completions [str]
+    return:         [tuple] the [list] with completions [str], and the [dict] of tokens used, as add_usage
     """
-    global client
-#   if cnfg.DEBUG:  return [ "test_only" ]
-
-    if client is None:              # check if openai has already a client, otherwise set it
-        client  = set_openai()
     user    = os.getlogin() + '@' + platform.node()
 
     if cnfg.mode == "cmpl":
@@ -162,7 +465,7 @@ def complete_openai( prompt ):
             stop                    = None,
             user                    = user
         )
-        return [ t.text for t in res.choices ]
+        return [ t.text for t in res.choices ], add_usage( res )
 
     if cnfg.mode == "chat":
         assert isinstance( prompt, list ), "ERROR: for chat-mode models, the prompt should be a list"
@@ -178,30 +481,127 @@ def complete_openai( prompt ):
             temperature             = cnfg.temperature,
             user                    = user
         )
-        return [ t.message.content for t in res.choices ]
+        return [ t.message.content for t in res.choices ], add_usage( res )
 
-    return None
+    return None, None
 
 
-def complete_llava( model, processor, prompt, image ):
+def hedge_delay():
     """
-    Feed a prompt to a Llava model and get the list of completions returned.
+    Return the latency after which a request is hedged: the cnfg.hedge percentile of the recent latencies,
+    or None if there are not enough latencies yet
+
+    return:         [float] seconds, or None
+    """
+    with stats_lock:
+        latencies   = sorted( hedge_stats[ "latencies" ] )
+    if len( latencies ) < hedge_min_samples:
+        return None
+    return latencies[ int( cnfg.hedge * ( len( latencies ) - 1 ) ) ]
+
+
+def hedge_request( func, *args ):
+    """
+    Call a function sending a request, issuing a duplicate request if the first is slower than hedge_delay().
+    The first response wins, the other is cancelled if still waiting, otherwise its result is discarded.
+    The latency saved is measured when the slower original request completes.
+
+    params:
+        func        [function] sending the request, like request_openai
+        args        the arguments of func
+
+    return:         the result of the fastest request
+    """
+    global hedge_pool
+
+    with stats_lock:
+        if hedge_pool is None:
+            hedge_pool  = ThreadPoolExecutor( max_workers=hedge_workers )
+        hedge_stats[ "requests" ]   += 1
+
+    t_start     = time.perf_counter()
+    first       = hedge_pool.submit( func, *args )
+    done, _     = wait( [ first ], timeout=hedge_delay() )
+
+    if done:
+        with stats_lock:
+            hedge_stats[ "latencies" ].append( time.perf_counter() - t_start )
+        return first.result()
+
+    second      = hedge_pool.submit( func, *args )
+    for winner in as_completed( [ first, second ] ):
+        if winner.exception() is None:
+            break
+    t_win       = time.perf_counter() - t_start
+    with stats_lock:
+        hedge_stats[ "hedged" ]     += 1
+        hedge_stats[ "latencies" ].append( t_win )
+        if winner is second:
+            hedge_stats[ "won" ]        += 1
+
+    if winner is second:
+        if not first.cancel():
+            def saved( f ):
+                with stats_lock:
+                    hedge_stats[ "saved" ]  += time.perf_counter() - t_start - t_win
+            first.add_done_callback( saved )
+    else:
+        second.cancel()
+
+    return winner.result()
+
+
+def complete_openai( prompt, usage=None ):
+    """
+    Feed a prompt to an OpenAI model and get the list of completions returned.
+    This function works for both completion-mode models and chat-mode models,
+    and for models on local servers with OpenAI-compatible API.
+    If cnfg.hedge is set, slow requests are hedged with a duplicate request.
+
+    params:
+        prompt      [str] or [list] the prompt for completion-mode models,
+                    or the messages for chat-mode models
+        usage       [dict] where the prompt and completion tokens of the request are added, or None
+
+    return:         [list] with completions [str]
+    """
+    global client
+#   if cnfg.DEBUG:  return [ "test_only" ]
+
+    if client is None:              # check if openai has already a client, otherwise set it
+        client  = set_local() if cnfg.interface == "local" else set_openai()
+
+    if cnfg.hedge is not None:
+        completion, used    = hedge_request( request_openai, prompt )
+    else:
+        completion, used    = request_openai( prompt )
+    if usage is not None and used is not None:
+        for k in used:
+            usage[ k ]  += used[ k ]
+    return completion
+
+
+def inputs_llava( model, processor, prompt, image ):
+    """
+    Process a prompt for a Llava model.
 
         NOTE: currently there is a bug in llava-next when doing inference without an image:
         https://huggingface.co/llava-hf/llava-v1.6-mistral-7b-hf/discussions/36
         As a temporary workaround, if no image is requested, a blank image of the same size is loaded.
 
     params:
-        prompt      [str] or [list] the prompt for completion-mode models,
-                    or the messages for chat-mode models
+        model       [transformers.models...] client model
+        processor   [transformers.models...] client input processor
+        prompt      [list] the messages for chat-mode models
         image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
 
-    return:         [list] with completions [str]
+    return:         [transformers.BatchFeature] the model inputs
     """
     text        = processor.apply_chat_template( prompt, add_generation_prompt=True )
 
     # dummy image as workaround for llava-next bug (see comment above)
     if image is None:
+        from    PIL         import Image
         image   = Image.new( mode='L', size=native_res, color="black" )
     else:
         image   = image.resize( native_res )
@@ -213,38 +613,20 @@ def complete_llava( model, processor, prompt, image ):
     ).to( model.device, torch.float16 )
 
     model.generation_config.pad_token_id = model.generation_config.eos_token_id
-
-    out         = model.generate(
-            **inputs,
-            max_new_tokens          = cnfg.max_tokens,
-            do_sample               = True,                     # NOTE: the default is greedy!
-            num_return_sequences    = cnfg.n_returns,
-            top_p                   = cnfg.top_p,
-            temperature             = cnfg.temperature,
-    )
-    res         = processor.batch_decode( out, skip_special_tokens=True )
-
-    # NOTE that the prompt is included in the completion, there is no parameter like return_full_text in pipeline
-    # that can avoid this issue in model.generate. Therefore, here are workarounds that are model dependent.
-    # CHECK when new models are added
-    end_input   = "[/INST]"
-    completions = [ r.split( end_input )[ -1 ].strip() for r in res ]
-
-    return completions
+    return inputs
 
 
-def complete_chameleon( model, processor, prompt, image ):
+def inputs_chameleon( model, processor, prompt, image ):
     """
-    Feed a prompt to a Chameleon model and get the list of completions returned.
+    Process a prompt for a Chameleon model.
 
     params:
-        prompt      [str] or [list] the prompt for completion-mode models,
-                    or the messages for chat-mode models
-        image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
         model       [transformers.models...] client model
-        processor   transformers.models...] client input processor
+        processor   [transformers.models...] client input processor
+        prompt      [str] the prompt for completion-mode models
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
 
-    return:         [list] with completions [str]
+    return:         [transformers.BatchFeature] the model inputs
     """
     if image is None:
         text        = prompt
@@ -257,34 +639,20 @@ def complete_chameleon( model, processor, prompt, image ):
             text            = text,
             return_tensors  = "pt"
     ).to( model.device, torch.float16 )
+    return inputs
 
-    out         = model.generate(
-            **inputs,
-            max_new_tokens          = cnfg.max_tokens,
-            do_sample               = True,                     # NOTE: the default is greedy!
-            num_return_sequences    = cnfg.n_returns,
-            top_p                   = cnfg.top_p,
-            temperature             = cnfg.temperature,
-    )
-    res         = processor.batch_decode( out, skip_special_tokens=True )
-
-    # NOTE that the prompt is included in the completion, there is no parameter like return_full_text in pipeline
-    # that can avoid this issue in model.generate. Therefore, here are workarounds that are model dependent.
-    # CHECK when new models are added
-    completions = [ r.replace( prompt, "" ) for r in res ]
-
-    return completions
 
-
-def complete_qwen( model, processor, prompt, image ):
+def inputs_qwen( model, processor, prompt, image ):
     """
-    Feed a prompt to a Qwen model and get the list of completions returned.
+    Process a prompt for a Qwen model.
 
     params:
-        prompt      [str] or [list] the prompt for completion-mode models,
-                    or the messages for chat-mode models
+        model       [transformers.models...] client model
+        processor   [transformers.models...] client input processor
+        prompt      [list] the messages for chat-mode models
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
 
-    return:         [list] with completions [str]
+    return:         [transformers.BatchFeature] the model inputs
     """
     if image is not None:
         image   = image.resize( native_res )
@@ -299,24 +667,85 @@ def complete_qwen( model, processor, prompt, image ):
             padding         = True,
             return_tensors  = "pt"
     ).to( model.device, torch.float16 )
+    return inputs
 
-    out         = model.generate(
-            **inputs,
-            max_new_tokens          = cnfg.max_tokens,
-            do_sample               = True,                     # NOTE: the default is greedy!
-            num_return_sequences    = 1,                        # NOTE: more than 1 produces garbage!
-            top_p                   = cnfg.top_p,
-            temperature             = cnfg.temperature,
-    )
-    res         = processor.batch_decode( out, skip_special_tokens=True )
 
-    # NOTE that the prompt is included in the completion, there is no parameter like return_full_text in pipeline
-    # that can avoid this issue in model.generate. Therefore, here are workarounds that are model dependent.
-    # CHECK when new models are added
-    end_input   = "\nassistant\n"
-    completions = [ r.split( end_input )[ -1 ].strip() for r in res ]
+def hf_inputs( model, processor, prompt, image ):
+    """
+    Process a prompt for the current HuggingFace model.
 
-    return completions
+    params:
+        model       [transformers.models...] client model
+        processor   [transformers.models...] client input processor
+        prompt      [str] or [list] the prompt for completion-mode models,
+                    or the messages for chat-mode models
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
+
+    return:         [transformers.BatchFeature] the model inputs
+    """
+    if "llava-v1.6" in cnfg.model:
+        return inputs_llava( model, processor, prompt, image )
+    if "chameleon" in cnfg.model:
+        return inputs_chameleon( model, processor, prompt, image )
+    if "Qwen" in cnfg.model:
+        return inputs_qwen( model, processor, prompt, image )
+    return None
+
+
+def complete_llava( model, processor, prompt, image ):
+    """
+    Feed a prompt to a Llava model and get the list of completions returned.
+
+    params:
+        prompt      [str] or [list] the prompt for completion-mode models,
+                    or the messages for chat-mode models
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
+
+    return:         [list] with completions [str]
+    """
+    inputs      = inputs_llava( model, processor, prompt, image )
+    out         = generate( model, inputs, cnfg.n_returns )
+    return decode_new( processor, out, inputs[ "input_ids" ].shape[ 1 ] )
+
+
+def complete_chameleon( model, processor, prompt, image ):
+    """
+    Feed a prompt to a Chameleon model and get the list of completions returned.
+
+    params:
+        prompt      [str] or [list] the prompt for completion-mode models,
+                    or the messages for chat-mode models
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
+        model       [transformers.models...] client model
+        processor   transformers.models...] client input processor
+
+    return:         [list] with completions [str]
+    """
+    inputs      = inputs_chameleon( model, processor, prompt, image )
+    out         = generate( model, inputs, cnfg.n_returns )
+    return decode_new( processor, out, inputs[ "input_ids" ].shape[ 1 ] )
+
+
+def complete_qwen( model, processor, prompt, image, draft=None ):
+    """
+    Feed a prompt to a Qwen model and get the list of completions returned.
+    The cnfg.n_returns samples are generated at once, replicating the prompt along the batch dimension.
+    If a draft model is given, use assisted generation: the draft model proposes a few tokens at a time,
+    the main model verifies them in a single forward pass.
+        NOTE: assisted generation supports one sequence only, do_complete calls this function once per sample
+
+    params:
+        prompt      [str] or [list] the prompt for completion-mode models,
+                    or the messages for chat-mode models
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
+        draft       [transformers.models...] smaller model sharing the tokenizer, or None
+
+    return:         [list] with completions [str]
+    """
+    inputs      = inputs_qwen( model, processor, prompt, image )
+    inputs      = replicate( inputs, cnfg.n_returns )
+    out         = generate( model, inputs, 1, assistant=draft )
+    return decode_new( processor, out, inputs[ "input_ids" ].shape[ 1 ] )
 
 
 def complete_hf( prompt, image ):
@@ -344,14 +773,14 @@ def complete_hf( prompt, image ):
     if "chameleon" in cnfg.model:
         return complete_chameleon( model, processor, prompt, image )
     if "Qwen" in cnfg.model:
-        return complete_qwen( model, processor, prompt, image )
+        return complete_qwen( model, processor, prompt, image, draft=client[ "draft" ] )
 #       return complete_qwen_base64( model, processor, prompt )
 
     print( f"WARNING: model '{cnfg.model}' not currently supported.")
     return None
 
 
-def do_complete( prompt, image=None ):
+def do_complete( prompt, image=None, usage=None ):
     """
     Feed a prompt to any model and get the list of completions returned.
 
@@ -360,17 +789,18 @@ def do_complete( prompt, image=None ):
                     or the messages for chat completion models
         image       [PIL.JpegImagePlugin.JpegImageFile] or None, for OpenAI and Qwen
                     the image is embedded in the propmt
+        usage       [dict] where the tokens used by OpenAI requests are added, or None
 
     return:         [list] with completions [str]
     """
     match cnfg.interface:
 
-        case 'openai':
-            return complete_openai( prompt )
+        case 'openai' | 'local':
+            return complete_openai( prompt, usage=usage )
 
         case 'hf':
             if "Qwen" in cnfg.model:
-                n_max   = qwen2_vl_n_max
+                n_max   = qwen2_vl_n_max if cnfg.draft is None else 1
             else:
                 n_max   = llava_next_n_max
             if cnfg.n_returns <= n_max:
@@ -392,3 +822,585 @@ def do_complete( prompt, image=None ):
         case _:
             print( f"WARNING: model interface '{cnfg.interface}' not supported" )
             return None
+
+
+def run_stats():
+    """
+    Return the statistics on the completions of the execution, to write in the log
+
+    return:         [list] of [str] lines
+    """
+    global hedge_pool
+    lines       = []
+
+    if hedge_pool is not None:      # wait for the discarded requests, to measure the latency saved
+        hedge_pool.shutdown( wait=True )
+        hedge_pool  = None
+
+    if cnfg.hedge is not None:
+        n_req       = hedge_stats[ "requests" ]
+        n_hedged    = hedge_stats[ "hedged" ]
+        rate        = n_hedged / n_req if n_req else 0.
+        lines.append( f"hedged requests          {n_hedged} of {n_req} ({rate:.3f})" )
+        lines.append( f"hedges faster            {hedge_stats[ 'won' ]}" )
+        lines.append( f"hedge latency saved      {hedge_stats[ 'saved' ]:.1f} s" )
+
+    if load_seconds is not None:
+        source      = "local cache" if local_only else "hub"
+        lines.append( f"model load time          {load_seconds:.1f} s from {source}" )
+
+    if usage_stats[ "requests" ]:
+        lines.append( f"tokens used              {usage_stats[ 'prompt' ]} prompt, "
+                      f"{usage_stats[ 'completion' ]} completion, in {usage_stats[ 'requests' ]} requests" )
+
+    if batch_stats is not None:
+        lines.append( f"batching throughput      {batch_stats[ 'tokens/s' ]:.2f} tok/s  "
+                      f"{batch_stats[ 'sequences/s' ]:.3f} seq/s  {batch_stats[ 'requests/s' ]:.3f} req/s" )
+
+    return lines
+
+
+# ===================================================================================================================
+#
+#   Multi-turn conversations with HuggingFace models, keeping the KV cache between turns
+#   - turn_ids
+#   - generated_mask
+#   - first_turn_hf
+#   - next_turn_hf
+#
+# ===================================================================================================================
+
+def turn_ids( processor, text ):
+    """
+    Return the token ids of a follow-up user message, as formatted by the chat template: the closing of the
+    previous assistant turn, the user message and the opening of the next assistant turn.
+    The end-of-sequence token closing the assistant turn is left out, since it is generated by the model.
+
+    params:
+        processor   [transformers.models...] client input processor
+        text        [str] the user message
+
+    return:         [torch.Tensor] the token ids, 1 dimension
+    """
+    marker      = "\x01"                        # placeholder of the assistant reply
+    messages    = [
+        { "role": "user",       "content": [ { "type": "text", "text": "-" } ] },
+        { "role": "assistant",  "content": [ { "type": "text", "text": marker } ] },
+        { "role": "user",       "content": [ { "type": "text", "text": text } ] },
+    ]
+    full        = processor.apply_chat_template( messages, add_generation_prompt=True )
+    tail        = full[ full.index( marker ) + len( marker ) : ]
+    eos         = processor.tokenizer.eos_token
+    if tail.startswith( eos ):
+        tail        = tail[ len( eos ) : ]
+
+    return processor.tokenizer( tail, add_special_tokens=False, return_tensors="pt" )[ "input_ids" ][ 0 ]
+
+
+def generated_mask( model, ids, length ):
+    """
+    Return the attention mask of the generated tokens: the padding after the end-of-sequence of the rows
+    ended earlier is masked. Also return which rows ended with the end-of-sequence token
+
+    params:
+        model       [transformers.models...] client model
+        ids         [torch.Tensor] token ids returned by generate, prompt included
+        length      [int] length of the input ids passed to generate
+
+    return:         [torch.Tensor] the mask of the generated tokens
+                    [torch.Tensor] of booleans, True for the rows ended with end-of-sequence
+    """
+    eos         = model.generation_config.eos_token_id
+    eos         = torch.tensor( eos if isinstance( eos, list ) else [ eos ], device=ids.device )
+    is_eos      = torch.isin( ids[ :, length : ], eos ).long()
+    after       = ( is_eos.cumsum( dim=1 ) - is_eos ) > 0           # tokens after the first end-of-sequence
+    return ( ~after ).long(), is_eos.bool().any( dim=1 )
+
+
+def first_turn_hf( prompt, image ):
+    """
+    Generate the cnfg.n_returns replies to the first turn of a conversation, keeping the KV cache.
+        NOTE: the static cache and assisted generation are not used in conversations
+
+    params:
+        prompt      [list] the messages of the first turn
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
+
+    return:         [list] with completions [str]
+                    [dict] the state of the conversation, to pass to next_turn_hf
+    """
+    global client
+    if client is None:
+        client  = set_hf()
+
+    model       = client[ "model" ]
+    processor   = client[ "processor" ]
+    inputs      = hf_inputs( model, processor, prompt, image )
+    length      = inputs[ "input_ids" ].shape[ 1 ]
+    n_returns   = cnfg.n_returns
+    state       = { "rope_deltas": None, "prefilled": length, "reused": 0 }
+
+    if "Qwen" in cnfg.model:
+        # samples as replicas in the batch, the offsets of the multimodal positions are kept for the next turns
+        inputs      = replicate( inputs, n_returns )
+        n_returns   = 1
+        _, state[ "rope_deltas" ]   = model.get_rope_index(
+                inputs[ "input_ids" ], inputs.get( "image_grid_thw" ), None, inputs[ "attention_mask" ] )
+
+    out         = generate( model, inputs, n_returns, return_dict_in_generate=True )
+    mask, ended = generated_mask( model, out.sequences, length )
+    prompt_mask = inputs[ "attention_mask" ].repeat_interleave( n_returns, dim=0 )
+
+    state[ "ids" ]      = out.sequences
+    state[ "mask" ]     = torch.cat( [ prompt_mask, mask ], dim=1 )
+    state[ "ended" ]    = ended
+    state[ "cache" ]    = out.past_key_values
+    return decode_new( processor, out.sequences, length ), state
+
+
+def next_turn_hf( state, text ):
+    """
+    Generate the replies to a follow-up user message, one for each sample of the conversation.
+    Only the new tokens are prefilled, the history is in the KV cache of the state.
+    The rows that did not end with end-of-sequence (truncated by max_tokens) are closed with it,
+    in the other rows the same position is masked.
+
+    params:
+        state       [dict] the state of the conversation, updated in place
+        text        [str] the user message
+
+    return:         [list] with completions [str], one for each sample
+    """
+    model       = client[ "model" ]
+    processor   = client[ "processor" ]
+    ids         = state[ "ids" ]
+    batch       = ids.shape[ 0 ]
+
+    eos         = model.generation_config.eos_token_id
+    eos         = eos[ 0 ] if isinstance( eos, list ) else eos
+    close       = torch.full( ( batch, 1 ), eos, dtype=ids.dtype, device=ids.device )
+    close_mask  = ( ~state[ "ended" ] ).long()[ :, None ]
+    new         = turn_ids( processor, text ).to( ids.device ).repeat( batch, 1 )
+
+    inputs      = {
+        "input_ids":        torch.cat( [ ids, close, new ], dim=1 ),
+        "attention_mask":   torch.cat( [ state[ "mask" ], close_mask, torch.ones_like( new ) ], dim=1 ),
+    }
+    length      = inputs[ "input_ids" ].shape[ 1 ]
+    cached      = state[ "cache" ].get_seq_length()
+    extra       = { "past_key_values": state[ "cache" ], "return_dict_in_generate": True }
+    if state[ "rope_deltas" ] is not None:
+        extra[ "rope_deltas" ]  = state[ "rope_deltas" ]
+        model.rope_deltas       = state[ "rope_deltas" ]        # NOTE newer transformers keep it in the model
+
+    out         = generate( model, inputs, 1, **extra )
+    mask, ended = generated_mask( model, out.sequences, length )
+
+    state[ "prefilled" ]    += length - cached
+    state[ "reused" ]       += cached
+    state[ "ids" ]          = out.sequences
+    state[ "mask" ]         = torch.cat( [ inputs[ "attention_mask" ], mask ], dim=1 )
+    state[ "ended" ]        = ended
+    state[ "cache" ]        = out.past_key_values
+    return decode_new( processor, out.sequences, length )
+
+
+# ===================================================================================================================
+#
+#   Continuous batching of HuggingFace generation
+#   - Scheduler
+#   - legacy_cache
+#   - batch_cache
+#   - logits_warpers
+#   - do_complete_batch
+#
+# ===================================================================================================================
+
+class Scheduler( object ):
+    """
+    Iteration-level scheduler for HuggingFace generation (continuous batching).
+    A fixed number of decode slots is kept busy: as soon as a sequence ends, a waiting sequence is admitted,
+    instead of waiting for the longest sequence of a static batch, as with model.generate.
+
+    The KV cache of all the slots is preallocated (see batch_cache), the running sequences occupy its first rows
+    and each decoding step writes the new keys and values in place, at the position of each sequence.
+    Each prompt is prefilled once, and its cache is copied in the row of each of its samples when admitted.
+    The logits are processed as in model.generate (see logits_warpers), with the repetition penalty of the
+    generation config of the model.
+        NOTE: this path does not use the static cache, the compiled decoder or assisted generation
+    """
+
+    def __init__( self, model, processor, n_slots ):
+        """
+        params:
+            model       [transformers.models...] client model
+            processor   [transformers.models...] client input processor
+            n_slots     [int] maximum number of sequences decoded together
+        """
+        self.model      = model
+        self.processor  = processor
+        self.decoder    = model.language_model if hasattr( model, "language_model" ) else model
+        self.n_slots    = n_slots
+        self.mrope      = "Qwen2-VL" in cnfg.model          # Qwen2-VL uses 3D rotary positions
+        eos             = model.generation_config.eos_token_id
+        self.eos        = set( eos if isinstance( eos, list ) else [ eos ] )
+        self.penalty    = model.generation_config.repetition_penalty
+        self.warpers    = logits_warpers( model )
+
+        self.prompts    = dict()        # inputs of prompts, replaced by their prefix cache after prefill
+        self.pending    = []            # sequences waiting for a slot, as ( request, sample )
+        self.running    = []            # sequences being decoded, in the order of the rows of the cache
+        self.outputs    = []            # generated tokens of each sample of each request
+        self.cache      = None          # KV cache of the slots, allocated at the first prefill
+        self.seen       = None          # tokens in each sequence, for the repetition penalty
+
+        self.n_tokens   = 0             # generated tokens
+        self.n_seqs     = 0             # completed sequences
+        self.elapsed    = 0.            # seconds spent in run()
+
+
+    def add( self, prompt, image, n ):
+        """
+        Queue a prompt, with the number of samples to generate
+
+        params:
+            prompt      [str] or [list] the prompt for completion-mode models,
+                        or the messages for chat-mode models
+            image       [PIL.JpegImagePlugin.JpegImageFile] or None in case of no image
+            n           [int] number of samples
+
+        return:         [int] id of the request
+        """
+        req                 = len( self.outputs )
+        inputs              = hf_inputs( self.model, self.processor, prompt, image )
+        self.prompts[ req ] = { "inputs": inputs, "left": n }
+        self.outputs.append( n * [ None ] )
+        self.pending        += [ ( req, i ) for i in range( n ) ]
+        return req
+
+
+    def prefill( self, req ):
+        """
+        Run the prompt of a request through the model, keeping its KV cache and the logits of the next token
+
+        params:
+            req         [int] id of the request
+        """
+        p           = self.prompts[ req ]
+        inputs      = p.pop( "inputs" )
+        length      = inputs[ "input_ids" ].shape[ 1 ]
+        position    = torch.arange( length, device=self.model.device )
+        out         = self.model( **inputs, use_cache=True, cache_position=position )
+
+        p[ "cache" ]    = legacy_cache( out.past_key_values )
+        p[ "logits" ]   = out.logits[ :, -1 ]
+        p[ "ids" ]      = inputs[ "input_ids" ][ 0 ]
+        p[ "length" ]   = p[ "cache" ][ 0 ][ 0 ].shape[ 2 ]
+        p[ "position" ] = length
+        if self.mrope:              # the positions of the image patches are compressed
+            p[ "position" ] += int( self.model.rope_deltas[ 0, 0 ] )
+
+        # the cache of the slots holds the longest prompt and its new tokens
+        needed      = p[ "length" ] + cnfg.max_tokens
+        if self.cache is None or self.cache.capacity < needed:
+            self.cache  = batch_cache( p[ "cache" ], self.n_slots, needed, self.cache )
+        if self.seen is None and self.penalty not in ( None, 1.0 ):
+            self.seen   = torch.zeros( ( self.n_slots, p[ "logits" ].shape[ -1 ] ), dtype=torch.bool,
+                                       device=self.model.device )
+
+
+    def sample( self, logits, rows ):
+        """
+        Sample the next tokens, processing the logits as model.generate
+
+        params:
+            logits      [torch.Tensor] of shape ( batch, vocabulary )
+            rows        [torch.Tensor] rows of the sequences in the cache
+
+        return:         [list] of token ids
+        """
+        scores          = logits.float()
+        if self.seen is not None:
+            # as transformers.RepetitionPenaltyLogitsProcessor, over the prompt and the tokens generated
+            penalized       = torch.where( scores < 0, scores * self.penalty, scores / self.penalty )
+            scores          = torch.where( self.seen[ rows ], penalized, scores )
+        scores          = self.warpers( None, scores )
+        probs           = torch.softmax( scores, dim=-1 )
+        tokens          = torch.multinomial( probs, 1 ).squeeze( -1 )
+        if self.seen is not None:
+            self.seen[ rows, tokens ]   = True
+        return tokens.tolist()
+
+
+    def finish( self, seq ):
+        """
+        Store the tokens of a sequence, if completed
+
+        params:
+            seq         [dict] the state of the sequence
+
+        return:         [bool] True if the sequence is completed
+        """
+        tokens      = seq[ "tokens" ]
+        if tokens[ -1 ] not in self.eos and len( tokens ) < cnfg.max_tokens:
+            return False
+
+        self.outputs[ seq[ "req" ] ][ seq[ "sample" ] ] = tokens
+        self.n_tokens   += len( tokens )
+        self.n_seqs     += 1
+        return True
+
+
+    def admit( self ):
+        """
+        Fill the free slots with waiting sequences, prefilling their prompts if necessary.
+        The prefix cache of the prompt is copied in the first free row of the cache
+        """
+        while len( self.running ) < self.n_slots and len( self.pending ):
+            req, i      = self.pending.pop( 0 )
+            p           = self.prompts[ req ]
+            if "cache" not in p:
+                self.prefill( req )
+            row         = len( self.running )
+            self.cache.load( row, p[ "cache" ] )
+            if self.seen is not None:
+                self.seen[ row ]                = False
+                self.seen[ row, p[ "ids" ] ]    = True
+            seq         = {
+                "req":          req,
+                "sample":       i,
+                "length":       p[ "length" ],
+                "position":     p[ "position" ],
+                "tokens":       self.sample( p[ "logits" ], torch.tensor( [ row ], device=self.model.device ) ),
+            }
+            p[ "left" ] -= 1
+            if not p[ "left" ]:
+                del self.prompts[ req ]                     # release the prefix cache
+            if not self.finish( seq ):
+                self.running.append( seq )
+
+
+    def release( self, ended ):
+        """
+        Release the rows of the completed sequences, moving the last running sequences in their place,
+        so that the running sequences keep occupying the first rows of the cache
+
+        params:
+            ended       [list] of [int] rows of the completed sequences
+        """
+        for b in sorted( ended, reverse=True ):
+            last        = len( self.running ) - 1
+            if b != last:
+                self.cache.move( last, b, self.running[ last ][ "length" ] )
+                if self.seen is not None:
+                    self.seen[ b ]  = self.seen[ last ]
+                self.running[ b ]   = self.running[ last ]
+            self.running.pop()
+
+
+    def step( self ):
+        """
+        Decode one token for all running sequences, and release the slots of completed sequences
+        """
+        seqs        = self.running
+        device      = self.model.device
+        lengths     = torch.tensor( [ s[ "length" ] for s in seqs ], device=device )
+        width       = int( lengths.max() ) + 1
+
+        # each sequence attends its cache and the new token, written at its own length
+        mask        = ( torch.arange( width, device=device )[ None, : ] <= lengths[ :, None ] ).long()
+        ids         = torch.tensor( [ [ s[ "tokens" ][ -1 ] ] for s in seqs ], device=device )
+        position    = torch.tensor( [ [ s[ "position" ] ] for s in seqs ], device=device )
+        if self.mrope:
+            position    = position.unsqueeze( 0 ).expand( 3, -1, -1 )
+
+        self.cache.lengths  = lengths
+        self.cache.width    = width
+        out         = self.decoder(
+                input_ids       = ids,
+                attention_mask  = mask,
+                position_ids    = position,
+                past_key_values = self.cache,
+                cache_position  = torch.tensor( [ width - 1 ], device=device ),
+                use_cache       = True
+        )
+        tokens      = self.sample( out.logits[ :, -1 ], torch.arange( len( seqs ), device=device ) )
+
+        ended       = []
+        for b, s in enumerate( seqs ):
+            s[ "length" ]   += 1
+            s[ "position" ] += 1
+            s[ "tokens" ].append( tokens[ b ] )
+            if self.finish( s ):
+                ended.append( b )
+        self.release( ended )
+
+
+    def run( self ):
+        """
+        Generate all the queued sequences
+
+        return:         [list] with the list of completions [str] of each request, in order of request
+        """
+        t_start     = time.perf_counter()
+        with torch.no_grad():
+            while len( self.pending ) or len( self.running ):
+                self.admit()
+                if len( self.running ):
+                    self.step()
+        self.elapsed    += time.perf_counter() - t_start
+        self.cache      = None                              # release the memory of the slots
+
+        completions = []
+        for tokens in self.outputs:
+            res         = self.processor.batch_decode( tokens, skip_special_tokens=True )
+            completions.append( [ r.strip() for r in res ] )
+        return completions
+
+
+    def stats( self ):
+        """
+        Return the throughput of the scheduler
+
+        return:         [dict] with generated tokens, completed sequences and requests, seconds and rates
+        """
+        elapsed     = max( self.elapsed, 1e-9 )
+        return {
+            "tokens":       self.n_tokens,
+            "sequences":    self.n_seqs,
+            "requests":     len( self.outputs ),
+            "seconds":      self.elapsed,
+            "tokens/s":     self.n_tokens / elapsed,
+            "sequences/s":  self.n_seqs / elapsed,
+            "requests/s":   len( self.outputs ) / elapsed,
+        }
+
+
+def legacy_cache( cache ):
+    """
+    Return the KV cache as tuple of ( keys, values ) for each layer
+
+    params:
+        cache       [transformers.Cache] or [tuple]
+
+    return:         [tuple]
+    """
+    return cache.to_legacy_cache() if hasattr( cache, "to_legacy_cache" ) else cache
+
+
+def batch_cache( prefix, n_slots, capacity, old=None ):
+    """
+    Return the KV cache of the decode slots of Scheduler, preallocated for capacity positions in each slot.
+    Unlike the caches of transformers, where all the sequences of a batch are written at the same position,
+    each row is written in place at its own length, so that sequences of different lengths are decoded together
+    without padding and concatenating their caches at each step
+
+    params:
+        prefix      [tuple] a cache as returned by legacy_cache, giving the shape of the layers
+        n_slots     [int] number of rows
+        capacity    [int] positions in each row
+        old         [BatchCache] cache to copy in the new one, when its capacity is not enough, or None
+
+    return:         [BatchCache]
+    """
+    from    transformers    import Cache
+
+    class BatchCache( Cache ):
+
+        def __init__( self ):
+            super().__init__()
+            _, heads, _, dim    = prefix[ 0 ][ 0 ].shape
+            k                   = prefix[ 0 ][ 0 ]
+            shape               = ( n_slots, heads, capacity, dim )
+            self.capacity       = capacity
+            self.keys           = [ k.new_zeros( shape ) for _ in prefix ]
+            self.values         = [ k.new_zeros( shape ) for _ in prefix ]
+            self.lengths        = None      # [torch.Tensor] length of each running row, set at each step
+            self.width          = 0         # positions returned to the attention, set at each step
+
+        def update( self, key_states, value_states, layer_idx, cache_kwargs=None ):
+            n                   = key_states.shape[ 0 ]
+            rows                = torch.arange( n, device=key_states.device )
+            self.keys[ layer_idx ][ rows, :, self.lengths ]     = key_states[ :, :, 0 ]
+            self.values[ layer_idx ][ rows, :, self.lengths ]   = value_states[ :, :, 0 ]
+            return self.keys[ layer_idx ][ :n, :, : self.width ], self.values[ layer_idx ][ :n, :, : self.width ]
+
+        def get_seq_length( self, layer_idx=0 ):
+            return self.width - 1
+
+        def get_max_length( self ):
+            return None
+
+        def get_max_cache_shape( self ):
+            return None
+
+        def load( self, row, cache ):
+            for layer, ( k, v ) in enumerate( cache ):
+                self.keys[ layer ][ row, :, : k.shape[ 2 ] ]    = k[ 0 ]
+                self.values[ layer ][ row, :, : v.shape[ 2 ] ]  = v[ 0 ]
+
+        def move( self, src, dst, length ):
+            for k, v in zip( self.keys, self.values ):
+                k[ dst, :, : length ]   = k[ src, :, : length ]
+                v[ dst, :, : length ]   = v[ src, :, : length ]
+
+    cache       = BatchCache()
+    if old is not None:
+        for k, v, ok, ov in zip( cache.keys, cache.values, old.keys, old.values ):
+            k[ :, :, : old.capacity ]   = ok
+            v[ :, :, : old.capacity ]   = ov
+    return cache
+
+
+def logits_warpers( model ):
+    """
+    Return the warpers of the logits applied by model.generate when sampling: the temperature and top_p of cnfg,
+    and the top_k and min_p of the generation config of the model
+
+    params:
+        model       [transformers.models...] client model
+
+    return:         [transformers.LogitsProcessorList]
+    """
+    from    transformers    import LogitsProcessorList, TemperatureLogitsWarper, TopKLogitsWarper, \
+                                   TopPLogitsWarper, MinPLogitsWarper
+
+    config      = model.generation_config
+    warpers     = LogitsProcessorList()
+    if cnfg.temperature != 1.0:
+        warpers.append( TemperatureLogitsWarper( cnfg.temperature ) )
+    if config.top_k is not None and config.top_k != 0:
+        warpers.append( TopKLogitsWarper( config.top_k ) )
+    if cnfg.top_p < 1.0:
+        warpers.append( TopPLogitsWarper( cnfg.top_p ) )
+    if getattr( config, "min_p", None ) is not None:
+        warpers.append( MinPLogitsWarper( config.min_p ) )
+    return warpers
+
+
+def do_complete_batch( prompts, images ):
+    """
+    Feed many prompts to a HuggingFace model with continuous batching, using cnfg.cb_slots decode slots,
+    and get the lists of completions returned. The throughput is kept in batch_stats.
+
+    params:
+        prompts     [list] of prompts, as in do_complete
+        images      [list] of [PIL.JpegImagePlugin.JpegImageFile] or None, one for each prompt
+
+    return:         [list] with the list of completions [str] of each prompt
+    """
+    global client, batch_stats
+
+    if client is None:              # check if hf has already a client, otherwise set it
+        client  = set_hf()
+
+    scheduler   = Scheduler( client[ "model" ], client[ "processor" ], cnfg.cb_slots )
+    for pr, image in zip( prompts, images ):
+        scheduler.add( pr, image, cnfg.n_returns )
+    completions = scheduler.run()
+    batch_stats = scheduler.stats()
+
+    if cnfg.VERBOSE:
+        print( f"continuous batching: {batch_stats[ 'tokens/s' ]:.2f} tok/s, "
+               f"{batch_stats[ 'sequences/s' ]:.3f} seq/s, {batch_stats[ 'requests/s' ]:.3f} req/s" )
+    return completions
@@ -6,31 +6,19 @@
 #####################################################################################################################
 """
 
+import  re
 import  sys
-import  numpy           as np
+from    concurrent.futures      import ThreadPoolExecutor
 
 import  prompt          as prmpt                # this module composes the prompts
 import  complete        as cmplt                # this module performs LLM completions
+import  workers                                 # this module runs HF inference on a pool of processes
+import  pipeline                                # this module processes the news in a pipeline of stages
+import  save_res                                # this module saves results
 
 cnfg                    = None                  # parameter obj assigned by main_exec.py
 
-# ===================================================================================================================
-#
-#   - check_reply
-#   - ask_news
-#
-# ===================================================================================================================
-
-def check_reply( completion ):
-    """
-    Check the model answers in response to yes/no questions.
-
-    params:
-        completion  [list] of completion text
-
-    return:         three [np.array] of booleans for yes/no/unk replies
-    """
-    no_patterns = [
+no_patterns             = (                     # patterns of negative replies
         "<decision>no",
         "would recommend not reposting",
         "would recommend not sharing",
@@ -48,8 +36,8 @@ def check_reply( completion ):
         "i do not want to share",
         "i would not want to repost",
         "i would not want to share",
-    ]
-    yes_patterns    = [
+)
+yes_patterns            = (                     # patterns of positive replies
         "<decision>yes",
         "i want to repost",
         "i want to share",
@@ -65,138 +53,695 @@ def check_reply( completion ):
         "i would like to share",
         "i might consider sharing it",
         "it would be reasonable to share",
+)
+reply_codes             = {                     # codes of the classified replies
+        "yes":              0,
+        "no":               1,
+        "unk":              2,
+        "contradicting":    3,                  # both positive and negative patterns, counted as yes and unk
+}
+sep                     = "\x00"                # separator of the completions matched together
+regex                   = None                  # the compiled regex of all patterns, see reply_regex()
+reply_warnings          = {                     # replies not clearly classified
+        "unclear":          0,
+        "contradicting":    0,
+}
+turn_stats              = []                    # replies and tokens of each turn of the conversations
+adaptive_z              = 1.96                  # normal quantile of the confidence interval of adaptive sampling
+adaptive_samples        = []                    # number of completions of each news, with adaptive sampling
+reused_samples          = 0                     # completions taken from the stream or the baseline, not generated
+
+# ===================================================================================================================
+#
+#   - reply_regex
+#   - classify_replies
+#   - check_reply
+#   - reply_stats
+#   - wilson_width
+#   - prompt_interface
+#   - build_prompt
+#   - infer_one
+#   - complete_one
+#   - ask_one
+#   - load_one
+#   - infer_loaded
+#   - post_one
+#   - record_one
+#   - Conversation
+#   - converse_one
+#   - sample_one
+#   - ask_all
+#   - ask_modalities
+#   - ask_news
+#   - ask_both
+#
+# ===================================================================================================================
+
+def reply_regex():
+    """
+    Compile all the yes/no patterns into a single regex, matched over all the completions of a batch joined
+    by a separator. Each alternative is a named group, inside a lookahead so that all positions are tested,
+    also when patterns overlap. Replies starting with yes/no are matched at the start of each completion.
+
+    return:         [re.Pattern]
+    """
+    alt     = lambda ps: '|'.join( re.escape( p ) for p in ps )
+    groups  = [
+        f"(?P<tag_yes>{alt( [ '<yes>' ] )})",
+        f"(?P<tag_no>{alt( [ '<no>' ] )})",
+        f"(?<![^{sep}])(?P<start_yes>yes)",
+        f"(?<![^{sep}])(?P<start_no>no)",
+        f"(?P<pat_yes>{alt( yes_patterns )})",
+        f"(?P<pat_no>{alt( no_patterns )})",
     ]
+    return re.compile( f"(?=(?:{'|'.join( groups )}))" )
+
+
+def classify_replies( completion ):
+    """
+    Classify a batch of completions with a single pass of the compiled regex, following the precedence:
+        1. reply contains <yes>/<no>
+        2. reply starts with yes/no
+        3. reply contains positive/negative patterns, if both the reply is contradicting
+        4. otherwise the reply is unclear
+
+    params:
+        completion  [list] of completion text
+
+    return:         [np.array] of codes, see reply_codes
+    """
+    global  np
+    import  numpy           as np               # imported at first use, for a fast startup
+
+    global regex
+    if regex is None:
+        regex       = reply_regex()
 
-    values      = 'yes', 'no', 'unk'
     nc          = len( completion )
+    lower       = [ c.lower() for c in completion ]
+    text        = sep.join( lower )
+    ends        = np.cumsum( [ len( c ) + 1 for c in lower ] )          # end of each completion in text
+    found       = { g: np.full( nc, False ) for g in regex.groupindex }
+    for m in regex.finditer( text ):
+        found[ m.lastgroup ][ np.searchsorted( ends, m.start(), side='right' ) ] = True
+
+    tag_yes     = found[ "tag_yes" ]
+    tag_no      = ~tag_yes & found[ "tag_no" ]
+    rest        = ~tag_yes & ~tag_no
+    start_yes   = rest & found[ "start_yes" ]
+    start_no    = rest & ~start_yes & found[ "start_no" ]
+    rest        &= ~start_yes & ~start_no
+    pat_yes     = rest & found[ "pat_yes" ]
+    pat_no      = rest & found[ "pat_no" ]
+
+    codes       = np.full( nc, reply_codes[ "unk" ], dtype=np.uint8 )
+    codes[ tag_yes | start_yes | pat_yes ]  = reply_codes[ "yes" ]
+    codes[ tag_no | start_no | ( pat_no & ~pat_yes ) ]  = reply_codes[ "no" ]
+    codes[ pat_yes & pat_no ]               = reply_codes[ "contradicting" ]
+
+    return codes
+
+
+def check_reply( completion ):
+    """
+    Check the model answers in response to yes/no questions.
+    Contradicting replies count both as yes and as unk, unclear replies as unk. Both are counted
+    in reply_warnings, reported in the log.
+
+    params:
+        completion  [list] of completion text
+
+    return:         three [np.array] of booleans for yes/no/unk replies
+    """
+    codes       = classify_replies( completion )
+    contra      = codes == reply_codes[ "contradicting" ]
+    unclear     = codes == reply_codes[ "unk" ]
+    reply_warnings[ "contradicting" ]   += int( contra.sum() )
+    reply_warnings[ "unclear" ]         += int( unclear.sum() )
+
     res         = dict()
-    for v in values:
-        res[ v ]    = np.full( nc, False )
-
-    for i, c in enumerate( completion ):
-        c       = c.lower()
-        found   = False
-
-        # first, check if reply contains <yes>/<no>
-        if "<yes>" in c:
-            res[ "yes" ][ i ]   = True
-            found               = True
-        elif "<no>" in c:
-            res[ "no" ][ i ]    = True
-            found               = True
-
-        # second, check if reply starts with yes/no
-        elif c[ :3 ] == "yes":
-            res[ "yes" ][ i ]   = True
-            found               = True
-        elif c[ :2 ] == "no":
-            res[ "no" ][ i ]    = True
-            found               = True
-
-        # third, check if reply contains positive/negative patterns
-        else:
-            found_yes       = any( p in c for p in yes_patterns )
-            found_no        = any( p in c for p in no_patterns )
-
-            if found_yes and found_no:
-                print( f"WARNING: contradicting reply to YES/NO question. Considering <UNK> as answer." )
-                res[ "unk" ][ i ]       = True
-#               if cnfg.DEBUG:
-#                   sys.exit()
-
-            if found_yes:
-                res[ "yes" ][ i ]       = True
-                found                   = True
-            elif found_no:
-                res[ "no" ][ i ]        = True
-                found                   = True
-
-        # if not found:
-        #     for p in yes_patterns:
-        #         if p in c:
-        #             res[ "yes" ][ i ]   = True
-        #             found               = True
-        #             break
-        #         else:
-        #             if cnfg.DEBUG:
-        #                 print( f"not found: {p}\n in: {c}" )
-        #
-        # if not found:
-        #     for p in no_patterns:
-        #         if p in c:
-        #             res[ "no" ][ i ]    = True
-        #             found               = True
-        #             break
-        #         else:
-        #             if cnfg.DEBUG:
-        #                 print( f"not found: {p}\n in: {c}" )
-
-        # otherwise, default to unknown
-        if not found:
-            print( f"WARNING: unclear reply to YES/NO question. Considering <UNK> as answer." )
-            res[ "unk" ][ i ]    = True
-#           if cnfg.DEBUG:
-#               sys.exit()
+    res[ "yes" ]    = ( codes == reply_codes[ "yes" ] ) | contra
+    res[ "no" ]     = codes == reply_codes[ "no" ]
+    res[ "unk" ]    = unclear | contra
 
     return res
 
 
-def ask_news( with_img=True, demographics=None ):
+def reply_stats():
     """
-    Prepare the prompts and obtain the model completions
+    Return the counts of warnings on replies, and the replies of each turn of the conversations,
+    to write in the log
+
+    return:         [list] of [str] lines
+    """
+    import  numpy           as np
+
+    lines   = [
+        f"unclear replies          {reply_warnings[ 'unclear' ]} (considered <UNK>)",
+        f"contradicting replies    {reply_warnings[ 'contradicting' ]} (considered <YES> and <UNK>)",
+    ]
+    if len( adaptive_samples ):
+        s       = np.array( adaptive_samples )
+        lines.append( f"adaptive samples         {s.sum()} in total, per news mean {s.mean():.1f}, "
+                      f"min {s.min()}, max {s.max()}" )
+    for i, t in enumerate( turn_stats ):
+        n       = max( t[ "replies" ], 1 )
+        lines.append( f"turn {i:<20}yes {t[ 'yes' ] / n:.3f}  no {t[ 'no' ] / n:.3f}  unk {t[ 'unk' ] / n:.3f}  "
+                      f"tokens {t[ 'tokens' ]}" )
+    return lines
+
+
+def wilson_width( k, n ):
+    """
+    Return the width of the Wilson score interval of a proportion, at the confidence of adaptive_z
 
     params:
-        with_img    [bool] whether the prompts include image and text
+        k           [int] number of successes
+        n           [int] number of trials
+
+    return:         [float]
+    """
+    import  numpy           as np
+
+    z2      = adaptive_z ** 2
+    p       = k / n
+    return 2 * adaptive_z * np.sqrt( p * ( 1 - p ) / n + z2 / ( 4 * n * n ) ) / ( 1 + z2 / n )
+
+
+def prompt_interface():
+    """
+    Return the interface used to format the prompts of the current model
+
+    return:         [str] "openai", "qwen" or "hf"
+    """
+    if cnfg.interface in ( "openai", "local" ):
+        return "openai"                 # local servers accept the same multi-modal payload of OpenAI
+    if "Qwen" in cnfg.model:
+        return "qwen"
+    return cnfg.interface
+
+
+def format_one( news_id, with_img=True, demographics=None ):
+    """
+    Compose the prompt of one news, in the format of the current model
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        demographics [dict] demographic details, or None
+
+    return:
+        [tuple] of:
+                    prompt      [list] the prompt conversation
+                    img_name    [str] the image name or "" if not with_img
+    """
+    return prmpt.format_prompt(
+                        news_id,
+                        prompt_interface(),
+                        mode        = cnfg.mode,
+                        pre         = cnfg.dialogs_pre,
+                        post        = cnfg.dialogs_post,
+                        with_img    = with_img,
+                        source      = cnfg.info_source,
+                        more        = cnfg.info_more,
+                        demographics= demographics,
+    )
+
+
+def build_prompt( news_id, with_img=True, demographics=None ):
+    """
+    Prepare the prompt of one news, and its image for HF models
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        demographics [dict] demographic details, or None
+
+    return:
+        [tuple] of:
+                    prompt      [list] the prompt conversation
+                    image       [PIL.JpegImagePlugin.JpegImageFile] or None if not with_img or not HF
+                    img_name    [str] the image name or "" if not with_img
+    """
+    pr, name        = format_one( news_id, with_img=with_img, demographics=demographics )
+    image           = None
+    if with_img and cnfg.interface == "hf":
+        image           = prmpt.image_pil( news_id )
+
+    return pr, image, name
+
+
+def infer_one( pr, image ):
+    """
+    Obtain the model completions of a prompt
+
+    params:
+        pr          [list] the prompt conversation
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None
+
+    return:
+        [tuple] of:
+                    prompt      [list] the prompt conversation, without the image for OpenAI models
+                    completion  [list] the completions
+    """
+    # using OpenAI or a local OpenAI-compatible server
+    if cnfg.interface in ( "openai", "local" ):
+        completion  = cmplt.do_complete( pr )
+        pr          = prmpt.prune_prompt( pr ) # remove the textual version of the image from the prompt
+    # using HuggingFace
+    else:
+        completion  = cmplt.do_complete( pr, image=image )
+
+    return pr, completion
+
+
+def complete_one( news_id, with_img=True, demographics=None ):
+    """
+    Prepare the prompt of one news and obtain the model completions, without checking the replies
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
         demographics [dict] demographic details, or None
 
     return:
         [tuple] of:
-                    prompts     [list] of all prompt conversations
-                    completions [list] the list of completions
-                    scores      [list] of the yes/not answers
+                    prompt      [list] the prompt conversation
+                    completion  [list] the completions
+                    img_name    [str] the image name or "" if not with_img
+    """
+    if cnfg.VERBOSE:
+        i_mode      = "img + txt" if with_img else "only txt"
+        print( f"==========> Processing news {news_id} {i_mode} <==========" )
+
+    pr, image, name = build_prompt( news_id, with_img=with_img, demographics=demographics )
+    pr, completion  = infer_one( pr, image )
+    return pr, completion, name
+
+
+def ask_one( news_id, with_img=True, demographics=None ):
+    """
+    Prepare the prompt of one news and obtain the model completions
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        demographics [dict] demographic details, or None
+
+    return:
+        [tuple] of:
+                    prompt      [list] the prompt conversation
+                    completion  [list] the completions
+                    score       [dict] of the yes/not answers
+                    img_name    [str] the image name or "" if not with_img
+    """
+    pr, completion, name    = complete_one( news_id, with_img=with_img, demographics=demographics )
+    return pr, completion, check_reply( completion ), name
+
+
+def load_one( args ):
     """
-    prompts         = []        # initialize the list of prompts
-    completions     = []        # initialize the list of completions
-    scores          = dict()    # initialize the yes/not replies
-    img_names       = []        # initialize the list of image names
+    First stage of the pipeline: prepare the prompt of one news, and decode its image
 
+    params:
+        args        [tuple] arguments of build_prompt
+
+    return:         [tuple] arguments, prompt, image, image name
+    """
+    pr, image, name = build_prompt( *args )
+    if image is not None:
+        image.load()                    # PIL decodes the image only when the pixels are accessed
+    return args, pr, image, name
+
+
+def infer_loaded( loaded ):
+    """
+    Second stage of the pipeline: obtain the model completions
+
+    params:
+        loaded      [tuple] returned by load_one
+
+    return:         [tuple] arguments, prompt, completions, image name
+    """
+    args, pr, image, name   = loaded
+    pr, completion          = infer_one( pr, image )
+    return args, pr, completion, name
+
+
+def post_one( inferred ):
+    """
+    Third stage of the pipeline: check the replies and stream the result
+
+    params:
+        inferred    [tuple] returned by infer_loaded
+
+    return:         [dict] the scores, as returned by record_one
+    """
+    args, pr, completion, name  = inferred
+    return record_one( args, ( pr, completion, check_reply( completion ), name ) )
+
+
+def record_one( args, result ):
+    """
+    Stream the result of one news to the execution folder.
+    Only the scores are returned, the prompt and the completions are read again from the stream file when needed
+
+    params:
+        args        [tuple] arguments of ask_one
+        result      [tuple] returned by ask_one, or by converse_one with the replies of the other turns
+
+    return:         [dict] the scores of the result
+    """
+    news_id, with_img, _        = args
+    pr, completion, res, name   = result[ :4 ]
+    turns                       = result[ 4 ] if len( result ) > 4 else None
+    save_res.write_record( news_id, with_img, pr, completion, name, turns=turns )
+    return res
+
+
+class Conversation( object ):
+    """
+    Multi-turn conversation about one news. The first turn is the prompt of the news, the next ones are user
+    messages sent after the replies, like "why?". Each of the cnfg.n_returns samples continues its own
+    conversation, and the replies of every turn are scored.
+
+    With HF models the KV cache of all samples is kept between turns, and only the new tokens are prefilled.
+    OpenAI models receive the whole history at each turn, and the tokens used are accumulated.
+    """
+
+    def __init__( self, news_id, with_img=True, demographics=None ):
+        """
+        Prepare the prompt of the news
+
+        params:
+            news_id     [str] id of the news
+            with_img    [bool] whether the prompt includes image and text
+            demographics [dict] demographic details, or None
+        """
+        assert cnfg.mode == "chat", "error: conversations require a chat-mode model"
+        self.prompt, self.image, self.img_name = build_prompt( news_id, with_img=with_img, demographics=demographics )
+        self.follow_ups = []            # user messages after the first turn
+        self.turns      = []            # [list] of tuples ( completions, scores, tokens ) of each turn
+        self.state      = None          # HF models: token ids, mask and KV cache of all samples
+        self.histories  = None          # OpenAI models: the messages of each sample
+        self.tokens     = { "prompt": 0, "completion": 0 }     # OpenAI: tokens used, HF: prompt tokens prefilled
+
+
+    def ask( self, text=None ):
+        """
+        Run one turn of the conversation
+
+        params:
+            text        [str] the user message, or None for the first turn
+
+        return:         [list] the completions, one for each sample
+                        [dict] of the yes/not answers
+        """
+        assert ( text is None ) == ( not self.turns ), "error: only the first turn has no user message"
+        if text is not None:
+            self.follow_ups.append( text )
+        used        = sum( self.tokens.values() )
+
+        if cnfg.interface in ( "openai", "local" ):
+            completion  = self.ask_openai( text )
+        elif self.state is None:
+            completion, self.state  = cmplt.first_turn_hf( self.prompt, self.image )
+            self.tokens[ "prompt" ] = self.state[ "prefilled" ]
+        else:
+            completion  = cmplt.next_turn_hf( self.state, text )
+            self.tokens[ "prompt" ] = self.state[ "prefilled" ]
+
+        scores      = check_reply( completion )
+        self.turns.append( ( completion, scores, sum( self.tokens.values() ) - used ) )
+        return completion, scores
+
+
+    def ask_openai( self, text ):
+        """
+        Run one turn of the conversation with an OpenAI model: the first turn returns all the samples at once,
+        the next ones send the history of each sample with one return
+
+        params:
+            text        [str] the user message, or None for the first turn
+
+        return:         [list] the completions, one for each sample
+        """
+        # the tokens of the requests of this conversation, not counting the concurrent ones of other news
+        if text is None:
+            completion      = cmplt.do_complete( self.prompt, usage=self.tokens )
+            self.histories  = [ list( self.prompt ) for _ in completion ]
+        else:
+            saved           = cnfg.n_returns
+            cnfg.n_returns  = 1
+            completion      = []
+            for h in self.histories:
+                h.append( { "role": "user", "content": text } )
+                completion  += cmplt.do_complete( h, usage=self.tokens )
+            cnfg.n_returns  = saved
+
+        for h, c in zip( self.histories, completion ):
+            h.append( { "role": "assistant", "content": c } )
+        return completion
+
+
+    def log_prompt( self ):
+        """
+        Return the prompt to write in the log: the messages of the first turn and the user follow-up messages
+
+        return:         [list] of messages
+        """
+        pr          = self.prompt
+        if cnfg.interface in ( "openai", "local" ):
+            pr          = prmpt.prune_prompt( pr )
+        return pr + [ { "role": "user", "content": t } for t in self.follow_ups ]
+
+
+def converse_one( news_id, with_img=True, demographics=None ):
+    """
+    Run a conversation about one news, with the follow-up messages in cnfg.follow_ups.
+    The replies of the turn cnfg.score_turn, asking the question, are the result of the news, the replies of
+    the other turns are only written in the log. The replies of all turns are counted in turn_stats
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        demographics [dict] demographic details, or None
+
+    return:         [tuple] as returned by ask_one, and the [dict] with the replies of the other turns
+                    by turn index, as written by save_res.write_record
+    """
+    dialog      = Conversation( news_id, with_img=with_img, demographics=demographics )
+    for text in [ None ] + list( cnfg.follow_ups ):
+        dialog.ask( text )
+    completion, scores, _   = dialog.turns[ cnfg.score_turn ]
+    turns       = { str( i ): t[ 0 ] for i, t in enumerate( dialog.turns ) if i != cnfg.score_turn }
+
+    for i, ( _, sc, tokens ) in enumerate( dialog.turns ):
+        if len( turn_stats ) <= i:
+            turn_stats.append( { "replies": 0, "yes": 0, "no": 0, "unk": 0, "tokens": 0 } )
+        turn_stats[ i ][ "replies" ]    += len( sc[ "yes" ] )
+        turn_stats[ i ][ "tokens" ]     += tokens
+        for v in ( "yes", "no", "unk" ):
+            turn_stats[ i ][ v ]        += int( sc[ v ].sum() )
+
+    return dialog.log_prompt(), completion, scores, dialog.img_name, turns
+
+
+def sample_one( news_id, with_img=True, demographics=None ):
+    """
+    Obtain the completions of one news in rounds of cnfg.adaptive_round, until the confidence interval
+    of the fraction of yes replies is narrower than cnfg.adaptive_ci, or cnfg.n_returns completions are reached
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        demographics [dict] demographic details, or None
+
+    return:         [tuple] as returned by ask_one
+    """
+    pr, image, name = build_prompt( news_id, with_img=with_img, demographics=demographics )
+    saved           = cnfg.n_returns
+    completion      = []
+    while len( completion ) < saved:
+        cnfg.n_returns  = min( cnfg.adaptive_round, saved - len( completion ) )
+        prompt, compl   = infer_one( pr, image )
+        completion      += compl
+        codes           = classify_replies( completion )
+        n_yes           = np.isin( codes, ( reply_codes[ "yes" ], reply_codes[ "contradicting" ] ) ).sum()
+        if wilson_width( n_yes, len( completion ) ) < cnfg.adaptive_ci:
+            break
+    cnfg.n_returns  = saved
+
+    adaptive_samples.append( len( completion ) )
+    return prompt, completion, check_reply( completion ), name
+
+
+def seed_baseline( order, streamed, demographics=None ):
+    """
+    Stream the results of the news of the baseline execution in cnfg.BASELINE, which are not streamed yet,
+    at most cnfg.n_returns completions each. The news of the baseline whose prompt or image differs are executed
+    again, as well as those whose prompt cannot be read from the log of a baseline without stream
+
+    params:
+        order       [list] of tuples ( news id, with_img ) to execute
+        streamed    [dict] with_img -> news already streamed, as returned by save_res.index_records
+        demographics [dict] demographic details, or None
+    """
+    baseline    = { w: save_res.read_baseline( cnfg.BASELINE, w ) for w in streamed }
+    logged      = not save_res.has_stream( cnfg.BASELINE )
+    for n, w in order:
+        if n in streamed[ w ] or n not in baseline[ w ]:
+            continue
+
+        # the prompt is composed as written in the stream, with the follow-up messages of conversations
+        pr, completion, name, turns = baseline[ w ][ n ]
+        new_pr, new_name        = format_one( n, with_img=w, demographics=demographics )
+        if cnfg.interface in ( "openai", "local" ):
+            new_pr  = prmpt.prune_prompt( new_pr )
+        if len( cnfg.follow_ups ):
+            new_pr  = new_pr + [ { "role": "user", "content": t } for t in cnfg.follow_ups ]
+        # a baseline without stream has the prompt as written in its log
+        same    = save_res.dialog_text( new_pr, mode=cnfg.mode ) if logged else new_pr
+        if pr is None or pr != same or name != new_name:
+            if cnfg.VERBOSE:
+                print( f"news {n} executed again, its prompt differs from the baseline" )
+            continue
+
+        if turns is not None:
+            turns   = { t: c[ : cnfg.n_returns ] for t, c in turns.items() }
+        record_one( ( n, w, demographics ), ( new_pr, completion[ : cnfg.n_returns ], None, new_name, turns ) )
+
+
+def ask_all( args ):
+    """
+    Obtain the results of a list of news, streaming each one to the execution folder.
+    With follow-up messages the news are conversations, with cnfg.adaptive_ci they are sampled adaptively.
+    For HF models with cnfg.n_workers > 1, the news are distributed over a pool of worker processes,
+    with cnfg.cb_slots > 0 all prompts are generated together by continuous batching.
+    For OpenAI models with cnfg.api_concurrency > 1, that many requests are sent at the same time.
+    Otherwise, with cnfg.pipeline the prompts are built and the replies checked while the model is running.
+
+    params:
+        args        [list] of tuples with the arguments of ask_one
+
+    return:         [list] of the scores returned by record_one, in the same order of args
+    """
+    if len( cnfg.follow_ups ):
+        return [ record_one( a, converse_one( *a ) ) for a in args ]
+
+    if cnfg.adaptive_ci is not None:
+        return [ record_one( a, sample_one( *a ) ) for a in args ]
+
+    if cnfg.interface == "hf" and cnfg.n_workers > 1:
+        # the replies are checked in the main process, where the warnings are counted
+        done            = workers.run_pool( complete_one, args )
+        return [ record_one( a, ( pr, c, check_reply( c ), name ) ) for a, ( pr, c, name ) in zip( args, done ) ]
+
+    if cnfg.interface == "hf" and cnfg.cb_slots > 0:
+        built           = [ build_prompt( *a ) for a in args ]
+        all_compl       = cmplt.do_complete_batch( [ b[ 0 ] for b in built ], [ b[ 1 ] for b in built ] )
+        return [ record_one( a, ( pr, c, check_reply( c ), name ) )
+                 for a, ( pr, _, name ), c in zip( args, built, all_compl ) ]
+
+    if cnfg.interface in ( "openai", "local" ) and cnfg.api_concurrency > 1:
+        if cmplt.client is None:    # set the client before the threads use it
+            cmplt.client    = cmplt.set_local() if cnfg.interface == "local" else cmplt.set_openai()
+        # the replies are checked in the main thread, in the order of the news
+        with ThreadPoolExecutor( max_workers=cnfg.api_concurrency ) as pool:
+            done            = pool.map( lambda a: complete_one( *a ), args )
+            return [ record_one( a, ( pr, c, check_reply( c ), name ) ) for a, ( pr, c, name ) in zip( args, done ) ]
+
+    if cnfg.pipeline:
+        return pipeline.run_pipeline( args, load_one, infer_loaded, post_one )
+
+    return [ record_one( a, ask_one( *a ) ) for a in args ]
+
+
+def ask_modalities( modalities, demographics=None ):
+    """
+    Prepare the prompts and obtain the model completions of all news, for one or both image modalities
+    executed together. The news already streamed to the execution folder are not executed again, and with
+    cnfg.BASELINE the news of the baseline execution are reused, generating only the completions missing.
+    OpenAI requests of the two modalities are interleaved, HF prompts of the same modality are kept together,
+    to be batched together.
+
+    params:
+        modalities  [list] of [bool] whether the prompts include image and text
+        demographics [dict] demographic details, or None
+
+    return:         [list] with the scores as returned by ask_news for each modality
+    """
     if not len( cnfg.news_ids ):
         # use all news in file if not specified otherwise
         cnfg.news_ids   = prmpt.list_news()
 
-    for n in cnfg.news_ids:
-        if cnfg.VERBOSE:
-            i_mode      = "img + txt" if with_img else "only txt"
-            print( f"==========> Processing news {n} {i_mode} <==========" )
-
-        interface       = "qwen"    if "Qwen" in cnfg.model     else cnfg.interface
-#       interface       = cnfg.interface
-
-        pr, name        = prmpt.format_prompt(
-                            n,
-                            interface,
-                            mode        = cnfg.mode,
-                            pre         = cnfg.dialogs_pre,
-                            post        = cnfg.dialogs_post,
-                            with_img    = with_img,
-                            source      = cnfg.info_source,
-                            more        = cnfg.info_more,
-                            demographics= demographics,
-        )
-
-        # using OpenAI
-        if cnfg.interface == "openai":
-            completion  = cmplt.do_complete( pr )
-            pr          = prmpt.prune_prompt( pr ) # remove the textual version of the image from the prompt
-        # using HuggingFace
-        else:
-            image       = prmpt.image_pil( n ) if with_img else None
-            completion  = cmplt.do_complete( pr, image=image )
+    global reused_samples
+
+    streamed        = { w: save_res.index_records( w ) for w in modalities }
+    if cnfg.interface == "hf":
+        order           = [ ( n, w ) for w in modalities for n in cnfg.news_ids ]
+    else:
+        order           = [ ( n, w ) for n in cnfg.news_ids for w in modalities ]
+    if cnfg.BASELINE is not None:
+        seed_baseline( order, streamed, demographics=demographics )
+        streamed        = { w: save_res.index_records( w ) for w in modalities }
+
+    # completions to generate for each news, fewer for the news streamed with less than n_returns completions
+    missing         = dict()
+    for n, w in order:
+        if n not in streamed[ w ]:
+            missing[ ( n, w ) ] = cnfg.n_returns
+        elif cnfg.adaptive_ci is None and streamed[ w ][ n ][ 1 ] < cnfg.n_returns:
+            missing[ ( n, w ) ] = cnfg.n_returns - streamed[ w ][ n ][ 1 ]
+    if len( order ) > len( missing ) and cnfg.VERBOSE:
+        print( f"{len( order ) - len( missing )} news already completed, {len( missing )} to go" )
+
+    # the news needing the same number of completions are executed together
+    results         = dict()
+    saved           = cnfg.n_returns
+    for k in sorted( set( missing.values() ), reverse=True ):
+        args            = [ ( n, w, demographics ) for n, w in order if missing.get( ( n, w ) ) == k ]
+        cnfg.n_returns  = k
+        results.update( zip( [ a[ :2 ] for a in args ], ask_all( args ) ) )
+    cnfg.n_returns  = saved
+
+    # the scores of the news streamed by the interrupted execution or taken from the baseline are computed
+    # reading them one at a time, and topped up with the scores of the new completions
+    if any( len( streamed[ w ] ) for w in modalities ):
+        with open( save_res.f_stream, 'rb' ) as f:
+            for w in modalities:
+                for n, ( offsets, count ) in streamed[ w ].items():
+                    reused_samples      += count
+                    res                 = check_reply( save_res.load_record( f, offsets )[ 1 ] )
+                    if ( n, w ) in results:
+                        new_res             = results[ ( n, w ) ]
+                        res                 = { k: np.concatenate( ( res[ k ], new_res[ k ] ) ) for k in res }
+                    results[ ( n, w ) ] = res
+
+    return [ { n: results[ ( n, w ) ] for n in cnfg.news_ids } for w in modalities ]
+
+
+def ask_news( with_img=True, demographics=None ):
+    """
+    Prepare the prompts and obtain the model completions
+    The result of each news is streamed to the execution folder, the news already there are not executed again
+
+    params:
+        with_img    [bool] whether the prompts include image and text
+        demographics [dict] demographic details, or None
 
-        res             = check_reply( completion )
-        scores[ n ]     = res
-        prompts.append( pr )
-        completions.append( completion )
-        img_names.append( name )
+    return:         [dict] of the yes/not answers of each news
+    """
+    return ask_modalities( [ with_img ], demographics=demographics )[ 0 ]
 
-    return prompts, completions, scores, img_names
+
+def ask_both( demographics=None ):
+    """
+    Prepare the prompts and obtain the model completions of the news with and without image, executed together
+
+    params:
+        demographics [dict] demographic details, or None
+
+    return:         [list] with the scores returned by ask_news with image and without image
+    """
+    return ask_modalities( [ True, False ], demographics=demographics )
@@ -0,0 +1,241 @@
+"""
+#####################################################################################################################
+
+    Module to estimate tokens, time and cost of an execution, before running it
+
+    Prompts are formatted exactly as in the execution, without calling any model.
+    Text tokens are counted with the tokenizer of the model when available (tiktoken for OpenAI models,
+    the HF tokenizer for HF models), otherwise approximated as one token every 4 characters.
+    The messages of HF models are counted after applying the chat template of the model, those of OpenAI
+    models with the tokens added by the chat format to each message.
+    Image tokens follow the rules of each model, output tokens are bounded by n_returns * max_tokens.
+    The time is projected from previous executions of the same model, found in the folder of results,
+    excluding the time to load the model.
+
+#####################################################################################################################
+"""
+
+import  os
+import  json
+import  math
+
+import  prompt          as prmpt                # this module composes the prompts
+import  complete        as cmplt                # this module performs LLM completions
+import  conversation    as conv                 # this module handles conversations with the LLM
+from    models          import models_price, models_image_tokens
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+chars_per_token         = 4                     # approximation of text tokens when no tokenizer is available
+message_tokens          = 3                     # tokens added by the OpenAI chat format to each message,
+                                                # and to prime the reply
+
+
+# ===================================================================================================================
+#
+#   - get_tokenizer
+#   - text_tokens
+#   - prompt_tokens
+#   - image_tokens
+#   - past_timing
+#   - do_estimate
+#
+# ===================================================================================================================
+
+def get_tokenizer():
+    """
+    Return a function counting the tokens of a text with the tokenizer of the current model, if available,
+    and for HF models a function applying the chat template of the model to the messages of a prompt
+
+    return:         [tuple] of [function] or None
+    """
+    if cnfg.interface == "openai":
+        try:
+            import  tiktoken
+        except ImportError:
+            return None, None
+        try:
+            enc     = tiktoken.encoding_for_model( cnfg.model )
+        except KeyError:
+            enc     = tiktoken.get_encoding( "o200k_base" )
+        return lambda t: len( enc.encode( t ) ), None
+
+    if cnfg.interface == "hf":
+        try:
+            from    transformers    import AutoProcessor
+            proc    = AutoProcessor.from_pretrained( cnfg.model, local_files_only=cmplt.local_only )
+        except Exception:
+            return None, None
+        tok         = getattr( proc, "tokenizer", proc )
+        template    = lambda m: proc.apply_chat_template( m, tokenize=False, add_generation_prompt=True )
+        return lambda t: len( tok( t )[ "input_ids" ] ), template
+
+    return None, None
+
+
+def text_tokens( text, count ):
+    """
+    Return the number of tokens of a text
+
+    params:
+        text        [str] the text
+        count       [function] counting the tokens, or None for the approximation
+
+    return:         [int]
+    """
+    if count is None:
+        return math.ceil( len( text ) / chars_per_token )
+    return count( text )
+
+
+def prompt_tokens( prompt, count, template ):
+    """
+    Return the number of text tokens of a prompt, formatted as in the execution
+
+    params:
+        prompt      [str] the prompt for completion-mode models, or [list] the messages for chat-mode models
+        count       [function] counting the tokens, or None for the approximation
+        template    [function] applying the chat template of the model, or None
+
+    return:         [int]
+    """
+    if isinstance( prompt, str ):
+        return text_tokens( prompt, count )
+    if template is not None:
+        return text_tokens( template( prompt ), count )
+
+    # the images are counted apart, by image_tokens
+    n       = message_tokens
+    for m in prompt:
+        n       += message_tokens + text_tokens( m[ "role" ], count )
+        content = m[ "content" ]
+        if isinstance( content, str ):
+            content = [ { "type": "text", "text": content } ]
+        for c in content:
+            if c[ "type" ] == "text":
+                n       += text_tokens( c[ "text" ], count )
+    return n
+
+
+def image_tokens( fimage ):
+    """
+    Return the number of input tokens taken by an image, for the current model
+
+    params:
+        fimage      [str] name of the image file
+
+    return:         [int]
+    """
+    from    PIL         import Image
+
+    with Image.open( os.path.join( prmpt.dir_imgs, fimage ) ) as img:
+        w, h    = img.size                  # only the header is read
+
+    # OpenAI: base tokens, plus the tokens of each tile of 512 pixels with detail "high", as gpt-4o if unknown
+    if cnfg.interface == "openai":
+        base, tile  = models_image_tokens.get( cnfg.model, models_image_tokens[ "gpt-4o" ] )
+        if prmpt.detail == "low":
+            return base
+        scale   = min( 1., 2048 / max( w, h ) )
+        w, h    = w * scale, h * scale
+        scale   = min( 1., 768 / min( w, h ) )
+        w, h    = w * scale, h * scale
+        return base + tile * math.ceil( w / 512 ) * math.ceil( h / 512 )
+
+    # HF models resize the image to native_res, local servers are assumed to do the same
+    nw, nh  = cmplt.native_res
+    if "Qwen" in cnfg.model:
+        return ( nw // 28 ) * ( nh // 28 )          # 14 pixels patches merged 2x2
+    if "chameleon" in cnfg.model:
+        return 1024
+    if "llava" in cnfg.model:
+        # base image plus the tiles of 336 pixels, with a newline token at the end of each row of the tiles
+        tiles   = ( nw // 336 ) * ( nh // 336 )
+        return 576 + tiles * 576 + ( nh // 336 ) * 24
+    return 0
+
+
+def past_timing( dir_res ):
+    """
+    Return the seconds per completion of the previous executions of the current model,
+    without the time to load the model
+
+    params:
+        dir_res     [str] folder of results
+
+    return:         [float] or None if there are no previous executions
+    """
+    seconds     = 0.
+    samples     = 0
+    if not os.path.isdir( dir_res ):
+        return None
+    for d in os.listdir( dir_res ):
+        fname   = os.path.join( dir_res, d, "timing.json" )
+        if not os.path.isfile( fname ):
+            continue
+        with open( fname, 'r' ) as f:
+            t       = json.load( f )
+        if t[ "model" ] != cnfg.model:
+            continue
+        seconds += t[ "seconds" ] - ( t.get( "load_seconds" ) or 0. )
+        samples += t[ "samples" ]
+
+    if not samples:
+        return None
+    return seconds / samples
+
+
+def do_estimate( dir_res ):
+    """
+    Print the estimate of tokens, time and cost of the execution in the current configuration
+
+    params:
+        dir_res     [str] folder of results
+    """
+    match cnfg.experiment:
+        case "news_noimage":    modalities  = [ False ]
+        case "news_image":      modalities  = [ True ]
+        case "both":            modalities  = [ True, False ]
+        case _:
+            print( f"ERROR: experiment '{cnfg.experiment}' not implemented" )
+            return None
+
+    news_ids    = cnfg.news_ids if len( cnfg.news_ids ) else prmpt.list_news()
+    count, template = get_tokenizer()
+    n_prompts   = 0
+    txt_tokens  = 0
+    img_tokens  = 0
+    for with_img in modalities:
+        for n in news_ids:
+            pr, fimage  = conv.format_one( n, with_img=with_img, demographics=cnfg.demographics )
+            n_prompts   += 1
+            txt_tokens  += prompt_tokens( pr, count, template )
+            if len( fimage ):
+                img_tokens  += image_tokens( fimage )
+
+    # OpenAI bills the prompt once for all the returns, HF models process it once in the batch
+    in_tokens   = txt_tokens + img_tokens
+    n_samples   = n_prompts * cnfg.n_returns
+    out_tokens  = n_samples * cnfg.max_tokens
+
+    print( f"estimate for model {cnfg.model}, experiment {cnfg.experiment}" )
+    print( f"prompts                  {n_prompts}" )
+    print( f"completions              {n_samples}" )
+    tokenizer   = "approximated" if count is None else "tokenizer"
+    print( f"input text tokens        {txt_tokens} ({tokenizer})" )
+    print( f"input image tokens       {img_tokens}" )
+    print( f"output tokens            at most {out_tokens}" )
+
+    sec         = past_timing( dir_res )
+    if sec is None:
+        print( "time                     unknown, no previous execution of this model" )
+    else:
+        print( f"time                     {sec * n_samples / 60:.1f} min ({sec:.2f} s per completion)" )
+
+    if cnfg.model in models_price:
+        p_in, p_out = models_price[ cnfg.model ]
+        cost        = ( in_tokens * p_in + out_tokens * p_out ) / 1e6
+        print( f"cost                     at most $ {cost:.2f}" )
+    elif cnfg.interface == "openai":
+        print( "cost                     unknown, no price for this model" )
+
+    return True
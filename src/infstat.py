@@ -12,10 +12,6 @@ import  re
 import  json
 import  time
 import  shutil
-import  numpy   as np
-import  pandas  as pd
-from    statsmodels.formula.api     import ols
-from    statsmodels.stats.anova     import anova_lm
 from    models                      import models_short_name
 import  plot
 
@@ -277,6 +273,9 @@ def collect_data():
 
     return:             [pandas.core.frame.DataFrame] the data in pandas DataFrame
     """
+    global  np, pd
+    import  numpy   as np                       # imported here, the logs are parsed by get_info with numpy
+    import  pandas  as pd
 
     list_res    = sorted( os.listdir( res ) )
     match len( res_range ):
@@ -371,6 +370,9 @@ def anova_1( df, score ):
 
     return:             [tuple] anova for profile, age, gender, race, edu, politic
     """
+    from    statsmodels.formula.api     import ols
+    from    statsmodels.stats.anova     import anova_lm
+
     formula     = f"{score} ~ C(profile)"
     model       = ols( formula, df ).fit()
     am          = anova_lm( model )
@@ -17,29 +17,56 @@ class Config( object ):
     Several parameters can be given in the configuration file as well as with command line flags.
 
     Command line flags:
+    BASELINE                [str] folder of a previous execution whose completions are reused (DEFAULT=None)
     CONFIG                  [str] name of configuration file (without path nor extension) (DEFAULT=None)
     DEBUG                   [str] debug mode, for generic debugging in selected parts of the software
+    DRAFT                   [int] index in the list of possible models of the draft model (DEFAULT=None)
+    ESTIMATE                [bool] estimate tokens, time and cost of the execution, without calling any model
     MAXTOKENS               [int] maximum number of tokens (DEFAULT=None)
     MODEL                   [int] index in the list of possible models (DEFAULT=0)
+    MODELS                  [list] indices of several models to execute concurrently (DEFAULT=None)
     NRETURNS                [int] number of return sequences (DEFAULT=None)
+    QUEUE                   [str] folder of a shared work queue, to execute the cells of the sweep (DEFAULT=None)
+    RESUME                  [str] folder of an interrupted execution to complete (DEFAULT=None)
     VERBOSE                 [bool] write additional information
 
     Configuration file parameters:
+    adaptive_ci             [float] width of the confidence interval of the yes fraction at which adaptive sampling
+                            of a news stops, at most n_returns completions, or None for fixed n_returns
+    adaptive_round          [int] completions per round of adaptive sampling (default=5)
+    api_concurrency         [int] OpenAI requests sent at the same time (default=1)
+    attn_impl               [str] attention kernel of HF models: "sdpa", "eager", or None for the model default
+    base_url                [str] URL of the server of "local" models (default from models.py)
+    cache_impl              [str] KV cache of HF models: "static" (preallocated for max_tokens) or None (dynamic)
+    cb_slots                [int] decode slots for continuous batching of HF models, or 0 to generate per prompt
+    compile                 [bool] compile the decoder of HF models with torch.compile (requires static cache)
     demographics            [dic] demographic data or None
     detail                  [str] detail parameter for OpenAI image handling: "high", "low", "auto"
     dialogs_pre             [list or str] dialog ids to instert before the news
     dialogs_post            [list or str] dialog ids to instert after the news
+    draft_id                [int] index of the draft model for assisted generation, or None (overwritten by DRAFT)
+    follow_ups              [list] user messages sent after the replies, for multi-turn conversations (default=[])
     f_dialog                [str] filename of json file with dialogs
     f_news                  [str] filename of json file with the news
+    hedge                   [float] latency percentile (e.g. 0.95) after which OpenAI requests are duplicated, or None
     info_source             [bool] add info about the source of the news
     info_more               [bool] add more available info about the news, like number of share/followers
     model_id                [int] index in the list of possible models (overwritten by MODEL)
     max_tokens              [int] maximum number of tokens (overwritten by MAXTOKENS)
     n_returns               [int] number of return sequences (overwritten by NRETURNS)
     news_ids                [list] ids of news to process
+    offline                 [bool] load HF models from the local cache without login, if they are there
+    onnx_threads            [int] threads of ONNX Runtime for the vision encoder, or None for its default
+    onnx_vision             [bool] run the vision encoder of HF models with ONNX Runtime (exported at first use)
+    n_workers               [int] number of worker processes for HF inference on CPU (default=1, no workers)
+    pipeline                [bool] build prompts and check replies in threads, overlapping with the model
+    prefetch                [int] size of the queues between the stages of the pipeline (default=4)
     repetition_penalty      [float] penality for text repetitions in completion
+    score_turn              [int] turn of multi-turn conversations whose replies are the result, 0 for the prompt of
+                            the news, i for the follow-up message i (default=0)
     top_p                   [int] probability mass of tokens generated in completion (default=1)
     temperature             [float] sampling temperature during completion (default=1.0)
+    worker_threads          [int] cores and torch threads of each worker, or None to split all cores evenly
 
     """
 
@@ -89,6 +116,42 @@ class Config( object ):
             self.repetition_penalty = 1.1
         if not hasattr(self, 'demographics'):
             self.demographics       = None      # Default is not including demographics
+        if not hasattr( self, 'draft_id' ):
+            self.draft_id           = None      # no assisted generation
+        if not hasattr( self, 'attn_impl' ):
+            self.attn_impl          = None
+        if not hasattr( self, 'cache_impl' ):
+            self.cache_impl         = None
+        if not hasattr( self, 'compile' ):
+            self.compile            = False
+        if not hasattr( self, 'cb_slots' ):
+            self.cb_slots           = 0
+        if not hasattr( self, 'hedge' ):
+            self.hedge              = None
+        if not hasattr( self, 'n_workers' ):
+            self.n_workers          = 1
+        if not hasattr( self, 'worker_threads' ):
+            self.worker_threads     = None
+        if not hasattr( self, 'onnx_vision' ):
+            self.onnx_vision        = False
+        if not hasattr( self, 'onnx_threads' ):
+            self.onnx_threads       = None
+        if not hasattr( self, 'offline' ):
+            self.offline            = False
+        if not hasattr( self, 'pipeline' ):
+            self.pipeline           = False
+        if not hasattr( self, 'prefetch' ):
+            self.prefetch           = 4
+        if not hasattr( self, 'follow_ups' ):
+            self.follow_ups         = []
+        if not hasattr( self, 'score_turn' ):
+            self.score_turn         = 0
+        if not hasattr( self, 'adaptive_ci' ):
+            self.adaptive_ci        = None
+        if not hasattr( self, 'adaptive_round' ):
+            self.adaptive_round     = 5
+        if not hasattr( self, 'api_concurrency' ):
+            self.api_concurrency    = 1
 
 
     def __str__( self ):
@@ -136,6 +199,22 @@ def read_args():
             dest            = 'DEBUG',
             help            = "debug mode: print prompts only, do not call LLMs"
     )
+    parser.add_argument(
+            '-d',
+            '--draft',
+            action          = 'store',
+            dest            = 'DRAFT',
+            type            = int,
+            default         = None,
+            help            = "index of the draft model for assisted generation (Qwen2-VL only)",
+    )
+    parser.add_argument(
+            '-E',
+            '--estimate',
+            action          = 'store_true',
+            dest            = 'ESTIMATE',
+            help            = "estimate tokens, time and cost of the execution, without calling any model"
+    )
     parser.add_argument(
             '-m',
             '--model',
@@ -145,6 +224,39 @@ def read_args():
             default         = None,
             help            = "index in the list of possible models (default=0) (-1 to print all)",
     )
+    parser.add_argument(
+            '--models',
+            action          = 'store',
+            dest            = 'MODELS',
+            type            = int,
+            nargs           = '+',
+            default         = None,
+            help            = "indices of several models to execute concurrently, each in its own process",
+    )
+    parser.add_argument(
+            '--baseline',
+            action          = 'store',
+            dest            = 'BASELINE',
+            type            = str,
+            default         = None,
+            help            = "folder of a previous execution, only the news and samples missing are executed"
+    )
+    parser.add_argument(
+            '--queue',
+            action          = 'store',
+            dest            = 'QUEUE',
+            type            = str,
+            default         = None,
+            help            = "folder of a work queue shared by several workers, to execute the cells of the sweep"
+    )
+    parser.add_argument(
+            '--resume',
+            action          = 'store',
+            dest            = 'RESUME',
+            type            = str,
+            default         = None,
+            help            = "folder of an interrupted execution, the news already completed are skipped"
+    )
     parser.add_argument(
             '-M',
             '--maxreturns',
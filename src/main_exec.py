@@ -11,18 +11,23 @@
 
 import  os
 import  sys
-import  shutil
 import  time
-import  numpy           as np
+import  itertools
 
 import  load_cnfg                               # this module sets program parameters
 import  prompt          as prmpt                # this module composes the prompts
 import  complete        as cmplt                # this module performs LLM completions
 import  conversation    as conv                 # this module handles conversations with the LLM
+import  workers                                 # this module runs HF inference on a pool of processes
+import  pipeline                                # this module processes the news in a pipeline of stages
+import  multirun                                # this module executes several models in one invocation
+import  estimate                                # this module estimates tokens, time and cost of an execution
+import  workqueue                               # this module executes the cells of a sweep from a shared queue
+import  objstore                                # this module archives files in a content-addressed store
 import  save_res                                # this module saves results
 
 # this module lists the available LLMs
-from    models          import models, models_endpoint, models_interface
+from    models          import models, models_endpoint, models_interface, models_base_url
 
 # execution directives
 DO_NOTHING              = False                 # for interactive usage
@@ -42,6 +47,18 @@ exec_data               = 'data'
 exec_log                = 'log.txt'
 exec_pkl                = 'res.pkl'
 exec_csv                = 'res.csv'
+exec_timing             = 'timing.json'
+exec_stream             = 'stream.jsonl'
+
+# parameters that should be the same of the baseline execution, the others are checked on the prompts
+baseline_params         = ( "model", "max_tokens", "top_p", "temperature", "repetition_penalty", "follow_ups",
+                            "score_turn", "dialogs_pre", "dialogs_post", "info_source", "info_more",
+                            "demographics", "f_dialog", "f_news", "detail" )
+# parameters not fully visible in the prompts written in the log, required also when missing from the log
+# of a baseline without stream
+baseline_logged         = ( "demographics", "f_dialog", "f_news", "detail" )
+# parameters that should be the same of the interrupted execution to resume, checked on the stream
+resume_params           = baseline_params + ( "n_returns", "adaptive_ci", "adaptive_round" )
 
 
 # ===================================================================================================================
@@ -49,35 +66,64 @@ exec_csv                = 'res.csv'
 #   Utilities to set up execution
 #   - init_dirs
 #   - init_cnfg
+#   - set_model
+#   - set_prompt
+#   - check_baseline
 #   - archive
 #
 # ===================================================================================================================
 
-def init_dirs():
+def init_dirs( root=None ):
     """
     Set paths and create directories where to save the current execution
+
+    params:
+        root        [str] folder where to create the execution folder, or None for dir_res
     """
     global exec_dir, exec_src, exec_data        # dirs
     global exec_log, exec_pkl, exec_csv         # files
+    global exec_timing, exec_stream
+
+    if cnfg.RESUME is not None:
+        # continue an interrupted execution in its own folder
+        assert os.path.isdir( cnfg.RESUME ), f"error: no folder {cnfg.RESUME} to resume"
+        exec_dir        = cnfg.RESUME
+        exec_src        = os.path.join( exec_dir, os.path.basename( exec_src ) )
+        exec_data       = os.path.join( exec_dir, os.path.basename( exec_data ) )
+        exec_log        = os.path.join( exec_dir, os.path.basename( exec_log ) )
+        exec_pkl        = os.path.join( exec_dir, os.path.basename( exec_pkl ) )
+        exec_csv        = os.path.join( exec_dir, os.path.basename( exec_csv ) )
+        exec_timing     = os.path.join( exec_dir, os.path.basename( exec_timing ) )
+        exec_stream     = os.path.join( exec_dir, os.path.basename( exec_stream ) )
+        save_res.f_stream   = exec_stream
+        return
+
+    exec_dir     = os.path.join( dir_res if root is None else root, now_time )
+    while True:
+        # NOTE the creation fails also when the folder is created by another execution running concurrently
+        try:
+            os.makedirs( exec_dir )
+            break
+        except FileExistsError:
+            if cnfg.VERBOSE:
+                print( f"WARNING: a folder with the timestamp {exec_dir} already exists." )
+                print( "Creating a folder with a timestamp a second ahead.\n" )
+            sec         = int( exec_dir[ -2: ] )
+            sec         += 1
+            exec_dir    = f"{exec_dir[ :-2 ]}{sec:02d}"
+
+    # NOTE the base names are taken again, since in a sweep the globals hold the paths of the previous execution
+    exec_src        = os.path.join( exec_dir, os.path.basename( exec_src ) )
+    exec_data       = os.path.join( exec_dir, os.path.basename( exec_data ) )
 
-    exec_dir     = os.path.join( dir_res, now_time )
-    while os.path.isdir( exec_dir ):
-        if cnfg.VERBOSE:
-            print( f"WARNING: a folder with the timestamp {exec_dir} already exists." )
-            print( "Creating a folder with a timestamp a second ahead.\n" )
-        sec         = int( exec_dir[ -2: ] )
-        sec         += 1
-        exec_dir    = f"{exec_dir[ :-2 ]}{sec:02d}"
-
-    exec_src        = os.path.join( exec_dir, exec_src )
-    exec_data       = os.path.join( exec_dir, exec_data )
-
-    os.makedirs( exec_dir )
     os.makedirs( exec_src )
     os.makedirs( exec_data )
-    exec_log        = os.path.join( exec_dir, exec_log )
-    exec_pkl        = os.path.join( exec_dir, exec_pkl )
-    exec_csv        = os.path.join( exec_dir, exec_csv )
+    exec_log        = os.path.join( exec_dir, os.path.basename( exec_log ) )
+    exec_pkl        = os.path.join( exec_dir, os.path.basename( exec_pkl ) )
+    exec_csv        = os.path.join( exec_dir, os.path.basename( exec_csv ) )
+    exec_timing     = os.path.join( exec_dir, os.path.basename( exec_timing ) )
+    exec_stream     = os.path.join( exec_dir, os.path.basename( exec_stream ) )
+    save_res.f_stream   = exec_stream
 
 
 def init_cnfg():
@@ -108,6 +154,7 @@ def init_cnfg():
         exec( "import " + cnfg.CONFIG )                     # exec the import statement
         file_kwargs     = eval( cnfg.CONFIG + ".kwargs" )   # assign the content to a variable
         cnfg.load_from_file( file_kwargs )                  # read the configuration file
+        cnfg.sweep      = getattr( sys.modules[ cnfg.CONFIG ], 'axes', None )  # axes of a sweep, if any
 
     else:                                                   # default configuration
         cnfg.model_id           = 0                         # use the defaul model
@@ -119,6 +166,25 @@ def init_cnfg():
         cnfg.dialogs_pre        = ""                        # set a reasonable default
         cnfg.dialogs_post       = ""                        # set a reasonable default
         cnfg.news_ids           = []                        # set a reasonable default
+        cnfg.draft_id           = None                      # no assisted generation
+        cnfg.attn_impl          = None                      # default attention of the model
+        cnfg.cache_impl         = None                      # dynamic KV cache
+        cnfg.compile            = False                     # no compilation
+        cnfg.cb_slots           = 0                         # no continuous batching
+        cnfg.hedge              = None                      # no hedged requests
+        cnfg.n_workers          = 1                         # no worker processes
+        cnfg.worker_threads     = None                      # split all cores among workers
+        cnfg.onnx_vision        = False                     # vision encoder in PyTorch
+        cnfg.onnx_threads       = None                      # default threads of ONNX Runtime
+        cnfg.offline            = False                     # login to the hub
+        cnfg.pipeline           = False                     # news processed in sequence
+        cnfg.prefetch           = 4                         # prompts built ahead of the model, with pipeline
+        cnfg.follow_ups         = []                        # single-turn conversations
+        cnfg.score_turn         = 0                         # replies to the prompt of the news are the result
+        cnfg.adaptive_ci        = None                      # fixed number of returns
+        cnfg.adaptive_round     = 5                         # returns per round, with adaptive sampling
+        cnfg.api_concurrency    = 1                         # one OpenAI request at a time
+        cnfg.sweep              = None                      # a single execution
 
     if not hasattr( cnfg, 'experiment' ):
         cnfg.experiment         = None                      # whether experiment uses images or not
@@ -127,53 +193,111 @@ def init_cnfg():
     if cnfg.MAXTOKENS is not None:      cnfg.max_tokens = cnfg.MAXTOKENS
     if cnfg.MODEL is not None:          cnfg.model_id   = cnfg.MODEL
     if cnfg.NRETURNS is not None:       cnfg.n_returns  = cnfg.NRETURNS
+    if cnfg.DRAFT is not None:          cnfg.draft_id   = cnfg.DRAFT
+
+    set_model()
+
+    now_time        = time.strftime( frmt_response )        # string used for composing file names of results
+
+    set_prompt()
 
+    # pass global parameters to other modules
+    cmplt.cnfg          = cnfg
+    conv.cnfg           = cnfg
+    workers.cnfg        = cnfg
+    pipeline.cnfg       = cnfg
+    save_res.cnfg       = cnfg
+    estimate.cnfg       = cnfg
+
+
+def set_model():
+    """
+    Derive the parameters depending on the model, and check that they are consistent
+    NOTE Execute this function again whenever the model or the generation parameters change
+    """
     # if a model is used, from its index derive the complete model name and usage mode
     if hasattr( cnfg, 'model_id' ):
         assert cnfg.model_id < len( models ), f"error: model # {cnfg.model_id} not available"
         cnfg.model          = models[ cnfg.model_id ]
         cnfg.mode           = models_endpoint[ cnfg.model ]
         cnfg.interface      = models_interface[ cnfg.model ]
-
-    now_time        = time.strftime( frmt_response )        # string used for composing file names of results
-
-    # export information from config
+        if getattr( cnfg, 'base_url', None ) is None:
+            cnfg.base_url       = models_base_url.get( cnfg.model )
+
+    # the draft model proposes tokens verified by the main model, they must share the tokenizer
+    cnfg.draft          = None
+    if cnfg.draft_id is not None:
+        assert cnfg.draft_id < len( models ), f"error: draft model # {cnfg.draft_id} not available"
+        cnfg.draft          = models[ cnfg.draft_id ]
+        assert "Qwen2-VL" in cnfg.model and "Qwen2-VL" in cnfg.draft, \
+                "error: assisted generation is available only for Qwen2-VL models"
+        assert cnfg.draft != cnfg.model, "error: the draft model should differ from the main model"
+
+    # conversations keep a dynamic KV cache between turns
+    assert 0 <= cnfg.score_turn <= len( cnfg.follow_ups ), f"error: no turn {cnfg.score_turn} to score"
+    if len( cnfg.follow_ups ):
+        assert cnfg.mode == "chat", "error: multi-turn conversations require a chat-mode model"
+        assert cnfg.cache_impl is None and cnfg.draft is None, \
+                "error: multi-turn conversations do not support static cache and assisted generation"
+
+    # the compiled decoder needs fixed shapes at each generation step
+    assert not cnfg.compile or cnfg.cache_impl == "static", "error: compiling the decoder requires the static cache"
+
+
+def set_prompt():
+    """
+    Export to the prompt module the parameters of the configuration it uses
+    NOTE Execute this function again whenever these parameters change
+    """
     if hasattr( cnfg, 'f_dialog' ):     prmpt.f_dialog  = cnfg.f_dialog
+    if hasattr( cnfg, 'f_news' ):       prmpt.f_news    = cnfg.f_news
     if hasattr( cnfg, 'f_demo' ):       prmpt.f_demo    = cnfg.f_demo
     if hasattr( cnfg, 'detail' ):       prmpt.detail    = cnfg.detail
     prmpt.DEBUG     = cnfg.DEBUG
 
-    # pass global parameters to other modules
-    cmplt.cnfg          = cnfg
-    conv.cnfg           = cnfg
-    save_res.cnfg       = cnfg
+
+def check_baseline():
+    """
+    Check that the completions of the baseline execution can be reused in the current execution
+    """
+    flog        = os.path.join( cnfg.BASELINE, os.path.basename( exec_log ) )
+    assert os.path.isfile( flog ), f"error: no execution in {cnfg.BASELINE} to use as baseline"
+    assert cnfg.adaptive_ci is None, "error: adaptive sampling cannot top up a baseline"
+    assert cnfg.sweep is None, "error: a sweep cannot top up a baseline"
+
+    # the baseline without stream, executed before the results were streamed, has the prompts only as text
+    params      = save_res.read_config( flog )
+    logged      = not save_res.has_stream( cnfg.BASELINE )
+    for k in baseline_params:
+        value       = getattr( cnfg, k, None )
+        if isinstance( value, dict ):
+            value       = { j: str( v ) for j, v in value.items() }
+        elif hasattr( cnfg, k ):
+            value       = str( value )
+        if k in params or ( logged and k in baseline_logged ):
+            assert params.get( k ) == value, \
+                    f"error: {k} is {getattr( cnfg, k, None )}, in the baseline {params.get( k )}"
 
 
 def archive():
     """
-    Save a copy of current python source and json data files in the execution folder
+    Save a copy of all python sources and json data files in the execution folder, with their manifest
     """
-    jfiles  = ( "dialogs.json",
-                "news.json",
-                "demographics.json",
+    jfiles  = ( prmpt.f_dialog,                     # the data files used, that may be set in the config
+                prmpt.f_news,
+                prmpt.f_demo,
     )
 
-    pfiles  = [ "main_exec.py",
-                "prompt.py",
-                "load_cnfg.py",
-                "models.py",
-                "save_res.py",
-                "complete.py"
-    ]
+    # all the modules, so that the execution can be reproduced from the restored sources
+    pfiles  = sorted( f for f in os.listdir( '.' ) if f.endswith( ".py" ) )
 
-    if cnfg.CONFIG is not None:
+    if cnfg.CONFIG is not None and cnfg.CONFIG + ".py" not in pfiles:
         pfiles.append( cnfg.CONFIG + ".py" )
 
-    for pfile in pfiles:
-        shutil.copy( pfile, exec_src )
-    for jfile in jfiles:
-        jfile   = os.path.join( dir_json, jfile )
-        shutil.copy( jfile, exec_data )
+    # the files are hard links to the content-addressed store, shared by all executions
+    files   = [ ( pfile, os.path.basename( exec_src ) ) for pfile in pfiles ]
+    files   += [ ( os.path.join( dir_json, jfile ), os.path.basename( exec_data ) ) for jfile in jfiles ]
+    objstore.archive( files, exec_dir )
 
 
 # ===================================================================================================================
@@ -190,31 +314,172 @@ def do_exec():
     return:     True if execution is succesful
     """
     fstream         = open( exec_log, 'w', encoding="utf-8" )   # open the log file
+    t_start         = time.time()
+    save_res.stream_key = save_res.config_key( resume_params )
 
     match cnfg.experiment:
         case "news_noimage":
-            pr, compl, res, names           = conv.ask_news( with_img=False, demographics=cnfg.demographics )
+            modalities                      = [ False ]
+            res                             = conv.ask_news( with_img=False, demographics=cnfg.demographics )
+            scores                          = [ res ]
 
         case "news_image":
-            pr, compl, res, names           = conv.ask_news( with_img=True, demographics=cnfg.demographics )
+            modalities                      = [ True ]
+            res                             = conv.ask_news( with_img=True, demographics=cnfg.demographics )
+            scores                          = [ res ]
 
         case "both":
-            pr_img, com_img, res_img, n_i   = conv.ask_news( with_img=True, demographics=cnfg.demographics )
-            pr_noi, com_noi, res_noi, n_n   = conv.ask_news( with_img=False, demographics=cnfg.demographics )
-            pr                              = pr_img + pr_noi
-            compl                           = com_img + com_noi
-            names                           = n_i + n_n
+            # the two halves are executed together
+            modalities                      = [ True, False ]
+            scores                          = conv.ask_both( demographics=cnfg.demographics )
+            res_img, res_noi                = scores
             res                             = { "with_img": res_img, "no_img": res_noi }
 
         case _:
             print( f"ERROR: experiment '{cnfg.experiment}' not implemented" )
             return None
 
-    save_res.write_all( fstream, pr, compl, res, names, exec_csv, exec_pkl, mode=cnfg.mode )
+    # only the scores are kept in memory, the prompts and completions are read from the stream file
+    elapsed         = time.time() - t_start
+    n_prompts       = sum( len( s ) for s in scores )
+    n_samples       = sum( len( r[ "yes" ] ) for s in scores for r in s.values() )
+    stats           = cmplt.run_stats() + conv.reply_stats() + pipeline.run_stats()
+    stats.append( f"wall time                {elapsed:.1f} s for {n_prompts} prompts, {n_samples} completions" )
+    # only the completions generated by this execution are timed
+    save_res.write_timing( exec_timing, n_prompts, n_samples - conv.reused_samples, elapsed,
+                           load_seconds=cmplt.load_seconds )
+    save_res.write_all( fstream, res, modalities, exec_csv, exec_pkl, mode=cnfg.mode, stats=stats )
     fstream.close()
     return True
 
 
+# ===================================================================================================================
+#
+#   Sweep of several executions in one process
+#   - sweep_cells
+#   - reset_stats
+#   - set_cell
+#   - do_sweep
+#   - do_queue
+#
+# ===================================================================================================================
+
+def sweep_cells( axes ):
+    """
+    Expand the axes of a sweep into all the combinations of their values.
+    The cells of the same model are consecutive, so that each model is loaded once.
+    An axis with a dict of lists as values, like the categories of demographics.json, is expanded into
+    all the combinations of the values of the dict
+
+    params:
+        axes        [dict] with parameter names as keys and lists of values
+
+    return:         [list] of [dict] with the value of each parameter in the cell
+    """
+    names       = sorted( axes, key=lambda k: k != 'model_id' )
+    values      = []
+    for k in names:
+        v       = axes[ k ]
+        if isinstance( v, dict ):
+            keys    = list( v )
+            v       = [ dict( zip( keys, c ) ) for c in itertools.product( *v.values() ) ]
+        values.append( v )
+
+    return [ dict( zip( names, c ) ) for c in itertools.product( *values ) ]
+
+
+def reset_stats():
+    """
+    Reset the statistics collected by the modules, so that the log of each cell has its own
+    """
+    cmplt.load_seconds      = None              # set again only if the client is loaded again
+    cmplt.batch_stats       = None
+    for k in cmplt.usage_stats:
+        cmplt.usage_stats[ k ]  = 0
+    for k in ( "requests", "hedged", "won", "saved" ):
+        cmplt.hedge_stats[ k ]  = 0
+    for k in conv.reply_warnings:
+        conv.reply_warnings[ k ]    = 0
+    conv.turn_stats.clear()
+    conv.adaptive_samples.clear()
+    conv.reused_samples     = 0
+    pipeline.stats          = None
+
+
+def set_cell( cell ):
+    """
+    Set the parameters of a cell of the sweep in the configuration.
+    The client is kept when the model does not change, with its caches and compiled decoder
+
+    params:
+        cell        [dict] with the value of each parameter in the cell
+    """
+    global now_time
+
+    if cell.get( 'model_id', cnfg.model_id ) != cnfg.model_id:
+        if cnfg.base_url == models_base_url.get( cnfg.model ):
+            cnfg.base_url   = None                  # the default server of the previous model
+        cmplt.client        = None                  # release the previous model
+        cmplt.static_caches.clear()
+        cmplt.warmed.clear()
+        cmplt.hedge_stats[ "latencies" ].clear()
+
+    for k, v in cell.items():
+        setattr( cnfg, k, v )
+    set_model()
+    set_prompt()
+    reset_stats()
+    now_time        = time.strftime( frmt_response )
+
+
+def do_sweep():
+    """
+    Execute all the cells of the sweep in cnfg.sweep, each saving its results in its own folder as do_exec
+
+    return:     True if all executions are succesful
+    """
+    cells       = sweep_cells( cnfg.sweep )
+    t_start     = time.time()
+    ok          = True
+    for i, cell in enumerate( cells ):
+        set_cell( cell )
+        init_dirs()
+        if not cnfg.DEBUG:
+            archive()
+        ok          = do_exec() and ok
+
+        elapsed     = time.time() - t_start
+        eta         = elapsed / ( i + 1 ) * ( len( cells ) - i - 1 )
+        print( f"sweep cell {i + 1}/{len( cells )} done in {os.path.basename( exec_dir )}, "
+               f"elapsed {elapsed / 60:.1f} min, ETA {eta / 60:.1f} min" )
+        if cnfg.VERBOSE:
+            for k, v in cell.items():
+                print( f"    {k:<20}{v}" )
+
+    return ok
+
+
+def do_queue():
+    """
+    Execute the cells of the sweep in cnfg.sweep taken from the work queue in cnfg.QUEUE, shared with other
+    workers, until all of them are completed. Each cell is committed in its own folder as do_exec
+
+    return:     True if no cell failed
+    """
+    os.makedirs( dir_res, exist_ok=True )
+    workqueue.init_queue( cnfg.QUEUE, sweep_cells( cnfg.sweep ), dir_res )
+
+    def execute( cell, staging ):
+        set_cell( cell )
+        init_dirs( root=staging )
+        if not cnfg.DEBUG:
+            archive()
+        assert do_exec(), f"error: execution of cell {cell} failed"
+        return exec_dir
+
+    return workqueue.run_worker( execute, dir_res )
+
+
 # ===================================================================================================================
 #
 #   MAIN
@@ -227,10 +492,26 @@ if __name__ == '__main__':
 
     else:
         init_cnfg()
+        # the folders to resume or to top up hold the execution of one model, they cannot be given to all models
+        assert cnfg.MODELS is None or ( cnfg.RESUME is None and cnfg.BASELINE is None ), \
+                "error: --resume and --baseline cannot be used with --models"
+        if cnfg.BASELINE is not None:
+            check_baseline()
+        if cnfg.ESTIMATE:
+            estimate.do_estimate( dir_res )
+            sys.exit()
+        if cnfg.MODELS is not None:
+            ok  = multirun.run_models( cnfg.MODELS )
+            sys.exit( 0 if ok else 1 )
+        assert cnfg.QUEUE is None or cnfg.sweep is not None, "error: a work queue requires the axes of a sweep"
+        if cnfg.sweep is not None:
+            assert cnfg.RESUME is None, "error: a sweep cannot resume an execution"
+            ok  = do_queue() if cnfg.QUEUE is not None else do_sweep()
+            sys.exit( 0 if ok else 1 )
         init_dirs()
         if cnfg.experiment is not None:
             if cnfg.DEBUG:
                 print( "Program running in DEBUG mode, not archiving" )
-            else:
+            elif cnfg.RESUME is None:
                 archive()
             do_exec()
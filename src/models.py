@@ -18,6 +18,8 @@ models                  = (                     # available models (first one is
         "facebook/chameleon-7b",
         "Qwen/Qwen2-VL-2B-Instruct",
         "Qwen/Qwen2-VL-7B-Instruct",
+        "local/Qwen2-VL-7B-Instruct",
+        "local/llava-v1.6-mistral-7b-hf",
 )
 models_endpoint         = {                     # which endpoint should be used for a model
         "gpt-3.5-turbo-instruct"            : "cmpl",
@@ -31,6 +33,8 @@ models_endpoint         = {                     # which endpoint should be used
         "facebook/chameleon-7b"             : "cmpl",
         "Qwen/Qwen2-VL-2B-Instruct"         : "chat",
         "Qwen/Qwen2-VL-7B-Instruct"         : "chat",
+        "local/Qwen2-VL-7B-Instruct"        : "chat",
+        "local/llava-v1.6-mistral-7b-hf"    : "chat",
 }
 models_interface        = {                     # which interface should be used for a model
         "gpt-3.5-turbo-instruct"            : "openai",
@@ -44,6 +48,12 @@ models_interface        = {                     # which interface should be used
         "facebook/chameleon-7b"             : "hf",
         "Qwen/Qwen2-VL-2B-Instruct"         : "hf",
         "Qwen/Qwen2-VL-7B-Instruct"         : "hf",
+        "local/Qwen2-VL-7B-Instruct"        : "local",
+        "local/llava-v1.6-mistral-7b-hf"    : "local",
+}
+models_base_url         = {                     # URL of the OpenAI-compatible server of "local" models
+        "local/Qwen2-VL-7B-Instruct"        : "http://localhost:8000/v1",
+        "local/llava-v1.6-mistral-7b-hf"    : "http://localhost:8000/v1",
 }
 models_short_name       = {                     # short name identifying a model, as used in statistics
         "gpt-3.5-turbo"                     : "gpt35",
@@ -55,4 +65,21 @@ models_short_name       = {                     # short name identifying a model
         "facebook/chameleon-7b"             : "cham7b",
         "Qwen/Qwen2-VL-2B-Instruct"         : "qwen2b",
         "Qwen/Qwen2-VL-7B-Instruct"         : "qwen7b",
+        "local/Qwen2-VL-7B-Instruct"        : "qwen7bl",
+        "local/llava-v1.6-mistral-7b-hf"    : "ll167bl",
+}
+models_price            = {                     # price of OpenAI models in $ per 1M tokens, input and output
+        "gpt-3.5-turbo-instruct"            : ( 1.50, 2.00 ),
+        "gpt-3.5-turbo"                     : ( 0.50, 1.50 ),
+        "gpt-4"                             : ( 30.0, 60.0 ),
+        "gpt-4-vision-preview"              : ( 10.0, 30.0 ),
+        "gpt-4o-2024-05-13"                 : ( 5.00, 15.0 ),
+        "gpt-4o"                            : ( 2.50, 10.0 ),
+        "gpt-4o-mini"                       : ( 0.15, 0.60 ),
+}
+models_image_tokens     = {                     # input tokens of an image for OpenAI models, base and per tile
+        "gpt-4-vision-preview"              : ( 85, 170 ),
+        "gpt-4o-2024-05-13"                 : ( 85, 170 ),
+        "gpt-4o"                            : ( 85, 170 ),
+        "gpt-4o-mini"                       : ( 2833, 5667 ),
 }
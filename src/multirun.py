@@ -0,0 +1,127 @@
+"""
+#####################################################################################################################
+
+    Module to execute several models in one invocation
+
+    Each model is executed by main_exec.py in its own process, since configuration and client are global
+    in every module, and saves its results in its own folder in res/.
+    The processes are scheduled on an asyncio event loop: models using APIs are network-bound and run all
+    at the same time, local HF models are CPU-bound and at most hf_parallel of them run together.
+    All the other options are given to every model, except --resume and --baseline, rejected by main_exec.py
+    since their folder holds the execution of one model.
+
+#####################################################################################################################
+"""
+
+import  sys
+import  time
+
+from    models          import models, models_interface
+
+hf_parallel             = 1                     # maximum number of HF models running at the same time
+
+
+# ===================================================================================================================
+#
+#   - child_argv
+#   - run_model
+#   - run_all
+#   - run_models
+#
+# ===================================================================================================================
+
+def child_argv():
+    """
+    Return the command line arguments of the current execution, without the list of models
+
+    return:         [list] of [str]
+    """
+    argv        = []
+    skip        = False
+    for a in sys.argv[ 1: ]:
+        if a == "--models":
+            skip    = True
+            continue
+        if a.startswith( "--models=" ):
+            continue
+        if skip and a.isdigit():
+            continue
+        skip    = False
+        argv.append( a )
+
+    return argv
+
+
+async def run_model( model_id, argv, limit ):
+    """
+    Execute main_exec.py for one model, printing its output with the model index as prefix
+
+    params:
+        model_id    [int] index in the list of models
+        argv        [list] of command line arguments, common to all models
+        limit       [asyncio.Semaphore] limiting the models of the same kind running together
+
+    return:         [tuple] model index, exit code, elapsed seconds
+    """
+    cmd         = [ sys.executable, "main_exec.py", *argv, "-m", str( model_id ) ]
+    async with limit:
+        t_start     = time.perf_counter()
+        proc        = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout  = asyncio.subprocess.PIPE,
+                stderr  = asyncio.subprocess.STDOUT
+        )
+        async for line in proc.stdout:
+            print( f"[{model_id:>2d}] {line.decode( errors='replace' ).rstrip()}" )
+        code        = await proc.wait()
+
+    return model_id, code, time.perf_counter() - t_start
+
+
+async def run_all( model_ids, argv ):
+    """
+    Execute all models concurrently, with API models unbounded and HF models limited to hf_parallel
+
+    params:
+        model_ids   [list] of [int] indices in the list of models
+        argv        [list] of command line arguments, common to all models
+
+    return:         [list] of tuples model index, exit code, elapsed seconds
+    """
+    api_limit   = asyncio.Semaphore( len( model_ids ) )
+    hf_limit    = asyncio.Semaphore( hf_parallel )
+    tasks       = []
+    for m in model_ids:
+        limit       = hf_limit if models_interface[ models[ m ] ] == "hf" else api_limit
+        tasks.append( run_model( m, argv, limit ) )
+
+    return await asyncio.gather( *tasks )
+
+
+def run_models( model_ids ):
+    """
+    Execute the current command for all the models given, and print a summary
+
+    params:
+        model_ids   [list] of [int] indices in the list of models
+
+    return:         [bool] True if all executions are succesful
+    """
+    global  asyncio
+    import  asyncio                             # imported only when used, it takes most of the startup of main_exec
+
+    for m in model_ids:
+        assert 0 <= m < len( models ), f"error: model # {m} not available"
+
+    t_start     = time.perf_counter()
+    results     = asyncio.run( run_all( model_ids, child_argv() ) )
+
+    print( "\n ID   model                                     exit   time [s]" )
+    for m, code, elapsed in results:
+        name    = models[ m ]
+        if len( name ) > 40:
+            name    = name[ : 26 ] + "<...>" + name[ -9 : ]
+        print( f"{m:>3d}   {name:<43}{code:>4d}{elapsed:>11.1f}" )
+    print( f"total time {time.perf_counter() - t_start:.1f} s" )
+
+    return all( code == 0 for _, code, _ in results )
@@ -0,0 +1,314 @@
+"""
+#####################################################################################################################
+
+    Module to archive the source and data files of the executions in a content-addressed store
+
+    Each file is stored once in dir_objects, named by the sha256 of its content, and the files in the execution
+    folder are hard links to the stored objects, so that identical files of all executions share the same space.
+    The hashes of the files are written in the manifest of the execution folder.
+    When the execution folder is on another file system, the files are copied, and the manifest is the same.
+
+        NOTE the stored objects are read-only, since editing a hard link would change all the executions
+
+    Pruning removes the objects with no hard link from an execution, and no entry in the manifests in dir_res.
+    It holds the lock of the store exclusively, while archiving holds it shared, and it keeps the objects newer
+    than grace seconds, in case the lock is not supported by a shared file system.
+
+        NOTE pruning is valid only when all the executions are in dir_res, on the file system of dir_objects:
+             the copies of executions moved elsewhere do not count as links of their objects
+
+    Usage:
+        $ python objstore.py restore ../res/24-05-13_10-21-44 ../restored      sources and data of an execution
+        $ python objstore.py dedup [execution folders]                          store the copies of past executions
+        $ python objstore.py prune                                              remove objects of no execution
+
+#####################################################################################################################
+"""
+
+import  os
+import  json
+import  time
+import  fcntl
+import  shutil
+import  hashlib
+import  argparse
+import  contextlib
+
+dir_objects             = "../objects"          # folder of the stored objects
+dir_res                 = "../res"              # folder of results
+f_manifest              = "manifest.json"       # hashes of the archived files of an execution
+archived                = ( "src", "data" )     # subfolders of an execution with the archived files
+chunk                   = 1 << 20               # bytes read at once when hashing
+f_lock                  = ".lock"               # lock file of the store, in dir_objects
+grace                   = 3600                  # seconds after their last link when objects are not pruned
+
+
+# ===================================================================================================================
+#
+#   - locked
+#   - file_hash
+#   - object_path
+#   - store
+#   - link
+#   - archive
+#   - restore
+#   - dedup
+#   - prune
+#
+# ===================================================================================================================
+
+@contextlib.contextmanager
+def locked( exclusive=False ):
+    """
+    Hold the lock of the store, shared when adding objects and exclusive when removing them
+
+    params:
+        exclusive   [bool] True for an exclusive lock
+    """
+    os.makedirs( dir_objects, exist_ok=True )
+    with open( os.path.join( dir_objects, f_lock ), 'a' ) as f:
+        fcntl.flock( f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH )
+        try:
+            yield
+        finally:
+            fcntl.flock( f, fcntl.LOCK_UN )
+
+
+def file_hash( fname ):
+    """
+    Return the sha256 of the content of a file
+
+    params:
+        fname       [str] file with path
+
+    return:         [str] hex digest
+    """
+    h       = hashlib.sha256()
+    with open( fname, 'rb' ) as f:
+        while True:
+            b   = f.read( chunk )
+            if not b:
+                break
+            h.update( b )
+    return h.hexdigest()
+
+
+def object_path( digest ):
+    """
+    Return the path of a stored object, in a subfolder named by the first two characters of the hash
+
+    params:
+        digest      [str] hex digest of the content
+
+    return:         [str]
+    """
+    return os.path.join( dir_objects, digest[ :2 ], digest[ 2: ] )
+
+
+def store( fname ):
+    """
+    Store the content of a file, if not stored yet
+
+    params:
+        fname       [str] file with path
+
+    return:         [str] hex digest of the content
+    """
+    digest  = file_hash( fname )
+    fobj    = object_path( digest )
+    if os.path.isfile( fobj ):
+        return digest
+
+    # a temporary copy is renamed, so that a stored object is always complete
+    os.makedirs( os.path.dirname( fobj ), exist_ok=True )
+    ftmp    = f"{fobj}.{os.getpid()}.tmp"
+    shutil.copyfile( fname, ftmp )
+    os.chmod( ftmp, 0o444 )
+    os.replace( ftmp, fobj )
+    return digest
+
+
+def link( digest, dest ):
+    """
+    Place a stored object in an execution folder, with a hard link or a copy on another file system
+
+    params:
+        digest      [str] hex digest of the content
+        dest        [str] file with path in the execution folder
+
+    return:         [bool] True if the object is hard linked
+    """
+    fobj    = object_path( digest )
+    try:
+        os.link( fobj, dest )
+        return True
+    except OSError:
+        shutil.copyfile( fobj, dest )
+        return False
+
+
+def archive( files, exec_dir ):
+    """
+    Archive files in an execution folder, and write its manifest
+
+    params:
+        files       [list] of tuples ( file with path, subfolder of the execution folder )
+        exec_dir    [str] the execution folder
+    """
+    manifest    = dict()
+    with locked():
+        for fname, sub in files:
+            rel     = os.path.join( sub, os.path.basename( fname ) )
+            digest  = store( fname )
+            link( digest, os.path.join( exec_dir, rel ) )
+            manifest[ rel ] = digest
+
+        with open( os.path.join( exec_dir, f_manifest ), 'w' ) as f:
+            json.dump( manifest, f, indent=4 )
+
+
+def restore( exec_dir, dest ):
+    """
+    Copy the archived files of an execution in a folder, checking their hashes.
+    The files are taken from the stored objects, or from the execution folder if the objects are not available
+
+    params:
+        exec_dir    [str] the execution folder
+        dest        [str] folder where to copy the files, with the same subfolders of the execution
+
+    return:         [int] number of files restored
+    """
+    fman        = os.path.join( exec_dir, f_manifest )
+    assert os.path.isfile( fman ), f"error: no {f_manifest} in {exec_dir}, its files are not archived in the store"
+    with open( fman, 'r' ) as f:
+        manifest    = json.load( f )
+
+    for rel, digest in manifest.items():
+        src     = object_path( digest )
+        if not os.path.isfile( src ):
+            src     = os.path.join( exec_dir, rel )
+        assert os.path.isfile( src ) and file_hash( src ) == digest, f"error: content of {rel} not available"
+        fdest   = os.path.join( dest, rel )
+        os.makedirs( os.path.dirname( fdest ), exist_ok=True )
+        shutil.copyfile( src, fdest )
+
+    return len( manifest )
+
+
+def dedup( exec_dir ):
+    """
+    Store the archived files of a past execution, replacing them with hard links, and write its manifest
+
+    params:
+        exec_dir    [str] the execution folder
+
+    return:         [int] bytes saved, 0 if the execution has a manifest already
+    """
+    if os.path.isfile( os.path.join( exec_dir, f_manifest ) ):
+        return 0
+
+    files       = []
+    saved       = 0
+    for sub in archived:
+        folder  = os.path.join( exec_dir, sub )
+        if not os.path.isdir( folder ):
+            continue
+        for name in sorted( os.listdir( folder ) ):
+            fname   = os.path.join( folder, name )
+            if os.path.isfile( fname ):
+                files.append( ( fname, sub ) )
+
+    manifest    = dict()
+    with locked():
+        for fname, sub in files:
+            digest  = file_hash( fname )
+            fobj    = object_path( digest )
+            if not os.path.isfile( fobj ):
+                # the first copy becomes the stored object, without copying it
+                os.makedirs( os.path.dirname( fobj ), exist_ok=True )
+                os.chmod( fname, 0o444 )
+                try:
+                    os.link( fname, fobj )
+                except FileExistsError:
+                    pass                            # stored in the meantime by another process
+                except OSError:
+                    store( fname )                  # the execution is on another file system
+            if not os.path.samefile( fname, fobj ):
+                size    = os.path.getsize( fname )
+                os.remove( fname )
+                if link( digest, fname ):
+                    saved   += size
+            manifest[ os.path.join( sub, os.path.basename( fname ) ) ] = digest
+
+        with open( os.path.join( exec_dir, f_manifest ), 'w' ) as f:
+            json.dump( manifest, f, indent=4 )
+    return saved
+
+
+def prune():
+    """
+    Remove the stored objects not linked by any execution, nor listed in the manifests in dir_res,
+    and older than grace seconds
+
+    return:         [int] number of objects removed
+    """
+    removed     = 0
+    if not os.path.isdir( dir_objects ):
+        return removed
+
+    listed      = set()
+    if os.path.isdir( dir_res ):
+        for r in os.listdir( dir_res ):
+            fman    = os.path.join( dir_res, r, f_manifest )
+            if os.path.isfile( fman ):
+                with open( fman, 'r' ) as f:
+                    listed.update( json.load( f ).values() )
+
+    with locked( exclusive=True ):
+        now     = time.time()
+        for sub in os.listdir( dir_objects ):
+            folder  = os.path.join( dir_objects, sub )
+            if not os.path.isdir( folder ):
+                continue
+            for name in os.listdir( folder ):
+                fobj    = os.path.join( folder, name )
+                st      = os.stat( fobj )
+                # the change time of an object is updated by each new link
+                if st.st_nlink > 1 or sub + name in listed or now - st.st_ctime < grace:
+                    continue
+                os.remove( fobj )
+                removed += 1
+
+    return removed
+
+
+# ===================================================================================================================
+#
+#   MAIN
+#
+# ===================================================================================================================
+
+if __name__ == '__main__':
+    parser      = argparse.ArgumentParser()
+    parser.add_argument( 'command', choices=( "restore", "dedup", "prune" ) )
+    parser.add_argument( 'args', nargs='*', help="execution folder and destination for restore, "
+                                                "execution folders for dedup (default all)" )
+    args        = parser.parse_args()
+
+    match args.command:
+        case "restore":
+            assert len( args.args ) == 2, "usage: python objstore.py restore <execution folder> <destination>"
+            n       = restore( *args.args )
+            print( f"{n} files restored in {args.args[ 1 ]}" )
+
+        case "dedup":
+            runs    = args.args if len( args.args ) else \
+                      [ os.path.join( dir_res, r ) for r in sorted( os.listdir( dir_res ) ) ]
+            saved   = 0
+            for r in runs:
+                if os.path.isdir( r ):
+                    saved   += dedup( r )
+            print( f"{len( runs )} executions, {saved / 1e6:.1f} MB saved" )
+
+        case "prune":
+            print( f"{prune()} objects removed" )
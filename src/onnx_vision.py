@@ -0,0 +1,341 @@
+"""
+#####################################################################################################################
+
+    Module to run the vision encoders of HF models with ONNX Runtime on CPU
+
+    The vision tower and the projector of LLaVA-NeXT, and the vision transformer of Qwen2-VL (including its
+    patch merger), are exported once to ONNX in dir_onnx, and verified against the PyTorch modules.
+    Then the modules of the model are replaced by wrappers running the ONNX Runtime session, so that
+    model.generate is unchanged. Chameleon has no separate vision encoder, and is left as it is.
+
+        NOTE: the Qwen2-VL encoder is exported for images resized to native_res, images with a different grid
+        of patches fall back to the PyTorch encoder
+
+    The parameters of each export (native_res, shape of the inputs, versions of the packages) are
+    written in a JSON file next to it, and the encoder is exported again when they change.
+
+#####################################################################################################################
+"""
+
+import  os
+import  copy
+import  json
+import  time
+import  types
+import  numpy           as np
+import  torch
+import  onnxruntime     as ort
+from    PIL             import Image
+
+import  complete        as cmplt                # this module performs LLM completions
+from    models          import models_short_name
+
+dir_onnx                = "../onnx"             # folder of the exported encoders
+opset                   = 17                    # ONNX opset of the export
+verify_atol             = 1e-3                  # maximum difference allowed between ONNX and PyTorch outputs
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+
+
+# ===================================================================================================================
+#
+#   Wrappers of ONNX Runtime sessions, replacing the PyTorch modules
+#   - LlavaTower
+#   - QwenVisual
+#
+# ===================================================================================================================
+
+class LlavaTower( torch.nn.Module ):
+    """
+    Replace the vision tower of LLaVA-NeXT. The ONNX graph computes the selected hidden layer of the tower
+    and applies the projector, which is then replaced by an identity.
+    The projector acts on each token, so removing the CLS token afterwards (as the model does) is the same.
+    """
+
+    def __init__( self, session, dtype ):
+        super().__init__()
+        self.session    = session
+        self._dtype     = dtype
+
+    @property
+    def dtype( self ):
+        return self._dtype
+
+    @property
+    def device( self ):
+        return torch.device( "cpu" )
+
+    def forward( self, pixel_values, output_hidden_states=True, **kwargs ):
+        x       = pixel_values.detach().float().cpu().numpy()
+        y       = self.session.run( None, { "pixel_values": x } )[ 0 ]
+        y       = torch.from_numpy( y ).to( self._dtype )
+
+        # the model indexes the hidden states with vision_feature_layer, any index returns the projected output
+        return types.SimpleNamespace( hidden_states=SameItem( y ), last_hidden_state=y )
+
+
+class SameItem( object ):
+    """
+    Sequence returning the same item for any index
+    """
+
+    def __init__( self, item ):
+        self.item   = item
+
+    def __getitem__( self, i ):
+        return self.item
+
+
+class QwenVisual( torch.nn.Module ):
+    """
+    Replace the vision transformer of Qwen2-VL. Each image in the batch is encoded with the ONNX graph
+    if its grid of patches is the one of the export, otherwise with the original PyTorch module.
+    The replicas of the same image, used for multiple returns, are encoded only once.
+    """
+
+    def __init__( self, session, visual, grid ):
+        super().__init__()
+        self.session    = session
+        self.visual     = visual
+        self.grid       = grid
+
+    def get_dtype( self ):
+        return torch.float32
+
+    def forward( self, hidden_states, grid_thw ):
+        dtype   = self.visual.get_dtype()
+        outputs = []
+        start   = 0
+        prev    = None
+        for g in grid_thw:
+            n       = int( g.prod() )
+            x       = hidden_states[ start : start + n ]
+            start   += n
+            if prev is not None and prev.shape == x.shape and torch.equal( prev, x ):
+                outputs.append( outputs[ -1 ] )
+            elif tuple( g.tolist() ) == self.grid:
+                y       = self.session.run( None, { "pixel_values": x.detach().float().cpu().numpy() } )[ 0 ]
+                outputs.append( torch.from_numpy( y ) )
+            else:
+                outputs.append( self.visual( x.to( dtype ), grid_thw=g[ None ] ).float() )
+            prev    = x
+
+        return torch.cat( outputs ).to( dtype )
+
+
+# ===================================================================================================================
+#
+#   Export and verification
+#   - TowerProjector
+#   - QwenEncoder
+#   - sample_inputs
+#   - onnx_file
+#   - export_params
+#   - export
+#   - new_session
+#   - verify
+#   - patch_client
+#
+# ===================================================================================================================
+
+class TowerProjector( torch.nn.Module ):
+    """
+    Vision tower and projector of LLaVA-NeXT, as a single module to export
+    """
+
+    def __init__( self, tower, projector, layer ):
+        super().__init__()
+        self.tower      = tower
+        self.projector  = projector
+        self.layer      = layer
+
+    def forward( self, pixel_values ):
+        hidden  = self.tower( pixel_values, output_hidden_states=True ).hidden_states[ self.layer ]
+        return self.projector( hidden )
+
+
+class QwenEncoder( torch.nn.Module ):
+    """
+    Vision transformer of Qwen2-VL for one image with a given grid of patches, as a module to export
+    """
+
+    def __init__( self, visual, grid ):
+        super().__init__()
+        self.visual     = visual
+        self.grid       = grid
+
+    def forward( self, pixel_values ):
+        return self.visual( pixel_values, grid_thw=self.grid )
+
+
+def sample_inputs( processor ):
+    """
+    Return the inputs of the vision encoder for a blank image of native resolution
+
+    params:
+        processor   [transformers.models...] client input processor
+
+    return:         [dict] with the processed image
+    """
+    image   = Image.new( "RGB", cmplt.native_res )
+    return processor.image_processor( images=[ image ], return_tensors="pt" )
+
+
+def onnx_file():
+    """
+    Return the file of the exported encoder of the current model
+
+    return:         [str] path of the ONNX file
+    """
+    name    = models_short_name.get( cnfg.model, cnfg.model.replace( '/', '_' ) )
+    return os.path.join( dir_onnx, f"{name}_vision.onnx" )
+
+
+def export_params( x ):
+    """
+    Return the parameters an exported encoder depends on
+
+    params:
+        x           [torch.Tensor] sample pixel values
+
+    return:         [dict]
+    """
+    import  transformers
+
+    return {
+        "model":            cnfg.model,
+        "native_res":       list( cmplt.native_res ),
+        "shape":            list( x.shape ),
+        "opset":            opset,
+        "transformers":     transformers.__version__,
+        "torch":            torch.__version__,
+        "onnxruntime":      ort.__version__,           # the optimized graph is saved by onnxruntime
+    }
+
+
+def export( module, x, fname, dynamic=True ):
+    """
+    Export a vision encoder to ONNX, in float32, with the file of its parameters.
+    The optimized graph of a previous export is removed
+
+    params:
+        module      [torch.nn.Module] the encoder taking only the pixel values
+        x           [torch.Tensor] sample pixel values
+        fname       [str] path of the ONNX file
+        dynamic     [bool] whether the first dimension of the input is variable (the number of tiles)
+    """
+    axes        = { "pixel_values": { 0: "n" }, "features": { 0: "n" } } if dynamic else None
+    os.makedirs( dir_onnx, exist_ok=True )
+    f_opt       = fname.replace( ".onnx", "_opt.onnx" )
+    if os.path.isfile( f_opt ):
+        os.remove( f_opt )
+    t_start     = time.time()
+    with torch.no_grad():
+        torch.onnx.export(
+                module,
+                ( x, ),
+                fname,
+                input_names     = [ "pixel_values" ],
+                output_names    = [ "features" ],
+                dynamic_axes    = axes,
+                opset_version   = opset,
+        )
+    with open( fname.replace( ".onnx", ".json" ), 'w' ) as f:
+        json.dump( export_params( x ), f, indent=4 )
+    if cnfg.VERBOSE:
+        print( f"vision encoder exported to {fname} in {time.time() - t_start:.1f} s" )
+
+
+def new_session( fname ):
+    """
+    Return an ONNX Runtime session on CPU, with all graph optimizations and cnfg.onnx_threads threads.
+    The optimized graph is saved next to the exported one, and loaded directly the next times
+
+    params:
+        fname       [str] path of the ONNX file
+
+    return:         [onnxruntime.InferenceSession]
+    """
+    f_opt       = fname.replace( ".onnx", "_opt.onnx" )
+    options     = ort.SessionOptions()
+    if os.path.isfile( f_opt ):
+        fname                               = f_opt
+        options.graph_optimization_level    = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+    else:
+        options.graph_optimization_level    = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.optimized_model_filepath    = f_opt
+    options.execution_mode      = ort.ExecutionMode.ORT_SEQUENTIAL
+    if cnfg.onnx_threads is not None:
+        options.intra_op_num_threads    = cnfg.onnx_threads
+        options.inter_op_num_threads    = 1
+
+    return ort.InferenceSession( fname, sess_options=options, providers=[ "CPUExecutionProvider" ] )
+
+
+def verify( module, x, session ):
+    """
+    Check the output of the ONNX session against the PyTorch module
+
+    params:
+        module      [torch.nn.Module] the encoder taking only the pixel values
+        x           [torch.Tensor] sample pixel values
+        session     [onnxruntime.InferenceSession] session of the exported encoder
+
+    return:         [float] the maximum absolute difference
+    """
+    with torch.no_grad():
+        y_torch     = module( x ).float().numpy()
+    y_onnx      = session.run( None, { "pixel_values": x.numpy() } )[ 0 ]
+    diff        = float( np.abs( y_torch - y_onnx ).max() )
+    assert diff < verify_atol, f"error: ONNX vision encoder differs from PyTorch by {diff:.2e}"
+    if cnfg.VERBOSE:
+        print( f"ONNX vision encoder verified, maximum difference {diff:.2e}" )
+
+    return diff
+
+
+def patch_client( client ):
+    """
+    Replace the vision encoder of the client model with its ONNX version, exporting it if not done before.
+    The exported encoder is verified at each load, in float32 against the PyTorch modules
+
+    params:
+        client      [dict] the HF client, as returned by complete.set_hf
+    """
+    model       = client[ "model" ]
+    inputs      = sample_inputs( client[ "processor" ] )
+    fname       = onnx_file()
+
+    # export and verify a float32 copy, the model keeps its own weights
+    if "llava" in cnfg.model:
+        layer       = model.config.vision_feature_layer
+        module      = TowerProjector( model.vision_tower, model.multi_modal_projector, layer )
+        x           = inputs[ "pixel_values" ][ 0 ].float()         # the tiles of the image
+    elif "Qwen" in cnfg.model:
+        grid        = inputs[ "image_grid_thw" ]
+        module      = QwenEncoder( model.visual, grid )
+        x           = inputs[ "pixel_values" ].float()
+    else:
+        print( f"WARNING: model {cnfg.model} has no vision encoder to run with ONNX" )
+        return
+    module      = copy.deepcopy( module ).float().eval()
+
+    # the encoder is exported again if it was exported with other parameters
+    fparams     = fname.replace( ".onnx", ".json" )
+    params      = None
+    if os.path.isfile( fname ) and os.path.isfile( fparams ):
+        with open( fparams, 'r' ) as f:
+            params  = json.load( f )
+    if params != export_params( x ):
+        if os.path.isfile( fname ) and cnfg.VERBOSE:
+            print( f"vision encoder {fname} exported with other parameters, exporting it again" )
+        export( module, x, fname, dynamic="llava" in cnfg.model )
+    session     = new_session( fname )
+    verify( module, x, session )
+    del module
+
+    if "llava" in cnfg.model:
+        model.vision_tower          = LlavaTower( session, model.dtype )
+        model.multi_modal_projector = torch.nn.Identity()
+    else:
+        model.visual                = QwenVisual( session, model.visual, tuple( grid[ 0 ].tolist() ) )
@@ -0,0 +1,187 @@
+"""
+#####################################################################################################################
+
+    Module to process the news in a pipeline of three stages, connected by bounded queues
+
+        build   (thread)        composes the prompts and decodes the images, up to cnfg.prefetch ahead of the model
+        infer   (main thread)   obtains the completions from the model
+        post    (thread)        checks the replies, behind the model
+
+    The time each stage waits on its queues (stalls) and the depth of the queues are collected in stats.
+
+#####################################################################################################################
+"""
+
+import  time
+import  queue
+import  threading
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+stats                   = None                  # statistics of the stages and queues, over all pipelines
+done                    = object()              # item signaling the end of the stream in the queues
+stages                  = ( "build", "infer", "post" )
+wait                    = 0.1                   # seconds between the checks for a failed stage, when blocked
+
+
+# ===================================================================================================================
+#
+#   - init_stats
+#   - put
+#   - get
+#   - run_pipeline
+#   - run_stats
+#
+# ===================================================================================================================
+
+def init_stats():
+    """
+    Initialize the statistics, once for all the pipelines of the execution
+    """
+    global stats
+    if stats is not None:
+        return
+    stats   = {
+        "stages":   { s: { "items": 0, "busy": 0., "stall": 0. } for s in stages },
+        "queues":   { q: { "gets": 0, "depth_sum": 0, "depth_max": 0 } for q in ( "built", "inferred" ) },
+    }
+
+
+def put( q, item, stage, stop ):
+    """
+    Put an item in a queue, counting the time the stage is blocked because the queue is full.
+    The wait ends when a stage fails, since the queue may be no longer read
+
+    params:
+        q           [queue.Queue] the queue
+        item        the item
+        stage       [str] the stage putting the item
+        stop        [threading.Event] set when a stage fails
+
+    return:         [bool] False if the item is not put because a stage has failed
+    """
+    t_start     = time.perf_counter()
+    while not stop.is_set():
+        try:
+            q.put( item, timeout=wait )
+            break
+        except queue.Full:
+            pass
+    stats[ "stages" ][ stage ][ "stall" ]   += time.perf_counter() - t_start
+    return not stop.is_set()
+
+
+def get( q, name, stage, stop ):
+    """
+    Get an item from a queue, counting the time the stage is blocked because the queue is empty,
+    and sampling the depth of the queue. The wait ends when a stage fails
+
+    params:
+        q           [queue.Queue] the queue
+        name        [str] the name of the queue
+        stage       [str] the stage getting the item
+        stop        [threading.Event] set when a stage fails
+
+    return:         the item, or done if a stage has failed
+    """
+    qs          = stats[ "queues" ][ name ]
+    depth       = q.qsize()
+    qs[ "gets" ]        += 1
+    qs[ "depth_sum" ]   += depth
+    qs[ "depth_max" ]   = max( qs[ "depth_max" ], depth )
+
+    t_start     = time.perf_counter()
+    item        = done
+    while not stop.is_set():
+        try:
+            item    = q.get( timeout=wait )
+            break
+        except queue.Empty:
+            pass
+    stats[ "stages" ][ stage ][ "stall" ]   += time.perf_counter() - t_start
+    return done if stop.is_set() else item
+
+
+def run_pipeline( items, build, infer, post ):
+    """
+    Process the items through the three stages, and return the results in order
+
+    params:
+        items       [list] the inputs of build
+        build       [function] taking an item, like conversation.load_one
+        infer       [function] taking the output of build, like conversation.infer_loaded
+        post        [function] taking the output of infer, like conversation.post_one
+
+    return:         [list] with the outputs of post
+    """
+    init_stats()
+    built       = queue.Queue( maxsize=cnfg.prefetch )
+    inferred    = queue.Queue( maxsize=cnfg.prefetch )
+    results     = []
+    errors      = []
+    stop        = threading.Event()             # set by the first stage failing, to stop all the others
+
+    def run_stage( stage, func, inputs, q_out ):
+        try:
+            for x in inputs:
+                t_start = time.perf_counter()
+                y       = func( x )
+                stats[ "stages" ][ stage ][ "busy" ]    += time.perf_counter() - t_start
+                stats[ "stages" ][ stage ][ "items" ]   += 1
+                if q_out is None:
+                    results.append( y )
+                elif not put( q_out, y, stage, stop ):
+                    return
+        except Exception as e:
+            errors.append( e )
+            stop.set()
+            return
+        if q_out is not None:
+            put( q_out, done, stage, stop )
+
+    def drain( q, name, stage ):
+        while True:
+            x       = get( q, name, stage, stop )
+            if x is done:
+                return
+            yield x
+
+    # threads are daemons, so that they do not block the exit on an interrupt
+    t_build     = threading.Thread( target=run_stage, args=( "build", build, items, built ), daemon=True )
+    t_post      = threading.Thread( target=run_stage, args=( "post", post, drain( inferred, "inferred", "post" ), None ),
+                                    daemon=True )
+    t_build.start()
+    t_post.start()
+    try:
+        run_stage( "infer", infer, drain( built, "built", "infer" ), inferred )
+    except BaseException:
+        stop.set()                              # interrupted, the other stages are stopped before exiting
+        raise
+    finally:
+        t_post.join()
+        t_build.join()
+
+    # the first error of any stage is raised once all the stages have stopped
+    if errors:
+        raise errors[ 0 ]
+    return results
+
+
+def run_stats():
+    """
+    Return the statistics of the pipelines of the execution, to write in the log
+
+    return:         [list] of [str] lines
+    """
+    lines       = []
+    if stats is None:
+        return lines
+
+    for s in stages:
+        st      = stats[ "stages" ][ s ]
+        lines.append( f"pipeline {s:<16}{st[ 'items' ]} items, busy {st[ 'busy' ]:.1f} s, "
+                      f"stalled {st[ 'stall' ]:.1f} s" )
+    for q, qs in stats[ "queues" ].items():
+        mean    = qs[ "depth_sum" ] / qs[ "gets" ] if qs[ "gets" ] else 0.
+        lines.append( f"queue {q:<19}mean depth {mean:.2f}, max depth {qs[ 'depth_max' ]} of {cnfg.prefetch}" )
+
+    return lines
@@ -10,11 +10,6 @@ import  os
 import  sys
 import  copy
 import  pickle
-import  numpy               as np
-import  pandas              as pd
-from    matplotlib          import pyplot
-from    matplotlib.patches  import Patch, Polygon
-from    matplotlib.lines    import Line2D
 
 figsize         = ( 18.0, 8.0 )                             # figure size in inches
 labelspacing    = 1.2
@@ -63,6 +58,8 @@ def plot_values_no_glabel( df, groups=["value","age"], values=["yes_img", "yes_t
         fname       [str] name of the output file
         suptitle    [str] plot title
     """
+    from    matplotlib          import pyplot
+    from    matplotlib.patches  import Patch
 
     columns = df.columns
     y       = []                        # list of all vectors to plot
@@ -155,6 +152,8 @@ def plot_values( df, groups=["value","age"], values=["yes_img", "yes_txt"], fnam
         suptitle    [str] plot title
         xlabels     [list] labels for the X axis, is None the components of the last group are assumed
     """
+    from    matplotlib          import pyplot
+    from    matplotlib.patches  import Patch
 
     columns = df.columns
     y       = []                        # list of all vectors to plot
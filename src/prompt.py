@@ -12,7 +12,6 @@ import  sys
 import  string
 import  base64
 import  json
-from    PIL         import Image
 
 
 dir_json                = "../data"                 # directory with all input data
@@ -22,11 +21,13 @@ f_news                  = "news.json"               # filename of the news tests
 f_demo                  = "demographics.json"       # filename of demographic data
 detail                  = "high"                    # parameter for OpenAI image, overwritten by cnfg
 DEBUG                   = False                     # validated by main_exec
+json_cache              = dict()                    # content of the JSON files already read, by filename
 
 
 # ===================================================================================================================
 #
 #   Utilities to read data
+#   - load_json
 #   - list_news
 #   - image_pil
 #   - image_b64
@@ -35,6 +36,23 @@ DEBUG                   = False                     # validated by main_exec
 #
 # ===================================================================================================================
 
+def load_json( fname ):
+    """
+    Return the content of a JSON file, read only the first time
+    NOTE the content is shared by all callers, and should not be modified
+
+    params:
+        fname   [str] name of the file, with path
+
+    return:     [list] or [dict] the content of the file
+    """
+    if fname not in json_cache:
+        with open( fname, 'r' ) as f:
+            json_cache[ fname ] = json.load( f )
+
+    return json_cache[ fname ]
+
+
 def list_news():
     """
     Return the list with all ID of the news found in the JSON dataset
@@ -42,8 +60,7 @@ def list_news():
     return:     [list] with news IDs
     """
     fname   = os.path.join( dir_json, f_news )
-    with open( fname, 'r' ) as f:
-        data    = json.load( f )
+    data    = load_json( fname )
     ids     = [ d[ 'id' ] for d in data ]
 
     return ids
@@ -59,8 +76,7 @@ def image_pil( i ):
     return:     [PIL.JpegImagePlugin.JpegImageFile]
     """
     fname   = os.path.join( dir_json, f_news )
-    with open( fname, 'r' ) as f:
-        data    = json.load( f )
+    data    = load_json( fname )
     ids     = [ d[ 'id' ] for d in data ]
 
     try:
@@ -69,6 +85,8 @@ def image_pil( i ):
         print( f"ERROR: non existing news with ID={i} in image_pil()" )
         raise e
 
+    from    PIL         import Image
+
     img_name    = data[ idx ][ "image" ]
     fname       = os.path.join( dir_imgs, img_name )
     img         = Image.open( fname )
@@ -106,8 +124,7 @@ def get_dialog(i, with_img, demographics=None):
 
     fname = os.path.join(dir_json, f_dialog)
 
-    with open(fname, 'r') as f:
-        data = json.load(f)
+    data = load_json(fname)
     ids = [d['id'] for d in data]
 
     try:
@@ -140,8 +157,7 @@ def get_dialog(i, with_img, demographics=None):
     if demographics:
         # Load valid demographic attributes
         dfile = os.path.join( dir_json, f_demo )
-        with open(dfile, 'r') as f:
-            valid_demographics = json.load(f)
+        valid_demographics = load_json(dfile)
 
         # Validate demographics against available options
         valid_keys = valid_demographics.keys()
@@ -254,8 +270,7 @@ def compose_prompt(
                     [str] image name or "" if not with_img
     """
     fname   = os.path.join( dir_json, f_news )
-    with open( fname, 'r' ) as f:
-        data    = json.load( f )
+    data    = load_json( fname )
     ids     = [ d[ 'id' ] for d in data ]
 
     try:
@@ -0,0 +1,210 @@
+"""
+#####################################################################################################################
+
+    Re-classify the completions of past executions with the current check_reply, without calling any model
+
+    The completions are read from the log of each execution, the scores are computed again and res.pkl, res.csv
+    and the table of results in log.txt are written again, for the executions whose scores changed.
+    The executions are processed in parallel.
+
+    Usage:
+        $ python replay.py                      all executions in res/
+        $ python replay.py 24-05-13_10-21-44    only the executions given
+        $ python replay.py -n                   only report the executions that would change
+
+#####################################################################################################################
+"""
+
+import  os
+import  re
+import  argparse
+import  multiprocessing     as mp
+
+import  conversation        as conv             # this module handles conversations with the LLM
+import  save_res                                # this module saves results
+
+dir_res                 = "../res"              # folder of results
+exec_log                = "log.txt"
+exec_pkl                = "res.pkl"
+exec_csv                = "res.csv"
+
+
+# ===================================================================================================================
+#
+#   - rebuild
+#   - changed_news
+#   - rewrite_log
+#   - replay_run
+#   - read_args
+#
+# ===================================================================================================================
+
+def rebuild( dialogs ):
+    """
+    Compute the scores of the completions, with the same structure of the results of main_exec.do_exec
+
+    params:
+        dialogs     [list] of tuples ( news id, with_img, img_name, prompt, completions ) as returned by
+                    save_res.read_dialogs
+
+    return:         [dict] of scores per news
+    """
+    res_img     = dict()
+    res_txt     = dict()
+    for news_id, with_img, _, _, completions in dialogs:
+        scores      = conv.check_reply( completions )
+        if with_img:
+            res_img[ news_id ]  = scores
+        else:
+            res_txt[ news_id ]  = scores
+
+    if len( res_img ) and len( res_txt ):
+        return { "with_img": res_img, "no_img": res_txt }
+    return res_img if len( res_img ) else res_txt
+
+
+def changed_news( old, new ):
+    """
+    Return the news whose scores differ
+
+    params:
+        old         [dict] of scores per news, as saved in res.pkl
+        new         [dict] of scores per news, as computed by rebuild
+
+    return:         [list] of [str] news ids, with the modality for the both experiment
+    """
+    import  numpy               as np
+
+    if "with_img" in new:
+        return [ f"{k}+i" for k in changed_news( old.get( "with_img", {} ), new[ "with_img" ] ) ] + \
+               [ f"{k}-i" for k in changed_news( old.get( "no_img", {} ), new[ "no_img" ] ) ]
+
+    changed     = []
+    for k, rs in new.items():
+        if k not in old or any( not np.array_equal( old[ k ][ v ], rs[ v ] ) for v in rs ):
+            changed.append( k )
+    return changed
+
+
+def rewrite_log( flog, fcsv ):
+    """
+    Replace the table of results in the text log, written after the header with the configuration,
+    and the counts of unclear and contradicting replies in the statistics of the execution, if any
+
+    params:
+        flog        [str] log file with path and extension
+        fcsv        [str] csv file with path and extension
+    """
+    line        = 60 * "=" + "\n"
+    with open( flog, 'r', encoding="utf-8" ) as f:
+        text    = f.read()
+
+    # the table starts after the third separator line, and ends with the next one
+    start       = 0
+    for _ in range( 3 ):
+        start   = text.index( line, start ) + len( line ) + 1
+    stop        = text.index( "\n" + line, start )
+    text        = text[ :start ] + save_res.table_text( fcsv ) + text[ stop: ]
+
+    # the statistics follow the table, before the dialogs of the news
+    m           = re.compile( r"^-+ News ", re.MULTILINE ).search( text, start )
+    dialogs     = m.start() if m is not None else len( text )
+    stats       = text[ start : dialogs ]
+    for l in conv.reply_stats()[ :2 ]:
+        stats   = re.sub( f"^{re.escape( l[ :25 ] )}.*$", lambda _: l, stats, count=1, flags=re.MULTILINE )
+    text        = text[ :start ] + stats + text[ dialogs: ]
+
+    with open( flog + ".tmp", 'w', encoding="utf-8" ) as f:
+        f.write( text )
+    os.replace( flog + ".tmp", flog )
+
+
+def replay_run( job ):
+    """
+    Re-classify the completions of one execution, and write its results again if the scores changed
+
+    params:
+        job         [tuple] execution folder, and whether to write the results
+
+    return:         [tuple] execution folder, news changed or None if the log cannot be read
+    """
+    folder, write   = job
+    flog        = os.path.join( folder, exec_log )
+    fpkl        = os.path.join( folder, exec_pkl )
+    fcsv        = os.path.join( folder, exec_csv )
+    if not os.path.isfile( flog ):
+        return folder, None
+
+    dialogs     = save_res.read_dialogs( flog )
+    if not len( dialogs ):
+        return folder, None
+    for k in conv.reply_warnings:               # counted for each execution, in the log
+        conv.reply_warnings[ k ]    = 0
+    new         = rebuild( dialogs )
+    old         = save_res.get_pickle( fpkl ) if os.path.isfile( fpkl ) else dict()
+    changed     = changed_news( old, new )
+
+    if write and len( changed ):
+        save_res.write_pickle( fpkl, new )
+        save_res.write_stats( fcsv, results=new )
+        rewrite_log( flog, fcsv )
+
+    return folder, changed
+
+
+def read_args():
+    """
+    Parse the command line arguments
+
+    return:         [argparse.Namespace]
+    """
+    parser      = argparse.ArgumentParser()
+    parser.add_argument(
+            'runs',
+            nargs           = '*',
+            help            = "execution folders in res/ (default all)"
+    )
+    parser.add_argument(
+            '-n',
+            '--dry-run',
+            action          = 'store_true',
+            dest            = 'DRY',
+            help            = "only report the executions whose scores would change"
+    )
+    parser.add_argument(
+            '-j',
+            '--jobs',
+            action          = 'store',
+            dest            = 'JOBS',
+            type            = int,
+            default         = os.cpu_count(),
+            help            = "number of executions processed in parallel"
+    )
+    return parser.parse_args()
+
+
+# ===================================================================================================================
+#
+#   MAIN
+#
+# ===================================================================================================================
+
+if __name__ == '__main__':
+    args        = read_args()
+    runs        = args.runs if len( args.runs ) else sorted( os.listdir( dir_res ) )
+    folders     = [ os.path.join( dir_res, r ) for r in runs ]
+    folders     = [ f for f in folders if os.path.isdir( f ) ]
+
+    with mp.Pool( args.JOBS ) as pool:
+        results     = pool.map( replay_run, [ ( f, not args.DRY ) for f in folders ], chunksize=1 )
+
+    n_changed   = 0
+    for folder, changed in results:
+        name        = os.path.basename( folder )
+        if changed is None:
+            print( f"{name}  no completions found" )
+        elif len( changed ):
+            n_changed   += 1
+            print( f"{name}  changed {len( changed )} news: {' '.join( changed )}" )
+    action      = "would change" if args.DRY else "changed"
+    print( f"{n_changed} of {len( folders )} executions {action}" )
@@ -10,10 +10,17 @@ import  os
 import  sys
 import  platform
 import  pickle
+import  re
 import  csv
-import  numpy       as np
+import  json
+import  io
+import  hashlib
+import  threading
 
 cnfg                = None                  # parameter obj assigned by main_exec.py
+f_stream            = None                  # file of the streamed results, set by main_exec.py
+stream_key          = None                  # hash of the configuration of the streamed results, see config_key
+stream_lock         = threading.Lock()      # records may be written by the threads of the pipeline
 
 
 # ===================================================================================================================
@@ -22,6 +29,7 @@ cnfg                = None                  # parameter obj assigned by main_exe
 #   - write_pickle
 #   - get_pickle
 #   - write_stats
+#   - write_timing
 #
 # ===================================================================================================================
 
@@ -57,6 +65,8 @@ def write_stats( fcsv, fpkl=None, results=None ):
         fpkl        [str] optional pickle file with path and extension
         results     [dict] optional structure with scores per news
     """
+    import  numpy       as np
+
     if fpkl is not None:
         results     = get_pickle( fpkl )
     else:
@@ -76,11 +86,15 @@ def write_stats( fcsv, fpkl=None, results=None ):
         for v in values:
             res_img[ v ]    = []
             res_txt[ v ]    = []
+        n_img           = []
+        n_txt           = []
         k_items         = sorted( list( all_res_img.keys() ) )
         for k  in k_items:
             ri          = all_res_img[ k ]
             rt          = all_res_txt[ k ]
             assert len( ri ) > 0, "ERROR: no completions for news {k} in write_stats()"
+            n_img.append( len( ri[ "yes" ] ) )
+            n_txt.append( len( rt[ "yes" ] ) )
             yes_i       = ri[ "yes" ].mean()
             no_i        = ri[ "no" ].mean()
             unk_i       = ri[ "unk" ].mean()
@@ -120,6 +134,11 @@ def write_stats( fcsv, fpkl=None, results=None ):
                     f"{m_no_t:.3f}",
                     f"{m_unk_t:.3f}",
         ] )
+        # mean weighted by the number of completions of each news, after the mean so that parsers are not affected
+        if len( set( n_img + n_txt ) ) > 1:
+            csv_rows.append( [ "wmean" ] +
+                    [ f"{np.average( res_img[ v ], weights=n_img ):.3f}" for v in values ] +
+                    [ f"{np.average( res_txt[ v ], weights=n_txt ):.3f}" for v in values ] )
 
     # stats for executions using news with OR without images (only YES)
     else:
@@ -128,9 +147,11 @@ def write_stats( fcsv, fpkl=None, results=None ):
         k_items     = sorted( list( results.keys() ) )
         for v in values:
             res[ v ]    = []
+        n_compl     = []
         for k  in k_items:
             rs      = results[ k ]
             assert len( rs ) > 0, "ERROR: no completions for news {k} in write_stats()"
+            n_compl.append( len( rs[ "yes" ] ) )
             r_yes       = rs[ "yes" ].mean()
             r_no        = rs[ "no" ].mean()
             r_unk       = rs[ "unk" ].mean()
@@ -148,12 +169,14 @@ def write_stats( fcsv, fpkl=None, results=None ):
             res[ v ]    = np.array( res[ v ] )
         m_yes   = res[ "yes" ].mean()
         m_no    = res[ "no" ].mean()
-        m_ink   = res[ "unk" ].mean()
+        m_unk   = res[ "unk" ].mean()
         csv_rows.append( [ "mean",
                     f"{m_yes:.3f}",
                     f"{m_no:.3f}",
                     f"{m_unk:.3f}",
         ] )
+        if len( set( n_compl ) ) > 1:
+            csv_rows.append( [ "wmean" ] + [ f"{np.average( res[ v ], weights=n_compl ):.3f}" for v in values ] )
 
     # # stats for executions using news with OR without images (only YES)
     # else:
@@ -180,13 +203,230 @@ def write_stats( fcsv, fpkl=None, results=None ):
 
 
 
+def write_timing( fname, n_prompts, n_samples, seconds, load_seconds=None ):
+    """
+    Save the duration of the execution, used to project the time of future executions
+
+    params:
+        fname       [str] json file with path and extension
+        n_prompts   [int] number of prompts
+        n_samples   [int] number of completions
+        seconds     [float] wall time of the execution
+        load_seconds [float] time to load the HF model, or None
+    """
+    timing      = {
+        "model":        cnfg.model,
+        "max_tokens":   cnfg.max_tokens,
+        "prompts":      n_prompts,
+        "samples":      n_samples,
+        "seconds":      seconds,
+        "load_seconds": load_seconds,
+    }
+    with open( fname, 'w' ) as f:
+        json.dump( timing, f, indent=4 )
+
+
+
+# ===================================================================================================================
+#
+#   Functions to stream the results of each news, as soon as they are completed
+#   - config_key
+#   - write_record
+#   - index_records
+#   - load_record
+#   - read_records
+#   - has_stream
+#   - read_baseline
+#
+# ===================================================================================================================
+
+def config_key( params ):
+    """
+    Return a hash of the values of the configuration parameters that affect the results, written in each record
+    of the stream, so that an execution is resumed only with the same configuration
+
+    params:
+        params      [tuple] of [str] names of the parameters
+
+    return:         [str]
+    """
+    values  = { k: getattr( cnfg, k, None ) for k in params }
+    text    = json.dumps( values, sort_keys=True, default=str, ensure_ascii=False )
+    return hashlib.sha1( text.encode( "utf-8" ) ).hexdigest()
+
+
+def write_record( news_id, with_img, prompt, completions, img_name, turns=None ):
+    """
+    Append the result of one news to the stream file, and flush it to disk.
+    Nothing is written if there is no stream file (e.g. in benchmarks)
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        prompt      [list] or [str] the prompt
+        completions [list] of [str]
+        img_name    [str] the image name or ""
+        turns       [dict] with the turn index [str] as key and the completions of the turn as value, for the
+                    turns of conversations other than the scored one, or None
+    """
+    if f_stream is None:
+        return
+    record  = {
+        "model":        cnfg.model,
+        "news":         news_id,
+        "with_img":     with_img,
+        "prompt":       prompt,
+        "completions":  completions,
+        "img_name":     img_name,
+        "config":       stream_key,
+    }
+    if turns is not None:
+        record[ "turns" ]   = turns
+    line    = json.dumps( record, ensure_ascii=False ) + "\n"
+    with stream_lock:
+        with open( f_stream, 'a', encoding="utf-8" ) as f:
+            f.write( line )
+            f.flush()
+            os.fsync( f.fileno() )
+
+
+def index_records( with_img, fname=None ):
+    """
+    Index the results already streamed, for one image modality, without keeping them in memory.
+    A last line truncated by a crash is ignored. The records of the same news with the same prompt are joined,
+    as written when the news are topped up with more samples, a record with another prompt replaces them.
+    The records of the current execution should have its configuration, as written by write_record
+
+    params:
+        with_img    [bool] whether the prompts include image and text
+        fname       [str] stream file with path, or None for the stream of the current execution
+
+    return:         [dict] with news id as key and tuple ( offsets of the lines of its records, number of
+                    completions ) as value
+    """
+    index       = dict()
+    prompts     = dict()                        # hash of the prompt of each news
+    fname       = f_stream if fname is None else fname
+    if fname is None or not os.path.isfile( fname ):
+        return index
+
+    with open( fname, 'rb' ) as f:
+        offset  = 0
+        for line in f:
+            start   = offset
+            offset  += len( line )
+            try:
+                r       = json.loads( line )
+            except ValueError:
+                continue
+            assert r[ "model" ] == cnfg.model, f"error: results of {r['model']} cannot be resumed with {cnfg.model}"
+            assert fname != f_stream or r.get( "config" ) == stream_key, \
+                    f"error: results in {fname} have another configuration, they cannot be resumed"
+            if r[ "with_img" ] != with_img:
+                continue
+            n       = r[ "news" ]
+            h       = hash( json.dumps( r[ "prompt" ], ensure_ascii=False ) )
+            if n in index and prompts[ n ] == h:
+                offsets, count  = index[ n ]
+                index[ n ]      = ( offsets + [ start ], count + len( r[ "completions" ] ) )
+            else:
+                index[ n ]      = ( [ start ], len( r[ "completions" ] ) )
+                prompts[ n ]    = h
+
+    return index
+
+
+def load_record( f, offsets ):
+    """
+    Load the result of one news from the stream file, joining the completions of its records.
+    The replies of the other turns of conversations are None for the records without them
+
+    params:
+        f           [BufferedReader] stream file open in binary mode
+        offsets     [list] of [int] offsets of the lines of the records, as returned by index_records
+
+    return:         [tuple] ( prompt, completions, img_name, turns ), turns as in write_record
+    """
+    completions = []
+    turns       = dict()
+    for o in offsets:
+        f.seek( o )
+        r           = json.loads( f.readline() )
+        for t, c in r.get( "turns", {} ).items():
+            turns.setdefault( t, [ None ] * len( completions ) )
+            turns[ t ]  += c
+        completions += r[ "completions" ]
+        for c in turns.values():
+            c           += [ None ] * ( len( completions ) - len( c ) )
+
+    return r[ "prompt" ], completions, r[ "img_name" ], turns if len( turns ) else None
+
+
+def read_records( with_img, fname=None ):
+    """
+    Read the results already streamed, for one image modality, joined as in index_records
+
+    params:
+        with_img    [bool] whether the prompts include image and text
+        fname       [str] stream file with path, or None for the stream of the current execution
+
+    return:         [dict] with news id as key and tuple ( prompt, completions, img_name, turns ) as value
+    """
+    index       = index_records( with_img, fname=fname )
+    if not len( index ):
+        return dict()
+
+    with open( f_stream if fname is None else fname, 'rb' ) as f:
+        return { n: load_record( f, offsets ) for n, ( offsets, _ ) in index.items() }
+
+
+def has_stream( folder ):
+    """
+    Check whether an execution folder has the stream file, written by the executions that stream their results
+
+    params:
+        folder      [str] the execution folder
+
+    return:         [bool]
+    """
+    return os.path.isfile( os.path.join( folder, "stream.jsonl" ) )
+
+
+def read_baseline( folder, with_img ):
+    """
+    Read the results of a previous execution, for one image modality, from its stream file if any,
+    otherwise from its text log, where the prompts are available only as text, as written by write_dialog
+
+    params:
+        folder      [str] the execution folder
+        with_img    [bool] whether the prompts include image and text
+
+    return:         [dict] with news id as key and tuple ( prompt, completions, img_name, turns ) as value,
+                    prompt is [str] when read from the text log, or None if it cannot be read there,
+                    the turns of conversations are not read from the text log
+    """
+    if has_stream( folder ):
+        return read_records( with_img, fname=os.path.join( folder, "stream.jsonl" ) )
+
+    records     = dict()
+    for news_id, w, name, prompt, completions in read_dialogs( os.path.join( folder, "log.txt" ) ):
+        if w == with_img:
+            records[ news_id ]  = ( prompt, completions, name, None )
+    return records
+
+
+
 # ===================================================================================================================
 #
 #   Functions to write the results on textual log file
 #   - write_header
 #   - write_dialog
+#   - dialog_text
 #   - write_dialogs
+#   - table_text
 #   - write_all
+#   - read_dialogs
+#   - read_config
 #
 # ===================================================================================================================
 
@@ -210,15 +450,17 @@ def write_header( fstream ):
     fstream.write( "\n" + 60 * "=" + "\n\n" )
 
 
-def write_dialog( fstream, prompt, completions, mode="chat" ):
+def write_dialog( fstream, prompt, completions, mode="chat", turns=None ):
     """
-    Write the content of prompts and completions on the log file
+    Write the content of prompts and completions on the log file,
+    followed by the completions of the other turns of conversations
 
     params:
         fstream     [TextIOWrapper] text stream of the output file
         prompt      [list] of dialog messages
         completions [list] of [str]
         mode        [str] "cmpl" or "chat"
+        turns       [dict] with the completions of the other turns, as in write_record, or None
     """
     if mode == "cmpl":
         fstream.write( f"PROMPT:\n{prompt}\n\n" )
@@ -238,54 +480,155 @@ def write_dialog( fstream, prompt, completions, mode="chat" ):
         fstream.write( 60 * "-" + "\n\n" )
         fstream.write( f"COMPLETION #{i}:\n{c}\n\n" )
 
+    for t, compl in ( turns or {} ).items():
+        for i, c in enumerate( compl ):
+            if c is not None:
+                fstream.write( 60 * "-" + "\n\n" )
+                fstream.write( f"TURN {t} COMPLETION #{i}:\n{c}\n\n" )
 
-def write_dialogs( fstream, prompts, completions, results, img_names, mode="chat" ):
+
+def dialog_text( prompt, mode="chat" ):
+    """
+    Return the prompt as written in the log file by write_dialog
+
+    params:
+        prompt      [list] of dialog messages, or [str] in "cmpl" mode
+        mode        [str] "cmpl" or "chat"
+
+    return:         [str]
     """
-    Write the log of all dialogs
+    with io.StringIO() as f:
+        write_dialog( f, prompt, [], mode=mode )
+        return f.getvalue()
+
+
+def write_dialogs( fstream, modalities, mode="chat" ):
+    """
+    Write the log of all dialogs, reading them one at a time from the stream file
 
     params:
         fstream     [TextIOWrapper] text stream of the output file
-        prompt      [list] of prompts
-        completions [list] of completions
-        results     [dict] of scores per news
-        img_names   [list] of image names
+        modalities  [list] of [bool] whether the prompts include image and text, in the order of the log
         mode        [str] "cmpl" or "chat"
     """
     fstream.write( "\n" + 60 * "=" + "\n" )
-    news_list   = cnfg.news_ids
-    if cnfg.experiment == "both":
-        news_list   += cnfg.news_ids
-    for i, pr, compl, name in zip( news_list, prompts, completions, img_names ):
-        if len( name ):
-            fstream.write( f"\n-------------- News {i} with image {name} ---------------\n\n" )
-        else:
-            fstream.write( f"\n---------------- News {i} with no image -------------------\n\n" )
-        write_dialog( fstream, pr, compl, mode=mode )
-        fstream.write( 60 * "=" + "\n" )
+    index       = { w: index_records( w ) for w in modalities }
+    with open( f_stream, 'rb' ) as f:
+        for w in modalities:
+            for i in cnfg.news_ids:
+                pr, compl, name, turns  = load_record( f, index[ w ][ i ][ 0 ] )
+                if len( name ):
+                    fstream.write( f"\n-------------- News {i} with image {name} ---------------\n\n" )
+                else:
+                    fstream.write( f"\n---------------- News {i} with no image -------------------\n\n" )
+                write_dialog( fstream, pr, compl, mode=mode, turns=turns )
+                fstream.write( 60 * "=" + "\n" )
+
+
+def table_text( fcsv ):
+    """
+    Return the csv file pretty printed as a table, as written in the text log
+
+    params:
+        fcsv        [str] csv file with path and extension
+
+    return:         [str]
+    """
+    # unix command to pretty print the csv in the text log
+    cmd     = f"column -s, -t <{fcsv}"
+    with os.popen( cmd ) as r:
+        s   = r.read()
+    return s
 
 
-def write_all( fstream, prompts, completions, results, img_names, fcsv, fpkl, mode="chat" ):
+def write_all( fstream, results, modalities, fcsv, fpkl, mode="chat", stats=None ):
     """
-    Write all result files (text log, csv, pkl)
+    Write all result files (text log, csv, pkl). The prompts and completions are read from the stream file
 
     params:
         fstream     [TextIOWrapper] text stream of the output file
-        prompt      [list] of prompts
-        completions [list] of completions
         results     [dict] of scores per news
-        img_names   [list] of image names
+        modalities  [list] of [bool] whether the prompts include image and text, in the order of the log
         fcsv        [str] csv file with path and extension
         fpkl        [str] pickle file with path and extension
         mode        [str] "cmpl" or "chat"
+        stats       [list] of [str] lines with statistics of the execution, or None
     """
     write_pickle( fpkl, results )
     write_stats( fcsv, results=results )
     write_header( fstream )
+    fstream.write( table_text( fcsv ) )
 
-    # unix command to pretty print the csv in the text log
-    cmd     = f"column -s, -t <{fcsv}"
-    with os.popen( cmd ) as r:
-        s   = r.read()
-    fstream.write( s )
+    # statistics of the execution, after the csv so that scripts parsing the log are not affected
+    if stats:
+        fstream.write( "\n" + 60 * "=" + "\n\n" )
+        for line in stats:
+            fstream.write( line + "\n" )
 
-    write_dialogs( fstream, prompts, completions, results, img_names, mode=mode )
+    write_dialogs( fstream, modalities, mode=mode )
+
+
+def read_dialogs( fname ):
+    """
+    Read the dialogs of all news from a text log written by write_all
+
+    params:
+        fname       [str] log file with path and extension
+
+    return:         [list] of tuples ( news id, with_img, img_name, prompt, completions ), with the prompt as
+                    written by write_dialog, or None if the dialog has no completions
+    """
+    with open( fname, 'r', encoding="utf-8" ) as f:
+        text    = f.read()
+
+    header      = re.compile( r"^-+ News (\S+) with (?:image (.*?)|no image) -+$", re.MULTILINE )
+    separator   = re.compile( r"^-{60}\n\nCOMPLETION #\d+:\n", re.MULTILINE )
+    turn        = re.compile( r"^-{60}\n\nTURN \d+ COMPLETION #\d+:\n", re.MULTILINE )   # other turns, after them
+    end         = re.compile( r"\n\n={60}\n*\Z" )          # the line closing the dialog of the news
+    heads       = list( header.finditer( text ) )
+    dialogs     = []
+    for i, h in enumerate( heads ):
+        stop        = heads[ i + 1 ].start() if i + 1 < len( heads ) else len( text )
+        block       = text[ h.end() : stop ]
+        parts       = separator.split( block )
+        completions = parts[ 1: ]
+        prompt      = parts[ 0 ][ 2: ] if len( completions ) else None      # after the blank line of the header
+        if len( completions ):
+            completions[ -1 ]   = end.sub( "\n\n", turn.split( completions[ -1 ], maxsplit=1 )[ 0 ] )
+        completions = [ c[ :-2 ] if c.endswith( "\n\n" ) else c for c in completions ]
+        name        = h.group( 2 ) if h.group( 2 ) is not None else ""
+        dialogs.append( ( h.group( 1 ), h.group( 2 ) is not None, name, prompt, completions ) )
+
+    return dialogs
+
+
+def read_config( fname ):
+    """
+    Read the configuration parameters from the header of a text log written by write_all
+
+    params:
+        fname       [str] log file with path and extension
+
+    return:         [dict] with the parameters as keys and their values as [str], or as [dict] of [str]
+                    for the parameters with dict values
+    """
+    line        = 60 * "=" + "\n"
+    with open( fname, 'r', encoding="utf-8" ) as f:
+        text    = f.read()
+
+    # the parameters are between the second and the third separator line, as written by write_header
+    start       = text.index( line, text.index( line ) + len( line ) ) + len( line )
+    stop        = text.index( line, start )
+    params      = dict()
+    key         = None                          # the parameter with dict value being read
+    for l in text[ start : stop ].splitlines():
+        if key is not None and l.startswith( 5 * ' ' ):
+            params[ key ][ l[ 5:35 ].strip() ] = l[ 35: ]
+        elif len( l ) >= 35 and not l.startswith( ' ' ):
+            params[ l[ :35 ].strip() ] = l[ 35: ]
+            key     = None
+        elif l.endswith( ':' ) and not l.startswith( ' ' ):
+            key     = l[ :-1 ]
+            params[ key ]   = dict()
+
+    return params
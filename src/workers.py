@@ -0,0 +1,114 @@
+"""
+#####################################################################################################################
+
+    Module to run HF inference on a pool of CPU worker processes
+
+    The model is loaded once in the main process, then the workers are forked from it, so that they share
+    the weights copy-on-write. Each worker is pinned to its own subset of cores, with as many torch threads.
+
+        NOTE forking a process whose OpenMP/MKL thread pool is running may deadlock the children, so the pool
+        should be created before torch is used in the main process, where torch then runs with a single thread
+
+#####################################################################################################################
+"""
+
+import  os
+import  sys
+import  multiprocessing     as mp
+
+import  complete        as cmplt                # this module performs LLM completions
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+cores_queue             = None                  # queue of core partitions, one is taken by each worker
+single_thread           = False                 # torch runs with a single thread in the main process
+
+
+# ===================================================================================================================
+#
+#   - partition_cores
+#   - init_worker
+#   - call_worker
+#   - run_pool
+#
+# ===================================================================================================================
+
+def partition_cores( n_workers ):
+    """
+    Split the cores available to the process in contiguous subsets of the same size
+
+    params:
+        n_workers   [int] number of subsets
+
+    return:         [list] of [list] of core indices
+    """
+    cores       = sorted( os.sched_getaffinity( 0 ) )
+    assert len( cores ) >= n_workers, f"error: {n_workers} workers requested, but only {len( cores )} cores"
+
+    if cnfg.worker_threads is not None:
+        size        = cnfg.worker_threads
+        assert size * n_workers <= len( cores ), "error: not enough cores for workers and threads requested"
+    else:
+        size        = len( cores ) // n_workers
+
+    return [ cores[ i * size : ( i + 1 ) * size ] for i in range( n_workers ) ]
+
+
+def init_worker():
+    """
+    Pin the worker process to one partition of the cores and set the number of torch threads accordingly
+    """
+    cores       = cores_queue.get()
+    os.sched_setaffinity( 0, cores )
+    cmplt.torch.set_num_threads( len( cores ) )
+    if cnfg.VERBOSE:
+        print( f"worker {os.getpid()} running on cores {cores}" )
+
+
+def call_worker( job ):
+    """
+    Execute one job in a worker
+
+    params:
+        job         [tuple] function and its arguments
+
+    return:         the return value of the function
+    """
+    func, args  = job
+    return func( *args )
+
+
+def run_pool( func, args ):
+    """
+    Apply a function to a list of arguments over cnfg.n_workers processes, and return the results in order.
+        NOTE: the function should be defined at module level, and the HF client is loaded before forking,
+        with a single torch thread, so that no thread pool is running in the main process when forking
+
+    params:
+        func        [function] the function to execute, like conversation.complete_one
+        args        [list] of tuples with the arguments of each call
+
+    return:         [list] with the return values, in the same order of args
+    """
+    global cores_queue, single_thread
+
+    # the thread pool of torch is started by its first operation, which should run with a single thread
+    if not single_thread:
+        assert "torch" not in sys.modules, "error: the worker pool should be created before torch is used"
+        import  torch
+        torch.set_num_threads( 1 )
+        single_thread   = True
+
+    if cmplt.client is None:        # load the model in the main process, it will be shared by the workers
+        cmplt.client    = cmplt.set_hf()
+
+    ctx         = mp.get_context( "fork" )
+    n_workers   = min( cnfg.n_workers, len( args ) )
+    cores_queue = ctx.Queue()
+    for cores in partition_cores( n_workers ):
+        cores_queue.put( cores )
+
+    with ctx.Pool( n_workers, initializer=init_worker ) as pool:
+        results     = pool.map( call_worker, [ ( func, a ) for a in args ], chunksize=1 )
+
+    cores_queue = None
+    return results
@@ -0,0 +1,480 @@
+"""
+#####################################################################################################################
+
+    Module to execute the cells of a sweep from a work queue in a shared folder, by workers on several hosts
+
+    There is no coordinator: every worker runs main_exec.py with the same config file and the same queue folder,
+    and the first one fills the queue with the cells of the sweep. The queue folder holds
+
+        cells/      one file per cell, with its parameters
+        claims/     one file per cell in execution, created exclusively by the worker executing it
+        done/       one file per cell committed in res/
+        failed/     one file per cell whose execution raised an error
+        staging/    the folders of the executions not yet committed, one subfolder per worker
+        clock/      one file per worker, to read the time of the shared file system
+
+    A worker renews its claim (the modification time of the file) every heartbeat seconds. A claim older than
+    lease seconds belongs to a dead worker, and its cell is taken by another worker.
+    A cell is executed in the staging folder, and committed once: the done file is created exclusively with a
+    hard link, only the worker succeeding moves its folder in res/, the others discard theirs.
+
+        NOTE the queue folder and res/ should be on the same file system, for the atomic rename of the folders
+
+    Usage:
+        $ python main_exec.py -c cfg_sweep --queue ../queue/sweep       one worker, on each host
+        $ python workqueue.py ../queue/sweep -j 4 -c cfg_sweep          four local workers
+        $ python workqueue.py ../queue/sweep                            status of the queue
+
+#####################################################################################################################
+"""
+
+import  os
+import  sys
+import  json
+import  errno
+import  time
+import  shutil
+import  socket
+import  argparse
+import  threading
+import  traceback
+import  subprocess
+from    datetime        import datetime, timedelta
+
+heartbeat               = 30                    # seconds between the renewals of a claim
+lease                   = 180                   # seconds after the last renewal when a claim is dead
+poll                    = 30                    # seconds between the checks of the queue, when all cells are claimed
+folders                 = ( "cells", "claims", "done", "failed", "staging", "clock" )
+frmt_folder             = "%y-%m-%d_%H-%M-%S"   # datetime format of the execution folders, as in main_exec.py
+
+q_dir                   = None                  # the queue folder
+worker                  = f"{socket.gethostname()}-{os.getpid()}"
+
+
+# ===================================================================================================================
+#
+#   Files of the queue
+#   - path
+#   - write_json
+#   - read_json
+#   - link_json
+#   - fs_now
+#
+# ===================================================================================================================
+
+def path( folder, name ):
+    """
+    Return the path of a file in a folder of the queue
+
+    params:
+        folder      [str] one of folders
+        name        [str] name of the file
+
+    return:         [str]
+    """
+    return os.path.join( q_dir, folder, name )
+
+
+def write_json( fname, data ):
+    """
+    Write a JSON file atomically, replacing it if it exists
+
+    params:
+        fname       [str] file with path
+        data        [dict] content of the file
+    """
+    ftmp        = f"{fname}.{worker}.tmp"
+    with open( ftmp, 'w' ) as f:
+        json.dump( data, f )
+        f.flush()
+        os.fsync( f.fileno() )
+    os.replace( ftmp, fname )
+
+
+def read_json( fname ):
+    """
+    Read a JSON file of the queue
+
+    params:
+        fname       [str] file with path
+
+    return:         [dict] content of the file, or None if the file does not exist or is being written
+    """
+    try:
+        with open( fname, 'r' ) as f:
+            return json.load( f )
+    except ( FileNotFoundError, json.JSONDecodeError ):
+        return None
+
+
+def link_json( fname, data ):
+    """
+    Create a JSON file only if it does not exist, with its full content, so that only one worker succeeds
+
+    params:
+        fname       [str] file with path
+        data        [dict] content of the file
+
+    return:         [bool] True if the file is created by this worker
+    """
+    ftmp        = f"{fname}.{worker}.tmp"
+    with open( ftmp, 'w' ) as f:
+        json.dump( data, f )
+        f.flush()
+        os.fsync( f.fileno() )
+    try:
+        os.link( ftmp, fname )
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove( ftmp )
+
+
+def fs_now():
+    """
+    Return the current time of the shared file system, so that the leases do not depend on the clocks of the hosts
+
+    return:         [float] seconds since the epoch
+    """
+    fclock      = path( "clock", worker )
+    with open( fclock, 'a' ):
+        os.utime( fclock, None )
+    return os.stat( fclock ).st_mtime
+
+
+# ===================================================================================================================
+#
+#   Claims of the cells
+#   - init_queue
+#   - cell_ids
+#   - try_claim
+#   - claim_next
+#   - start_heartbeat
+#   - release
+#
+# ===================================================================================================================
+
+def init_queue( queue, cells, dir_res ):
+    """
+    Create the queue folder and fill it with the cells, if not done by another worker.
+    All the workers should be given the same sweep
+
+    params:
+        queue       [str] the queue folder
+        cells       [list] of [dict] with the parameters of each cell, as main_exec.sweep_cells
+        dir_res     [str] folder where the executions are committed
+    """
+    global q_dir
+    q_dir       = queue
+    for d in folders:
+        os.makedirs( os.path.join( q_dir, d ), exist_ok=True )
+    os.makedirs( path( "staging", worker ) )
+    assert os.stat( q_dir ).st_dev == os.stat( dir_res ).st_dev, \
+            f"error: the queue {q_dir} and {dir_res} should be on the same file system"
+
+    for i, cell in enumerate( cells ):
+        fname   = path( "cells", f"{i:05d}.json" )
+        if not link_json( fname, cell ):
+            assert read_json( fname ) == json.loads( json.dumps( cell ) ), \
+                    f"error: the queue {q_dir} holds a different sweep"
+    assert len( cell_ids() ) == len( cells ), f"error: the queue {q_dir} holds a different sweep"
+
+
+def cell_ids():
+    """
+    Return the ids of all the cells in the queue
+
+    return:         [list] of [str]
+    """
+    return sorted( f[ : -5 ] for f in os.listdir( os.path.join( q_dir, "cells" ) ) if f.endswith( ".json" ) )
+
+
+def try_claim( cell_id, now ):
+    """
+    Claim a cell, if it is not claimed or its claim is dead.
+    A dead claim is renamed before being removed, so that only one worker takes it over
+
+    params:
+        cell_id     [str] id of the cell
+        now         [float] time of the shared file system
+
+    return:         [bool] True if the cell is claimed by this worker
+    """
+    fclaim      = path( "claims", cell_id )
+    try:
+        fd      = os.open( fclaim, os.O_CREAT | os.O_EXCL | os.O_WRONLY )
+    except FileExistsError:
+        try:
+            if now - os.stat( fclaim ).st_mtime < lease:
+                return False
+            fdead   = f"{fclaim}.{worker}.dead"
+            os.rename( fclaim, fdead )
+        except FileNotFoundError:
+            return False                        # released, or taken over by another worker
+
+        # another worker may have claimed the cell again in the meantime, then its claim is restored
+        if now - os.stat( fdead ).st_mtime < lease:
+            try:
+                os.link( fdead, fclaim )
+            except FileExistsError:
+                pass
+            os.remove( fdead )
+            return False
+        owner   = read_json( fdead )
+        os.remove( fdead )
+        print( f"cell {cell_id} of dead worker {owner[ 'worker' ] if owner else '?'} taken over by {worker}" )
+        return try_claim( cell_id, now )
+
+    with os.fdopen( fd, 'w' ) as f:
+        json.dump( { "worker": worker, "time": now }, f )
+    return True
+
+
+def claim_next():
+    """
+    Claim the first cell not yet committed, nor failed, nor claimed by a live worker
+
+    return:         [str] id of the cell claimed, "" if all cells are claimed, None if all cells are completed
+    """
+    now         = fs_now()
+    done        = set( os.listdir( os.path.join( q_dir, "done" ) ) )
+    failed      = set( os.listdir( os.path.join( q_dir, "failed" ) ) )
+    pending     = [ c for c in cell_ids() if c not in done and c not in failed ]
+    if not len( pending ):
+        return None
+
+    for cell_id in pending:
+        if try_claim( cell_id, now ):
+            # the cell may have been completed, and its claim released, after the listing of done and failed
+            if os.path.exists( path( "done", cell_id ) ) or os.path.exists( path( "failed", cell_id ) ):
+                release( cell_id )
+                continue
+            return cell_id
+    return ""
+
+
+def start_heartbeat( cell_id ):
+    """
+    Renew the claim of a cell every heartbeat seconds, in a thread, until the returned event is set.
+    The renewals stop if the claim is taken over by another worker
+
+    params:
+        cell_id     [str] id of the cell
+
+    return:         [threading.Event] to set when the execution of the cell ends
+    """
+    fclaim      = path( "claims", cell_id )
+    stop        = threading.Event()
+
+    def renew():
+        while not stop.wait( heartbeat ):
+            owner   = read_json( fclaim )
+            if owner is None or owner[ "worker" ] != worker:
+                print( f"WARNING: the claim of cell {cell_id} was taken over by another worker" )
+                return
+            os.utime( fclaim, None )
+
+    threading.Thread( target=renew, daemon=True ).start()
+    return stop
+
+
+def release( cell_id ):
+    """
+    Remove the claim of a cell, if still owned by this worker
+
+    params:
+        cell_id     [str] id of the cell
+    """
+    fclaim      = path( "claims", cell_id )
+    owner       = read_json( fclaim )
+    if owner is not None and owner[ "worker" ] == worker:
+        os.remove( fclaim )
+
+
+# ===================================================================================================================
+#
+#   Commits of the executions
+#   - move_folder
+#   - commit
+#   - recover
+#   - run_worker
+#   - status
+#
+# ===================================================================================================================
+
+def move_folder( src, dir_res ):
+    """
+    Move an execution folder into the folder of results, with a timestamp a second ahead if the name is taken.
+    An error is raised if the execution folder does not exist, e.g. moved by another worker
+
+    params:
+        src         [str] the execution folder, named with its timestamp
+        dir_res     [str] folder of results
+
+    return:         [str] name of the folder in dir_res
+    """
+    name        = os.path.basename( src )
+    while True:
+        dest    = os.path.join( dir_res, name )
+        try:
+            if not os.path.exists( dest ):
+                os.rename( src, dest )
+                return name
+        except OSError as e:
+            # only a folder created by another worker in the meantime is skipped
+            if not isinstance( e, FileExistsError ) and e.errno != errno.ENOTEMPTY:
+                raise
+        stamp   = datetime.strptime( name, frmt_folder ) + timedelta( seconds=1 )
+        name    = stamp.strftime( frmt_folder )
+
+
+def commit( cell_id, exec_dir, dir_res ):
+    """
+    Commit the execution of a cell in the folder of results, unless the cell is already committed
+
+    params:
+        cell_id     [str] id of the cell
+        exec_dir    [str] the execution folder in the staging folder
+        dir_res     [str] folder of results
+
+    return:         [str] name of the folder in dir_res, or None if the cell was committed by another worker
+    """
+    fdone       = path( "done", cell_id )
+    if not link_json( fdone, { "worker": worker, "staging": exec_dir } ):
+        print( f"cell {cell_id} already committed by another worker, discarding {exec_dir}" )
+        shutil.rmtree( exec_dir )
+        return None
+
+    name        = move_folder( exec_dir, dir_res )
+    write_json( fdone, { "worker": worker, "staging": exec_dir, "folder": name } )
+    return name
+
+
+def recover( dir_res ):
+    """
+    Complete the commits interrupted after the creation of the done file, and before moving the folder.
+    The commits of the workers still holding the claim of the cell are in progress, and are left to them
+
+    params:
+        dir_res     [str] folder of results
+    """
+    now         = fs_now()
+    for cell_id in os.listdir( os.path.join( q_dir, "done" ) ):
+        if cell_id.endswith( ".tmp" ):
+            continue
+        fdone   = path( "done", cell_id )
+        done    = read_json( fdone )
+        if done is None or "folder" in done or not os.path.isdir( done[ "staging" ] ):
+            continue
+        try:
+            if now - os.stat( path( "claims", cell_id ) ).st_mtime < lease:
+                continue
+        except FileNotFoundError:
+            pass                                # released by a worker whose commit failed
+        try:
+            done[ "folder" ]    = move_folder( done[ "staging" ], dir_res )
+        except FileNotFoundError:
+            continue                            # recovered by another worker in the meantime
+        write_json( fdone, done )
+        print( f"cell {cell_id} recovered from {done[ 'staging' ]}" )
+
+
+def run_worker( execute, dir_res ):
+    """
+    Execute the cells of the queue until all are completed, waiting for the cells claimed by other workers
+
+    params:
+        execute     [function] taking the parameters of a cell and the staging folder,
+                    and returning the execution folder, like main_exec.do_queue
+        dir_res     [str] folder of results
+
+    return:         [bool] True if no cell failed
+    """
+    staging     = path( "staging", worker )
+    recover( dir_res )
+    while True:
+        cell_id     = claim_next()
+        if cell_id is None:
+            break
+        if cell_id == "":
+            time.sleep( poll )
+            continue
+
+        cell        = read_json( path( "cells", f"{cell_id}.json" ) )
+        stop        = start_heartbeat( cell_id )
+        t_start     = time.time()
+        # the claim is held until the cell is committed or marked as failed, so no other worker executes it again
+        try:
+            exec_dir    = execute( cell, staging )
+            name        = commit( cell_id, exec_dir, dir_res )
+        except Exception:
+            write_json( path( "failed", cell_id ), { "worker": worker, "error": traceback.format_exc() } )
+            print( f"ERROR: cell {cell_id} failed, see {path( 'failed', cell_id )}" )
+            continue
+        finally:
+            stop.set()
+            release( cell_id )
+
+        if name is not None:
+            print( f"cell {cell_id} committed in {name} by {worker} in {( time.time() - t_start ) / 60:.1f} min" )
+
+    os.remove( path( "clock", worker ) )
+    if not len( os.listdir( staging ) ):
+        os.rmdir( staging )                     # the executions of failed cells are kept
+    n_failed    = len( os.listdir( os.path.join( q_dir, "failed" ) ) )
+    return n_failed == 0
+
+
+def status():
+    """
+    Print the number of cells in each state, and the cells claimed with the age of their last heartbeat
+    """
+    now         = fs_now()
+    os.remove( path( "clock", worker ) )
+    cells       = cell_ids()
+    done        = set( os.listdir( os.path.join( q_dir, "done" ) ) ) & set( cells )
+    failed      = set( os.listdir( os.path.join( q_dir, "failed" ) ) ) & set( cells )
+    claims      = set( os.listdir( os.path.join( q_dir, "claims" ) ) ) & set( cells )
+    print( f"cells {len( cells )}, done {len( done )}, failed {len( failed )}, claimed {len( claims )}, "
+           f"waiting {len( cells ) - len( done ) - len( failed ) - len( claims )}" )
+    for c in sorted( claims ):
+        owner   = read_json( path( "claims", c ) )
+        try:
+            age     = now - os.stat( path( "claims", c ) ).st_mtime
+        except FileNotFoundError:
+            continue
+        state   = "dead" if age >= lease else "alive"
+        print( f"    {c}  {owner[ 'worker' ] if owner else '?':<30}heartbeat {age:.0f} s ago ({state})" )
+
+
+# ===================================================================================================================
+#
+#   MAIN
+#
+# ===================================================================================================================
+
+if __name__ == '__main__':
+    parser      = argparse.ArgumentParser()
+    parser.add_argument( 'queue', help="the queue folder" )
+    parser.add_argument(
+            '-j',
+            '--jobs',
+            action          = 'store',
+            dest            = 'JOBS',
+            type            = int,
+            default         = 0,
+            help            = "number of local workers to start, the other arguments are passed to main_exec.py"
+    )
+    args, argv  = parser.parse_known_args()
+
+    if not args.JOBS:
+        q_dir       = args.queue
+        assert os.path.isdir( os.path.join( q_dir, "cells" ) ), f"error: no queue in {q_dir}"
+        status()
+        sys.exit()
+
+    cmd         = [ sys.executable, "main_exec.py", *argv, "--queue", args.queue ]
+    procs       = [ subprocess.Popen( cmd ) for _ in range( args.JOBS ) ]
+    codes       = [ p.wait() for p in procs ]
+    sys.exit( max( codes ) )